@@ -0,0 +1,231 @@
+# analytics.py - Compute-before-prompt: run the model's query plan locally with pandas
+import os
+import re
+import json
+import pandas as pd
+
+# Set to 0 to always send the plain sheet summary instead of computed results
+ANALYTICS_ENABLED = os.getenv('ANALYTICS_ENABLED', '1') == '1'
+# Most rows of a computed result put into the prompt
+ANALYTICS_MAX_ROWS = int(os.getenv('ANALYTICS_MAX_ROWS', '50'))
+# Distinct values listed for text columns in the planner's schema
+SCHEMA_MAX_VALUES = 15
+
+FILTER_OPS = ('==', '!=', '>', '>=', '<', '<=', 'in', 'contains', 'between')
+AGG_FUNCS = ('sum', 'mean', 'median', 'min', 'max', 'count', 'nunique')
+# Aggregation, ranking and comparison words; with a column name they mark a question the
+# planner can answer from the rows
+QUERY_WORDS = re.compile(
+    r'\b(sum|total|totals|average|avg|mean of|median|minimum|maximum|count|how many|how much|'
+    r'highest|lowest|largest|smallest|biggest|top \d+|bottom \d+|rank|ranked|sort|sorted|'
+    r'group|grouped|between|greater than|less than|more than|fewer than|at least|at most|filter)\b')
+
+PLANNER_PROMPT = """You turn questions about a spreadsheet into a JSON query plan that is run with pandas.
+
+Columns of the sheet ({rows} rows):
+{schema}
+{history}
+Question:
+{question}
+
+Reply with JSON only, in this form (every key is optional):
+{{"filters": [{{"column": "...", "op": "==", "value": ...}}],
+ "group_by": ["..."],
+ "aggregations": [{{"column": "...", "func": "mean", "as": "..."}}],
+ "sort": [{{"column": "...", "descending": true}}],
+ "columns": ["..."],
+ "limit": 10}}
+
+Allowed filter ops: {ops} ("in" takes a list, "between" takes [low, high]).
+Allowed aggregation funcs: {funcs}. Sort may refer to an aggregation's "as" name.
+Use exact column names from the list above.
+If the question can't be answered by filtering, grouping, aggregating or sorting the rows (for example it asks how to write a formula, or for general advice), reply {{"plan": null}}."""
+
+# Raised when a plan refers to unknown columns or uses unsupported operations
+class PlanError(ValueError):
+    pass
+
+# One line per column for the planner: type plus value range or example values
+def describe_schema(df):
+    lines = []
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series):
+            detail = 'true/false'
+        elif pd.api.types.is_numeric_dtype(series):
+            detail = f'number, {series.min()} to {series.max()}' if series.notna().any() else 'number'
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            detail = f'date, {series.min()} to {series.max()}' if series.notna().any() else 'date'
+        else:
+            values = series.dropna().astype(str).unique()
+            examples = ', '.join(json.dumps(v) for v in values[:SCHEMA_MAX_VALUES])
+            more = f' (+{len(values) - SCHEMA_MAX_VALUES} more)' if len(values) > SCHEMA_MAX_VALUES else ''
+            detail = f'text, e.g. {examples}{more}'
+        lines.append(f'- {col} ({detail})')
+    return '\n'.join(lines)
+
+# Build the planning prompt (schema and question only, never the data itself)
+def planner_prompt(df, question, chat_history=None):
+    history = ''
+    if chat_history:
+        recent = '\n'.join(f"- {entry['question']}" for entry in chat_history[-2:])
+        history = f"\nEarlier questions in this conversation:\n{recent}\n"
+    return PLANNER_PROMPT.format(rows=len(df), schema=describe_schema(df), history=history,
+                                 question=question, ops=', '.join(FILTER_OPS), funcs=', '.join(AGG_FUNCS))
+
+# Extract the JSON plan from the model's reply; None if there is no usable plan
+def parse_plan(text):
+    match = re.search(r'\{.*\}', text or '', flags=re.DOTALL)
+    if not match:
+        return None
+    try:
+        plan = json.loads(match.group(0))
+    except ValueError:
+        return None
+    if not isinstance(plan, dict) or ('plan' in plan and plan['plan'] is None):
+        return None
+    plan = plan.get('plan', plan)
+    return plan if isinstance(plan, dict) and plan else None
+
+# Map column names case-insensitively onto the sheet's actual columns
+def _resolve_column(df, name, extra=()):
+    names = {str(col): col for col in df.columns}
+    names.update({alias: alias for alias in extra})
+    if name in names:
+        return names[name]
+    folded = {key.casefold(): value for key, value in names.items()}
+    if isinstance(name, str) and name.casefold() in folded:
+        return folded[name.casefold()]
+    raise PlanError(f'unknown column {name!r}')
+
+# Check a plan against the sheet and normalize its column names
+def validate_plan(plan, df):
+    checked = {}
+    filters = []
+    for f in plan.get('filters') or []:
+        if not isinstance(f, dict) or f.get('op') not in FILTER_OPS:
+            raise PlanError(f'unsupported filter {f!r}')
+        filters.append({'column': _resolve_column(df, f.get('column')), 'op': f['op'], 'value': f.get('value')})
+    checked['filters'] = filters
+    checked['group_by'] = [_resolve_column(df, col) for col in plan.get('group_by') or []]
+    aggregations = []
+    for agg in plan.get('aggregations') or []:
+        if not isinstance(agg, dict) or agg.get('func') not in AGG_FUNCS:
+            raise PlanError(f'unsupported aggregation {agg!r}')
+        column = _resolve_column(df, agg.get('column'))
+        aggregations.append({'column': column, 'func': agg['func'],
+                             'as': str(agg.get('as') or f"{agg['func']}_{column}")})
+    checked['aggregations'] = aggregations
+    aliases = [agg['as'] for agg in aggregations]
+    checked['sort'] = [{'column': _resolve_column(df, s.get('column'), aliases), 'descending': bool(s.get('descending'))}
+                       for s in plan.get('sort') or [] if isinstance(s, dict)]
+    checked['columns'] = [_resolve_column(df, col, aliases) for col in plan.get('columns') or []]
+    try:
+        checked['limit'] = max(1, min(int(plan.get('limit') or ANALYTICS_MAX_ROWS), ANALYTICS_MAX_ROWS))
+    except (TypeError, ValueError):
+        checked['limit'] = ANALYTICS_MAX_ROWS
+    if checked['group_by'] and not aggregations:
+        raise PlanError('group_by needs at least one aggregation')
+    return checked
+
+# Convert a filter value to the column's type so comparisons work ("2023" vs 2023)
+def _coerce(series, value):
+    if isinstance(value, list):
+        return [_coerce(series, v) for v in value]
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        coerced = pd.to_numeric(value, errors='coerce')
+        return value if pd.isna(coerced) else coerced
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.to_datetime(value, errors='coerce')
+    return value
+
+# Boolean row mask for one filter (text equality ignores case and surrounding spaces)
+def _filter_mask(df, f):
+    series = df[f['column']]
+    op, value = f['op'], _coerce(series, f['value'])
+    is_text = not (pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series))
+    if is_text:
+        series = series.astype(str).str.strip().str.casefold()
+        value = [str(v).strip().casefold() for v in value] if isinstance(value, list) else str(value).strip().casefold()
+    if op == 'contains':
+        return series.astype(str).str.contains(str(value), case=False, regex=False, na=False)
+    if op == 'in':
+        return series.isin(value if isinstance(value, list) else [value])
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2:
+            raise PlanError("'between' needs [low, high]")
+        return series.between(value[0], value[1])
+    compare = {'==': series.eq, '!=': series.ne, '>': series.gt, '>=': series.ge, '<': series.lt, '<=': series.le}
+    return compare[op](value)
+
+# Run a validated plan against the sheet with vectorized pandas operations
+def execute_plan(df, plan):
+    result = df
+    if plan['filters']:
+        mask = pd.Series(True, index=df.index)
+        for f in plan['filters']:
+            mask &= _filter_mask(df, f)
+        result = result[mask]
+    if plan['aggregations']:
+        named = {agg['as']: pd.NamedAgg(column=agg['column'], aggfunc=agg['func']) for agg in plan['aggregations']}
+        if plan['group_by']:
+            result = result.groupby(plan['group_by'], dropna=False, observed=True).agg(**named).reset_index()
+        else:
+            result = pd.DataFrame([{agg['as']: result[agg['column']].agg(agg['func'])
+                                    for agg in plan['aggregations']}])
+    if plan['sort']:
+        result = result.sort_values([s['column'] for s in plan['sort']],
+                                    ascending=[not s['descending'] for s in plan['sort']])
+    if plan['columns']:
+        result = result[[col for col in plan['columns'] if col in result.columns]]
+    return result.head(plan['limit']), len(result)
+
+# Describe a plan in one line for the prompt
+def describe_plan(plan):
+    parts = []
+    if plan['filters']:
+        parts.append('filtered by ' + ' and '.join(f"{f['column']} {f['op']} {json.dumps(f['value'], default=str)}" for f in plan['filters']))
+    if plan['group_by']:
+        parts.append('grouped by ' + ', '.join(map(str, plan['group_by'])))
+    if plan['aggregations']:
+        parts.append('computing ' + ', '.join(f"{agg['func']}({agg['column']}) as {agg['as']}" for agg in plan['aggregations']))
+    if plan['sort']:
+        parts.append('sorted by ' + ', '.join(f"{s['column']} {'desc' if s['descending'] else 'asc'}" for s in plan['sort']))
+    return '; '.join(parts) or 'all rows'
+
+# Lower-case text with underscores read as spaces ("unit_price" matches "unit price")
+def _fold(text):
+    return ' '.join(str(text).replace('_', ' ').casefold().split())
+
+# Cheap local check, run before the sheet is loaded, for whether a question needs row-level
+# computation: it must use an aggregation/comparison word and name one of the sheet's columns.
+# Other questions skip the planner call.
+def needs_computation(column_names, question):
+    text = _fold(question or '')
+    if not QUERY_WORDS.search(text):
+        return False
+    return any(re.search(rf'(?<!\w){re.escape(_fold(col))}(?!\w)', text)
+               for col in column_names if _fold(col))
+
+# Ask the model for a plan, run it locally and return compact prompt data
+# (schema plus the computed result), or None to fall back to the sheet summary
+def computed_context(df, question, chat_history, generate):
+    if not ANALYTICS_ENABLED or df is None or df.empty:
+        return None
+    try:
+        plan = parse_plan(generate(planner_prompt(df, question, chat_history)))
+        if plan is None:
+            return None
+        plan = validate_plan(plan, df)
+        result, total = execute_plan(df, plan)
+    except PlanError as e:
+        print(f"Analytics: plan rejected ({e}), using sheet summary.")
+        return None
+    except Exception as e:
+        print(f"Analytics: could not compute result ({e}), using sheet summary.")
+        return None
+    shown = f'first {len(result)} of {total} result rows' if total > len(result) else f'{total} result rows'
+    return (f"Columns ({len(df)} rows in the sheet):\n{describe_schema(df)}\n\n"
+            f"Computed result for the user's question (exact values computed locally from all rows; "
+            f"{describe_plan(plan)}; {shown}):\n"
+            f"{result.to_string(index=False)}")
@@ -1,140 +1,418 @@
 # backend.py - Core logic for DocuBridge Excel Assistant
-import pandas as pd
-import openpyxl
-import google.generativeai as genai
+import numpy as np
 import os
-from flask import session, redirect, url_for
-from markupsafe import Markup
-from io import BytesIO
+from flask import session, redirect, url_for, abort, jsonify, render_template, Response, stream_with_context
 import uuid
 import re
+import json
+import time
 import markdown as md
+import sheet_cache
+import frame_compact
+import columnar_store
+import jobs
+import batches
+import prompt_builder
+import response_cache
+import context_cache
+import llm_client
+import analytics
+import conversation_store
+import upload_store
+import sheet_index
+import summaries
+import metrics
+from summaries import summarize_dataframe
 
-# Directory to store uploaded files
+# Working directory for uploads (see upload_store), converted sheets and caches
 UPLOAD_FOLDER = 'tmp'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Format a DataFrame as an HTML table for preview
-# Shows all rows if small, or first/last N rows if large
-def format_dataframe_for_display(df, max_rows_display=25):
-    if len(df) <= max_rows_display * 2:
-        html_output = df.to_html(index=False, classes='table table-striped', border=0)
-    else:
-        html_output = df.head(max_rows_display).to_html(index=False, classes='table table-striped', border=0)
-        html_output += "<br>"
-        html_output += df.tail(max_rows_display).to_html(index=False, classes='table table-striped', border=0)
-    return html_output
+# Largest accepted upload (MB)
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', '200'))
+
+# Fallback answers shown when Gemini can't be reached
+NO_API_KEY_MESSAGE = "Please use a Gemini API key to access this feature."
+AI_UNAVAILABLE_MESSAGE = "The AI service is currently unavailable, please try again later."
+AI_BUSY_MESSAGE = "The AI service is busy right now, please try again in a moment."
+FALLBACK_MESSAGES = (NO_API_KEY_MESSAGE, AI_UNAVAILABLE_MESSAGE, AI_BUSY_MESSAGE)
+
+# Seconds to wait for a queued answer that no worker process knows about before giving up
+PENDING_JOB_TIMEOUT = int(os.getenv('PENDING_JOB_TIMEOUT', '300'))
+
+# Most rows and columns returned by one preview request
+PREVIEW_MAX_ROWS = int(os.getenv('PREVIEW_MAX_ROWS', '500'))
+PREVIEW_MAX_COLUMNS = int(os.getenv('PREVIEW_MAX_COLUMNS', '100'))
+
+# Cache, job queue and upload store figures, read on each /metrics scrape
+metrics.gauge('docubridge_sheet_cache_lookups_total', 'Sheet cache lookups in this worker by result',
+              lambda: {'hit': sheet_cache.stats()['hits'], 'miss': sheet_cache.stats()['misses']},
+              label_name='result', kind='counter')
+metrics.gauge('docubridge_sheet_cache_hit_ratio', 'Share of sheet cache lookups in this worker that were hits',
+              lambda: sheet_cache.stats()['hit_ratio'])
+metrics.gauge('docubridge_sheet_cache_bytes', 'Memory used by cached sheets in this worker',
+              lambda: sheet_cache.stats()['bytes'])
+metrics.gauge('docubridge_sheet_cache_entries', 'Sheets cached in this worker', lambda: sheet_cache.stats()['entries'])
+metrics.gauge('docubridge_sheet_cache_evictions_total', 'Sheets dropped from this worker\'s cache by reason',
+              lambda: {'budget': sheet_cache.stats()['evictions'], 'idle': sheet_cache.stats()['idle_evictions']},
+              label_name='reason', kind='counter')
+metrics.gauge('docubridge_response_cache_hit_ratio', 'Share of response cache lookups that were hits (all workers)',
+              lambda: response_cache.stats()['hit_ratio'])
+metrics.gauge('docubridge_response_cache_entries', 'Answers in the response cache', lambda: response_cache.stats()['entries'])
+metrics.gauge('docubridge_llm_jobs', 'LLM jobs in this worker by state',
+              lambda: {key: value for key, value in jobs.stats().items() if key not in ('max_concurrency', 'max_queued')},
+              label_name='state')
+metrics.gauge('docubridge_batch_pending_questions', 'Batch questions in this worker not answered yet',
+              lambda: batches.stats()['pending_questions'])
+metrics.gauge('docubridge_upload_bytes', 'Disk used by stored uploads', lambda: upload_store.stats()['upload_bytes'])
 
-# Get a Gemini (Google AI) client using the API key from environment
+# Read a sheet through the process-wide cache; on a miss it is memory-mapped from
+# the columnar store (the workbook itself is only re-parsed if that copy is missing)
+# and compacted before it is cached
+def load_sheet(file_path, sheet_name, file_hash=None):
+    if file_hash is None:
+        file_hash = sheet_cache.file_hash(file_path)
+
+    def load():
+        with metrics.span('sheet_load'):
+            df = columnar_store.load_sheet(file_path, file_hash, sheet_name)
+        with metrics.span('sheet_compact'):
+            return frame_compact.compact_frame(df)
+    return sheet_cache.get_sheet(file_hash, sheet_name, load)
+
+# Get the shared Gemini client (None when no API key is configured)
 def get_gemini_client():
-    api_key = os.getenv('GEMINI_API_KEY')
-    if not api_key:
-        return None
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel('gemini-2.0-flash')
-
-# Generate a response from Gemini based on file data, user question, and chat history
-def get_gemini_response(file_data, user_question="", chat_history=None):
-    model = get_gemini_client()
-    if not model:
-        return "Please use a Gemini API key to access this feature."
-    # Build prompt with context and instructions
-    if chat_history:
-        history_str = "\n".join([
-            f"User: {q['question']}\nAssistant: {q['answer']}"
-            for q in chat_history
-        ])
-        prompt = f"""
-You are an expert, friendly, and proactive Excel assistant. Your job is to help the user interpret, analyze, and get the most out of their uploaded Excel file. Use your knowledge of spreadsheets, formulas, and data analysis to provide clear, CONCISE, actionable, and conversational answers.
-
-Below is the Excel Data Preview (this can be the full file content for smaller files, or a summary for larger files), followed by the chat history and the user's latest question.
-
-Excel Data Preview:
-{file_data}
-
-Chat History:
-{history_str}
-
-User's New Question:
-{user_question}
-
-Instructions:
-- Occasionally (especially early in the conversation or when relevant), offer proactive insights, trends, or suggestions based on the data. Do not repeat the same types of insights in every response. If the user's question is specific, focus on answering it directly.
-- If the data contains dates or time periods, you may perform trend analysis (e.g., month-over-month, year-over-year changes) and summarize the results, but only if it hasn't already been done recently.
-- When applicable, automatically calculate and present key business metrics or financial ratios.
-- When asked a question, also provide the Excel formulas or step-by-step instructions for the user to perform the task themselves.
-- For step-by-step instructions, always use Markdown bullet points (e.g., * Item 1\n* Item 2).
-- Reference specific columns, rows, or values when helpful.
-- If the user's request is unclear, ask a clarifying question.
-- Be as concise and brief as possible while remaining helpful and thorough. Aim for direct answers.
-- Avoid unnecessary disclaimers.
-- Do not generate tables in your response. If you need to summarize differences or comparisons, use bullet points or plain text instead of tables.
-
-Respond as a helpful, proactive Excel assistant.
-"""
-    else:
-        prompt = f"""
-You are an expert, friendly, and proactive Excel assistant. Your job is to help the user interpret, analyze, and get the most out of their uploaded Excel file. Use your knowledge of spreadsheets, formulas, and data analysis to provide clear, CONCISE, actionable, and conversational answers.
-
-Below is the Excel Data Preview (this can be the full file content for smaller files, or a summary for larger files), followed by the user's question.
-
-Excel Data Preview:
-    {file_data}
-
-User's Question:
-{user_question}
-
-Instructions:
-- Occasionally (especially early in the conversation or when relevant), offer proactive insights, trends, or suggestions based on the data. Do not repeat the same types of insights in every response. If the user's question is specific, focus on answering it directly.
-- If the data contains dates or time periods, you may perform trend analysis (e.g., month-over-month, year-over-year changes) and summarize the results, but only if it hasn't already been done recently.
-- When applicable, automatically calculate and present key business metrics or financial ratios.
-- When asked a question, also provide the Excel formulas or step-by-step instructions for the user to perform the task themselves.
-- For step-by-step instructions, always use Markdown bullet points (e.g., * Item 1\n* Item 2).
-- Reference specific columns, rows, or values when helpful.
-- If the user's request is unclear, ask a clarifying question.
-- Be as concise and brief as possible while remaining helpful and thorough. Aim for direct answers.
-- Avoid unnecessary disclaimers.
-- Do not generate tables in your response. If you need to summarize differences or comparisons, use bullet points or plain text instead of tables.
-
-Respond as a helpful, proactive Excel assistant.
-"""
+    return llm_client.get_client()
+
+# Build the token-budgeted Gemini prompt as (cacheable prefix, per-turn suffix) and log its estimated size
+def build_prompt(file_data, user_question="", chat_history=None, computed=None):
+    with metrics.span('prompt_build'):
+        prefix, suffix, stats = prompt_builder.build_prompt_parts(file_data, user_question, chat_history, computed)
+    metrics.prompt_tokens(stats['prompt_tokens'], 'estimated')
+    print(f"Prompt tokens (estimated): {stats['prompt_tokens']} "
+          f"(prefix {stats['prefix_tokens']} with file {stats['file_tokens']}, computed {stats['computed_tokens']}, "
+          f"history {stats['history_tokens']}, "
+          f"{stats['verbatim_turns']} verbatim / {stats['summarized_turns']} summarized turns)")
+    return prefix, suffix
+
+# Generate a response from Gemini based on file data, user question, chat history and
+# an optional result computed from the sheet
+def get_gemini_response(file_data, user_question="", chat_history=None, computed=None):
+    client = get_gemini_client()
+    if not client:
+        return NO_API_KEY_MESSAGE
+    prefix, suffix = build_prompt(file_data, user_question, chat_history, computed)
     try:
-        response = model.generate_content(prompt)
+        with metrics.span('llm_call'):
+            response = context_cache.generate(client, prefix, suffix)
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+            print(f"Prompt tokens (reported): {usage.prompt_token_count} ({cached_tokens} from cached context)")
+            metrics.prompt_tokens(usage.prompt_token_count, 'reported')
+            if cached_tokens:
+                metrics.prompt_tokens(cached_tokens, 'cached')
         return response.text
     except Exception as e:
         print(f"AI API Error: {e}")
-        return "The AI service is currently unavailable, please try again later."
-
-# Summarize a DataFrame for the AI prompt (columns, types, stats, sample rows)
-def summarize_dataframe(df, max_rows=100):
-    summary = []
-    summary.append(f"Columns: {', '.join(df.columns.astype(str))}")
-    summary.append(
-        "Column types: " +
-        ', '.join([f"{col}: {dtype}" for col, dtype in df.dtypes.items()]))
+        return AI_UNAVAILABLE_MESSAGE
+
+# Stream a Gemini response chunk by chunk (same prompt as get_gemini_response)
+# API errors are raised to the caller, which may already have sent part of the answer
+def stream_gemini_response(file_data, user_question="", chat_history=None, computed=None):
+    client = get_gemini_client()
+    if not client:
+        yield NO_API_KEY_MESSAGE
+        return
+    prefix, suffix = build_prompt(file_data, user_question, chat_history, computed)
+    started = time.perf_counter()
+    for i, chunk in enumerate(context_cache.stream(client, prefix, suffix)):
+        if i == 0:
+            metrics.observe_phase('llm_first_chunk', time.perf_counter() - started)
+        yield chunk
+    metrics.observe_phase('llm_stream', time.perf_counter() - started)
+
+# Convert an answer's Markdown to HTML (done once, when the answer is stored)
+def render_answer(answer):
+    with metrics.span('markdown'):
+        return md.markdown(answer)
+
+# Conversation turns for the chat page, rendering any answer stored without its HTML once
+def chat_messages(conversation_id):
+    history = conversation_store.get_history(conversation_id)
+    for entry in history:
+        if entry['answer_html'] is None:
+            entry['answer_html'] = render_answer(entry['answer'])
+            conversation_store.set_answer_html(entry['id'], entry['answer_html'])
+    return history
+
+# Remove a leading "DocuBridge Assistant:" the model sometimes echoes back
+def clean_answer(answer):
+    return re.sub(r'^\s*DocuBridge Assistant:\s*', '', answer, flags=re.IGNORECASE)
+
+# Summary of a sheet for the AI prompt, computed once per (file hash, sheet) and stored
+# next to the converted sheet; the sheet is only loaded when no summary exists yet
+def get_sheet_summary(file_path, sheet_name, file_hash=None, df=None):
+    if file_hash is None:
+        file_hash = sheet_cache.file_hash(file_path)
+    summary = columnar_store.read_sheet_text(file_hash, sheet_name, summaries.SUMMARY_SUFFIX)
+    metrics.cache_lookup('summary', summary is not None)
+    if summary is None:
+        if df is None:
+            df = load_sheet(file_path, sheet_name, file_hash)
+        with metrics.span('summarize'):
+            summary = summarize_dataframe(df)
+        columnar_store.write_sheet_text(file_hash, sheet_name, summaries.SUMMARY_SUFFIX, summary)
+    return summary
+
+# Response cache key for a question about a sheet at this point of the conversation
+# (model and summary format are part of the key so changing either starts afresh); kind
+# keeps the planner's query plans apart from the answers
+def response_cache_key(file_hash, sheet_name, user_question, chat_history, kind='answer'):
+    namespace = f'{llm_client.GEMINI_BACKEND}:{llm_client.GEMINI_MODEL}{summaries.SUMMARY_SUFFIX}'
+    if kind != 'answer':
+        namespace = f'{kind}:{namespace}'
+    return response_cache.make_key(file_hash, sheet_name, user_question, chat_history, namespace=namespace)
+
+# Remember an answer unless it is one of the fallback messages
+def _cache_answer(cache_key, answer):
+    if cache_key and answer not in FALLBACK_MESSAGES:
+        response_cache.put(cache_key, answer)
+
+# Result computed locally from the sheet when the question is a query over its rows, or None.
+# It goes next to the question while the sheet summary stays in the cached prompt prefix.
+# sheet_ref is (file_path, sheet_name, file_hash).
+def computed_result(user_question, chat_history, sheet_ref=None):
+    client = get_gemini_client()
+    if sheet_ref is None or client is None or not analytics.ANALYTICS_ENABLED:
+        return None
+    file_path, sheet_name, file_hash = sheet_ref
     try:
-        summary.append("Summary statistics:\n" +
-                       df.describe(include='all').to_string())
-    except Exception:
-        pass
-    if len(df) <= max_rows:
-        summary.append("Full data:\n" + df.to_string())
+        # Column names come from the memory-mapped Arrow schema; the sheet is only loaded
+        # for questions the planner will actually be asked about
+        column_names = columnar_store.sheet_table(file_path, file_hash, sheet_name).schema.names
+        if not analytics.needs_computation(column_names, user_question):
+            return None
+        df = load_sheet(*sheet_ref)
+    except Exception as e:
+        print(f"Analytics: could not load sheet ({e}), using sheet summary.")
+        return None
+    plan_key = response_cache_key(file_hash, sheet_name, user_question, chat_history, kind='plan')
+
+    # Planner reply from the response cache, asking the model on a miss
+    def plan(prompt):
+        reply = response_cache.get(plan_key)
+        metrics.cache_lookup('plan', reply is not None)
+        if reply is None:
+            reply = client.generate(prompt).text
+            response_cache.put(plan_key, reply)
+        return reply
+
+    with metrics.span('analytics'):
+        return analytics.computed_context(df, user_question, chat_history, plan)
+
+# Answer a question in a job thread (get_gemini_response with the name prefix stripped)
+def _answer_question(file_summary, user_question, chat_history, cache_key=None, sheet_ref=None):
+    computed = computed_result(user_question, chat_history, sheet_ref)
+    answer = clean_answer(get_gemini_response(file_summary, user_question, chat_history, computed))
+    _cache_answer(cache_key, answer)
+    return answer
+
+# Id of this session's conversation in the conversation store. Sessions from before
+# the store existed kept their history in the session itself; it is moved over once.
+def current_conversation():
+    conversation_id = session.get('conversation_id')
+    if conversation_id is None:
+        conversation_id = conversation_store.create_conversation(session.get('excel_file_hash'),
+                                                                 session.get('current_sheet'))
+        for turn in session.pop('chat_history', []):
+            conversation_store.append_turn(conversation_id, turn['question'], turn['answer'],
+                                           render_answer(turn['answer']))
+        pending = session.pop('pending_job', None)
+        if pending:
+            conversation_store.set_pending(conversation_id, pending['id'], pending['question'])
+        session['conversation_id'] = conversation_id
+    return conversation_id
+
+# Id under which this session holds on to its upload (keeps it from being swept)
+def upload_ref():
+    ref_id = session.get('upload_ref')
+    if ref_id is None:
+        ref_id = session['upload_ref'] = uuid.uuid4().hex
+    return ref_id
+
+# Start an empty conversation (new upload or sheet change)
+def start_conversation(file_hash, sheet_name):
+    session['conversation_id'] = conversation_store.create_conversation(file_hash, sheet_name)
+
+# Queue a Gemini call on the bounded job executor; the answer is collected by the
+# next chat page load. Cached answers are used right away, and when the queue is
+# full the user gets a "busy" answer instead.
+def queue_answer(file_summary, user_question, chat_history, cache_key=None, sheet_ref=None):
+    conversation_id = current_conversation()
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cache_key:
+        metrics.cache_lookup('response', cached is not None)
+    if cached is not None:
+        conversation_store.append_turn(conversation_id, user_question, cached, render_answer(cached))
+        return
+    try:
+        job_id = jobs.submit(_answer_question, file_summary, user_question, list(chat_history),
+                             cache_key, sheet_ref)
+    except jobs.JobQueueFull:
+        print("Backend Check Failed: LLM job queue is full. Question answered with busy message.")
+        conversation_store.append_turn(conversation_id, user_question, AI_BUSY_MESSAGE,
+                                       render_answer(AI_BUSY_MESSAGE))
+        return
+    conversation_store.set_pending(conversation_id, job_id, user_question)
+
+# Move a finished queued answer into the chat history; returns the job still pending, if any
+def collect_pending_answer():
+    conversation_id = current_conversation()
+    pending = conversation_store.get_pending(conversation_id)
+    if not pending:
+        return None
+    job = jobs.get(pending['id'])
+    if job is None or job['status'] in ('queued', 'running'):
+        # Unknown jobs may still be running in another worker process
+        if job is not None or time.time() - pending['submitted'] < PENDING_JOB_TIMEOUT:
+            return pending
+        answer = AI_UNAVAILABLE_MESSAGE
+    elif job['status'] == 'done':
+        answer = job['result']
     else:
-        summary.append("Sample rows (first 10):\n" + df.head(10).to_string())
-        summary.append("Sample rows (last 10):\n" + df.tail(10).to_string())
-    return '\n\n'.join(summary)
+        answer = AI_UNAVAILABLE_MESSAGE
+    conversation_store.finish_pending(conversation_id, pending['id'], answer, render_answer(answer))
+    jobs.discard(pending['id'])
+    return None
+
+# Report a queued job's status (and result once finished) as JSON
+def handle_job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'id': job_id, 'status': 'unknown'}), 404
+    return jsonify({key: job[key] for key in ('id', 'status', 'result', 'error')})
+
+# Read a non-negative integer query argument, clamped to maximum
+def _int_arg(args, name, default, maximum):
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    return max(0, min(value, maximum))
+
+# One window of a sheet for the preview table: rows [offset, offset + limit) of the
+# given column positions (the first PREVIEW_MAX_COLUMNS columns by default). row_ids
+# restricts and orders the rows (a filter/sort/search result); row numbers refer to the sheet.
+# The rows are sliced straight from the sheet's memory-mapped Arrow table, so only the
+# window is ever converted to pandas.
+def preview_window(table, offset=0, limit=100, columns=None, row_ids=None):
+    if columns is None:
+        columns = list(range(min(table.num_columns, PREVIEW_MAX_COLUMNS)))
+    columns = columns[:PREVIEW_MAX_COLUMNS]
+    selected = table.select(columns)
+    if row_ids is None:
+        positions = np.arange(offset, min(offset + limit, table.num_rows))
+        window = selected.slice(offset, len(positions))
+    else:
+        positions = np.asarray(row_ids[offset:offset + limit])
+        window = selected.take(positions)
+    window = window.to_pandas()
+    return {
+        'total_rows': table.num_rows if row_ids is None else len(row_ids),
+        'sheet_rows': table.num_rows,
+        'total_columns': table.num_columns,
+        'offset': offset,
+        'column_indexes': columns,
+        'columns': [str(col) for col in window.columns],
+        'row_numbers': (positions + 1).tolist(),
+        # to_json turns NaN into null and dates into ISO strings
+        'rows': json.loads(window.to_json(orient='values', date_format='iso', default_handler=str)),
+    }
+
+# Parse "position:op:value" filter arguments of the preview endpoint
+def _preview_filters(args, column_count):
+    filters = []
+    for text in args.getlist('filter'):
+        position, _, rest = text.partition(':')
+        op, _, value = rest.partition(':')
+        if not position.isdigit() or int(position) >= column_count:
+            raise sheet_index.IndexQueryError(f'bad filter column in {text!r}')
+        if op not in sheet_index.FILTER_OPS:
+            raise sheet_index.IndexQueryError(f'unsupported filter op {op!r}')
+        filters.append((int(position), op, value))
+    return filters
+
+# Preview endpoint: a JSON window of the current sheet, sliced from its Arrow file (the
+# sheet itself is only loaded to build the column indexes of a filter/sort/search)
+# Query arguments: offset, limit (at most PREVIEW_MAX_ROWS), columns (comma-separated
+# positions), filter (repeatable, "position:op:value" with op one of sheet_index.FILTER_OPS),
+# q (search text), sort (column position) and order ("asc" or "desc")
+def handle_preview(request):
+    file_path = session.get('excel_file_path')
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'No file uploaded.'}), 404
+    file_hash = session.get('excel_file_hash') or sheet_cache.file_hash(file_path)
+    upload_store.touch(upload_ref(), file_hash)
+    current_sheet = session.get('current_sheet')
+    try:
+        table = columnar_store.sheet_table(file_path, file_hash, current_sheet)
+    except Exception as e:
+        print(f"Backend Check Failed in /preview: Could not read Excel file. Error: {e}.")
+        return jsonify({'error': 'Could not read the sheet.'}), 500
+
+    columns = None
+    if request.args.get('columns'):
+        try:
+            columns = [int(col) for col in request.args['columns'].split(',')]
+        except ValueError:
+            return jsonify({'error': 'columns must be comma-separated column positions.'}), 400
+        if any(col < 0 or col >= table.num_columns for col in columns):
+            return jsonify({'error': 'Column position out of range.'}), 400
+
+    # Filtering, sorting and searching use the sheet's persisted column indexes
+    row_ids = None
+    query_ms = None
+    sort = request.args.get('sort', '')
+    search = request.args.get('q', '')
+    if request.args.getlist('filter') or search.strip() or sort:
+        started = time.perf_counter()
+        try:
+            df = load_sheet(file_path, current_sheet, file_hash)
+        except Exception as e:
+            print(f"Backend Check Failed in /preview: Could not read Excel file. Error: {e}.")
+            return jsonify({'error': 'Could not read the sheet.'}), 500
+        try:
+            if sort and (not sort.isdigit() or int(sort) >= table.num_columns):
+                raise sheet_index.IndexQueryError('sort must be a column position')
+            filters = _preview_filters(request.args, table.num_columns)
+            row_ids = sheet_index.query(df, file_hash, current_sheet, filters=filters,
+                                        search=search, sort=int(sort) if sort else None,
+                                        descending=request.args.get('order') == 'desc')
+        except sheet_index.IndexQueryError as e:
+            return jsonify({'error': str(e)}), 400
+        query_seconds = time.perf_counter() - started
+        metrics.observe_phase('preview_query', query_seconds)
+        query_ms = round(query_seconds * 1000, 1)
+
+    total = table.num_rows if row_ids is None else len(row_ids)
+    offset = _int_arg(request.args, 'offset', 0, total)
+    limit = _int_arg(request.args, 'limit', 100, PREVIEW_MAX_ROWS)
+    window = preview_window(table, offset, limit, columns, row_ids)
+    window['query_ms'] = query_ms
+    return jsonify(window)
 
 # Handle file upload, validation, and initial question
 def handle_upload(request):
     excel_file = request.files.get('excel_file')
     user_question = request.form.get('user_question')
 
-    # Backend file size check (10MB limit)
+    # Backend file size check (large .xlsx files are ingested in streaming mode)
     excel_file.seek(0, os.SEEK_END)
     file_size = excel_file.tell()
     excel_file.seek(0) # Reset file pointer
-    if file_size > 10 * 1024 * 1024:
-        print(f"Backend Check Failed: File size ({file_size / (1024*1024):.2f}MB) exceeds 10MB limit. User redirected.")
+    if file_size > MAX_UPLOAD_MB * 1024 * 1024:
+        print(f"Backend Check Failed: File size ({file_size / (1024*1024):.2f}MB) exceeds {MAX_UPLOAD_MB}MB limit. User redirected.")
         return redirect(url_for('index'))
 
     # Backend file type check
@@ -144,42 +422,199 @@ def handle_upload(request):
         print(f"Backend Check Failed: Invalid file type uploaded ('{file_extension}'). User redirected.")
         return redirect(url_for('index'))
 
-    # Save file to disk
-    unique_id = str(uuid.uuid4())
-    save_path = os.path.join(UPLOAD_FOLDER, unique_id + file_extension)
-    excel_file.save(save_path)
+    # Save file to disk, once per distinct content: a re-upload reuses the stored file
+    # and everything already derived from it (converted sheets, summaries, indexes)
+    with metrics.span('upload_save'):
+        save_path, file_hash, reused = upload_store.save_upload(excel_file, file_extension, upload_ref())
+    if reused:
+        print(f"Upload matches a stored file ({file_hash[:12]}), reusing its converted sheets.")
     session['excel_file_path'] = save_path
+    session['excel_file_hash'] = file_hash
     session['excel_file_name'] = excel_file.filename
     session['excel_file_ext'] = file_extension
     
     try:
-        # Get sheet names and set the first as default
-        xls = pd.ExcelFile(save_path)
-        sheet_names = xls.sheet_names
+        # Convert the first sheet now (the rest in the background) and set it as default
+        with metrics.span('workbook_convert'):
+            sheet_names = columnar_store.convert_workbook(save_path, file_hash)
         current_sheet = sheet_names[0]
         session['sheet_names'] = sheet_names
         session['current_sheet'] = current_sheet
-        # Read the first sheet
-        df = pd.read_excel(save_path, sheet_name=current_sheet)
+        # Summarize the first sheet (large sheets got their summary while being ingested,
+        # so the sheet itself is only loaded when a question needs its rows)
+        with metrics.span('sheet_summary'):
+            file_summary = get_sheet_summary(save_path, current_sheet, file_hash)
     except Exception as e:
         print(f"Backend Check Failed: Could not read Excel file. Error: {e}. User redirected.")
         return redirect(url_for('index'))
-    
-    # Start new chat history
-    session['chat_history'] = []
-    
-    # Summarize file and get initial AI response
-    file_summary = summarize_dataframe(df)
-    gemini_response = get_gemini_response(file_summary, user_question)
-    session['chat_history'].append({'question': user_question, 'answer': gemini_response})
-    session['file_preview_html'] = format_dataframe_for_display(df)
+
+    # Start a new conversation and queue the initial AI response
+    start_conversation(file_hash, current_sheet)
+    with metrics.span('queue_answer'):
+        queue_answer(file_summary, user_question, [],
+                     response_cache_key(file_hash, current_sheet, user_question, []),
+                     (save_path, current_sheet, file_hash))
     return redirect(url_for('chat'))
 
+# Format one Server-Sent Events message with a JSON payload
+def _sse_event(payload, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(payload)}\n\n"
+
+# Stream the answer to a chat question as Server-Sent Events and store the
+# finished answer in the chat history once the stream completes
+def handle_chat_stream(request):
+    file_path = session.get('excel_file_path')
+    user_question = request.args.get('user_question', '').strip()
+    if not file_path or not os.path.exists(file_path) or not user_question:
+        abort(400)
+    current_sheet = session.get('current_sheet')
+    file_hash = session.get('excel_file_hash') or sheet_cache.file_hash(file_path)
+    upload_store.touch(upload_ref(), file_hash)
+    try:
+        with metrics.span('sheet_summary'):
+            file_summary = get_sheet_summary(file_path, current_sheet, file_hash)
+    except Exception as e:
+        print(f"Backend Check Failed in /chat/stream: Could not read Excel file. Error: {e}.")
+        abort(400)
+    conversation_id = current_conversation()
+    with metrics.span('history_load'):
+        chat_history = conversation_store.get_history(conversation_id)
+    cache_key = response_cache_key(file_hash, current_sheet, user_question, chat_history)
+    cached = response_cache.get(cache_key)
+    metrics.cache_lookup('response', cached is not None)
+
+    # If the client disconnects, the generator is closed at a yield and nothing after it runs,
+    # so an interrupted answer is neither cached nor stored
+    def generate():
+        answer = ''
+        sent = 0
+        failed = False
+        if cached is not None:
+            chunks = [cached]
+        else:
+            computed = computed_result(user_question, chat_history, (file_path, current_sheet, file_hash))
+            chunks = stream_gemini_response(file_summary, user_question, chat_history, computed)
+        try:
+            for text in chunks:
+                answer += text
+                # Hold back the first few characters until an echoed name prefix can be stripped
+                if sent == 0:
+                    if len(answer) < 32:
+                        continue
+                    answer = clean_answer(answer)
+                yield _sse_event({'text': answer[sent:]})
+                sent = len(answer)
+        except Exception as e:
+            print(f"AI API Error (stream): {e}")
+            failed = True
+            answer += f"\n\n{AI_UNAVAILABLE_MESSAGE}" if answer else AI_UNAVAILABLE_MESSAGE
+        if sent == 0:
+            answer = clean_answer(answer)
+        if len(answer) > sent:
+            yield _sse_event({'text': answer[sent:]})
+        # A partial answer followed by the error message must not be served to other sessions
+        if cached is None and not failed:
+            _cache_answer(cache_key, answer)
+        answer_html = render_answer(answer)
+        conversation_store.append_turn(conversation_id, user_question, answer, answer_html)
+        yield _sse_event({'html': answer_html}, event='done')
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Status, progress and results (in question order) of a batch
+def _batch_payload(batch):
+    finished = batch['finished'] or time.time()
+    return {'id': batch['id'], 'status': batch['status'], 'total': len(batch['results']),
+            'answered': len(batch['completed']), 'seconds': round(finished - batch['created'], 3),
+            'results': batch['results']}
+
+# Answer a checklist of questions about the uploaded file at once. JSON body: "questions"
+# (list of strings), optional "sheet" (defaults to the current sheet) and "stream".
+# The sheet is loaded and summarized once, then the questions are answered concurrently
+# (BATCH_MAX_CONCURRENCY at a time per worker), each on its own without the chat history.
+# When streaming (or asked for text/event-stream) each result is sent as a Server-Sent Event
+# as soon as it is ready; otherwise the batch ID is returned for polling /batch/<id>.
+def handle_batch(request):
+    file_path = session.get('excel_file_path')
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'upload a file first'}), 400
+    payload = request.get_json(silent=True) or {}
+    questions = payload.get('questions')
+    if not isinstance(questions, list) or not questions or \
+            not all(isinstance(question, str) and question.strip() for question in questions):
+        return jsonify({'error': 'questions must be a non-empty list of questions'}), 400
+    if len(questions) > batches.BATCH_MAX_QUESTIONS:
+        return jsonify({'error': f'at most {batches.BATCH_MAX_QUESTIONS} questions per batch'}), 400
+    questions = [question.strip() for question in questions]
+    sheet_name = payload.get('sheet') or session.get('current_sheet')
+    if sheet_name not in session.get('sheet_names', []):
+        return jsonify({'error': f'unknown sheet {sheet_name!r}'}), 400
+    file_hash = session.get('excel_file_hash') or sheet_cache.file_hash(file_path)
+    upload_store.touch(upload_ref(), file_hash)
+    sheet_ref = (file_path, sheet_name, file_hash)
+    try:
+        with metrics.span('sheet_summary'):
+            # Loaded up front so every question's analytics step finds it in the sheet cache
+            df = load_sheet(*sheet_ref)
+            file_summary = get_sheet_summary(file_path, sheet_name, file_hash, df)
+    except Exception as e:
+        print(f"Backend Check Failed in /batch: Could not read Excel file. Error: {e}.")
+        return jsonify({'error': 'could not read the sheet'}), 400
+
+    cache_keys = {question: response_cache_key(file_hash, sheet_name, question, []) for question in questions}
+    known = {}
+    for i, question in enumerate(questions):
+        cached = response_cache.get(cache_keys[question])
+        metrics.cache_lookup('response', cached is not None)
+        if cached is not None:
+            known[i] = cached
+    try:
+        batch_id = batches.submit(
+            questions, lambda question: _answer_question(file_summary, question, [], cache_keys[question], sheet_ref),
+            known)
+    except jobs.JobQueueFull:
+        print("Backend Check Failed: batch queue is full.")
+        return jsonify({'error': AI_BUSY_MESSAGE}), 503
+    print(f"Batch {batch_id}: {len(questions)} questions about sheet '{sheet_name}' ({len(known)} cached)")
+
+    if not payload.get('stream') and 'text/event-stream' not in request.headers.get('Accept', ''):
+        return jsonify({'id': batch_id, 'status': 'running', 'total': len(questions),
+                        'status_url': url_for('batch_status', batch_id=batch_id)}), 202
+
+    def generate():
+        yield _sse_event({'id': batch_id, 'total': len(questions)}, event='batch')
+        for result in batches.iter_results(batch_id):
+            yield _sse_event(result, event='result')
+        batch = _batch_payload(batches.get(batch_id))
+        yield _sse_event({key: batch[key] for key in ('id', 'status', 'total', 'answered', 'seconds')}, event='done')
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Report a batch's progress and the answers so far as JSON
+def handle_batch_status(batch_id):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return jsonify({'id': batch_id, 'status': 'unknown'}), 404
+    return jsonify(_batch_payload(batch))
+
 # Handle chat UI, follow-up questions, and sheet switching
 def handle_chat(request):
     file_path = session.get('excel_file_path')
     if not file_path or not os.path.exists(file_path):
         return redirect(url_for('index'))
+    # Sessions created before the sheet cache existed have no hash yet
+    file_hash = session.get('excel_file_hash')
+    if not file_hash:
+        file_hash = sheet_cache.file_hash(file_path)
+        session['excel_file_hash'] = file_hash
+    upload_store.touch(upload_ref(), file_hash)
 
     # Handle POST: sheet change or new question
     if request.method == 'POST':
@@ -188,360 +623,42 @@ def handle_chat(request):
             new_sheet = request.form.get('sheet_selection')
             if new_sheet in session.get('sheet_names', []):
                 session['current_sheet'] = new_sheet
-                session['chat_history'] = []
-        # New question: process and get AI response
-        elif user_question := request.form.get('user_question'):
+                start_conversation(file_hash, new_sheet)
+        # New question: queue the AI response (one question at a time per conversation)
+        elif (user_question := request.form.get('user_question')) and collect_pending_answer() is None:
             current_sheet = session.get('current_sheet')
             try:
-                df = pd.read_excel(file_path, sheet_name=current_sheet)
+                with metrics.span('sheet_summary'):
+                    file_summary = get_sheet_summary(file_path, current_sheet, file_hash)
             except Exception as e:
                 print(f"Backend Check Failed in /chat: Could not read Excel file. Error: {e}. User redirected.")
                 return redirect(url_for('index'))
-            file_summary = summarize_dataframe(df)
-            chat_history = session.get('chat_history', [])
-            gemini_response = get_gemini_response(file_summary, user_question, chat_history)
-            gemini_response = re.sub(r'^\s*DocuBridge Assistant:\s*', '', gemini_response, flags=re.IGNORECASE)
-            chat_history.append({'question': user_question, 'answer': gemini_response})
-            session['chat_history'] = chat_history
+            with metrics.span('history_load'):
+                chat_history = conversation_store.get_history(current_conversation())
+            with metrics.span('queue_answer'):
+                queue_answer(file_summary, user_question, chat_history,
+                             response_cache_key(file_hash, current_sheet, user_question, chat_history),
+                             (file_path, current_sheet, file_hash))
         # After POST, redirect to GET to render page
         return redirect(url_for('chat'))
 
     # GET: render chat page with current sheet and chat history
+    # (the data preview is fetched window by window from /preview by the page script)
     current_sheet = session.get('current_sheet')
-    try:
-        df = pd.read_excel(file_path, sheet_name=current_sheet)
-    except Exception as e:
-        print(f"Backend Check Failed in /chat: Could not read Excel file. Error: {e}. User redirected.")
-        return redirect(url_for('index'))
-    file_preview_html = format_dataframe_for_display(df)
     sheet_names = session.get('sheet_names', [])
-    chat_history = session.get('chat_history', [])
-    
+    with metrics.span('collect_pending'):
+        pending_job = collect_pending_answer()
+    with metrics.span('history_load'):
+        chat_history = chat_messages(current_conversation())
+
     # Set input placeholder based on chat history
-    if len(chat_history) == 0:
+    if len(chat_history) == 0 and not pending_job:
         input_placeholder = "Ask a question..."
     else:
         input_placeholder = "Ask a follow up question..."
-    
-    # Build chat history HTML
-    chat_html = ''
-    for entry in chat_history:
-        html_answer = md.markdown(entry['answer'])
-        chat_html += f'''
-        <div class="chat-bubble user"><strong>You:</strong> {Markup.escape(entry['question'])}</div>
-        <div class="chat-bubble bot"><strong>DocuBridge Assistant:</strong> {html_answer}</div>
-        '''
-    
-    # Build sheet selector HTML if multiple sheets exist
-    sheet_selector_html = ''
-    if len(sheet_names) > 1:
-        options = ''
-        for name in sheet_names:
-            selected = 'selected' if name == current_sheet else ''
-            options += f'<option value="{name}" {selected}>{name}</option>'
-        sheet_selector_html = f'''
-        <div class="sheet-selector">
-            <form method="POST" action="/chat" id="sheetForm">
-                <input type="hidden" name="action" value="change_sheet">
-                <label for="sheet_selection">Select Sheet:</label>
-                <select name="sheet_selection" id="sheet_selection" onchange="this.form.submit()">
-                    {options}
-                </select>
-                <small>Changing sheets will clear the chat history.</small>
-            </form>
-        </div>
-        '''
-
-    # Render the chat UI page
-    return f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>DocuBridge - Chat</title>
-        <link href='https://fonts.googleapis.com/css2?family=Inter:wght@400;700&display=swap' rel='stylesheet'>
-        <style>
-            html, body {{
-                height: 100%;
-                margin: 0;
-                padding: 0;
-                font-size: 16px;
-            }}
-            body {{
-                background-color: #f5f7fa;
-                color: #2c3e50;
-                font-family: 'Inter', 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                margin: 0;
-                padding: 2vw 2vw 3vw 2vw;
-                min-height: 100vh;
-                display: flex;
-                flex-direction: column;
-            }}
-            .container {{
-                max-width: 50rem;
-                margin: 2vw auto 2vw auto;
-                background: #fff;
-                border-radius: 0.75rem;
-                box-shadow: 0 0.25rem 0.75rem rgba(44, 62, 80, 0.08);
-                padding: 2vw 3vw 3vw 3vw;
-                display: flex;
-                flex-direction: column;
-                min-height: 80vh;
-                flex: 1 1 auto;
-            }}
-            h2 {{
-                text-align: center;
-                color: #2c3e50;
-                font-size: 2.2rem;
-                margin-bottom: 1.2rem;
-            }}
-            h3 {{
-                color: #3498db;
-                margin-top: 2rem;
-                margin-bottom: 0.5rem;
-                font-size: 1.2rem;
-            }}
-            h4 {{
-                color: #2c3e50;
-                margin-top: 1rem;
-                margin-bottom: 0.3rem;
-                font-size: 1.1rem;
-            }}
-            .sheet-selector {{
-                margin-bottom: 1.5rem;
-                background: #f8fafc;
-                border-radius: 0.5rem;
-                padding: 1rem 1.2rem;
-                border: 1px solid #e0e6ed;
-            }}
-            .sheet-selector form {{
-                display: flex;
-                align-items: center;
-                gap: 1rem;
-                margin: 0;
-            }}
-            .sheet-selector label {{
-                font-weight: 600;
-            }}
-            .sheet-selector select {{
-                padding: 0.5rem;
-                border-radius: 0.3rem;
-                border: 1px solid #e0e6ed;
-            }}
-            .sheet-selector small {{
-                color: #7f8c8d;
-            }}
-            .file-info {{
-                margin-bottom: 1.1rem;
-                background: #f8fafc;
-                border-radius: 0.5rem;
-                padding: 1rem 1.2rem;
-                border: 1px solid #e0e6ed;
-                max-width: 100%;
-                overflow-x: auto;
-                max-height: 22vh;
-                min-height: 12vh;
-                box-sizing: border-box;
-            }}
-            .file-info ul {{
-                list-style: none;
-                padding-left: 0;
-            }}
-            .file-info ul li {{
-                margin-bottom: 0.2rem;
-            }}
-            .file-info table {{
-                width: 100%;
-                border-collapse: collapse;
-                margin-top: 0.5rem;
-                background: #fff;
-                border-radius: 0.4rem;
-                overflow: auto;
-                font-size: 0.95rem;
-            }}
-            .file-info th, .file-info td {{
-                border: 1px solid #e0e6ed;
-                padding: 0.5rem 0.7rem;
-                text-align: left;
-            }}
-            .file-info th {{
-                background: #eaf3fa;
-                color: #2980b9;
-                font-weight: 700;
-            }}
-            .chat-container {{
-                background: #f8fafc;
-                border-radius: 0.5rem;
-                border: 1px solid #e0e6ed;
-                padding: 1rem;
-                flex: 2 1 0%;
-                min-height: 20vh;
-                max-height: 70vh;
-                overflow-y: auto;
-                margin-bottom: 1.2rem;
-                display: flex;
-                flex-direction: column;
-                gap: 0.7rem;
-            }}
-            .chat-bubble {{
-                padding: 0.7rem 1rem;
-                border-radius: 0.5rem;
-                max-width: 90%;
-                word-break: break-word;
-                font-size: 1.05rem;
-            }}
-            .chat-bubble.user {{
-                background: #eaf3fa;
-                align-self: flex-end;
-                color: #2c3e50;
-            }}
-            .chat-bubble.bot {{
-                background: #f0e6fa;
-                align-self: flex-start;
-                color: #34495e;
-            }}
-            .chat-bubble.typing {{
-                background: #f9f9f9;
-                align-self: flex-start;
-                color: #888;
-                font-style: italic;
-                opacity: 0.8;
-            }}
-            form {{
-                display: flex;
-                gap: 0.7rem;
-                margin-top: 0.5rem;
-            }}
-            input[type="text"] {{
-                flex: 1;
-                padding: 0.8rem;
-                border: 1px solid #e0e6ed;
-                border-radius: 0.3rem;
-                font-size: 1rem;
-            }}
-            button {{
-                background-color: #3498db;
-                color: white;
-                padding: 0.8rem 1.5rem;
-                border: none;
-                border-radius: 0.3rem;
-                cursor: pointer;
-                font-size: 1rem;
-                transition: background-color 0.3s ease;
-            }}
-            button:hover {{
-                background-color: #2980b9;
-            }}
-            button:disabled {{
-                background-color: #7ba6c7;
-                cursor: not-allowed;
-                opacity: 0.7;
-            }}
-            .back-link {{
-                display: inline-block;
-                margin-top: 1.5rem;
-                color: #3498db;
-                text-decoration: none;
-                font-weight: 600;
-                transition: color 0.2s;
-            }}
-            .back-link:hover {{
-                color: #217dbb;
-                text-decoration: underline;
-            }}
-            @media (max-width: 900px) {{
-                .container {{
-                    max-width: 98vw;
-                    padding: 2vw 2vw 3vw 2vw;
-                }}
-                .file-info, .chat-container {{
-                    padding: 0.7rem 0.5rem;
-                }}
-                .file-info {{
-                    max-height: 28vh;
-                    min-height: 10vh;
-                }}
-                .chat-container {{
-                    max-height: 40vh;
-                    min-height: 10vh;
-                    flex: 1 1 0%;
-                }}
-            }}
-            @media (max-width: 600px) {{
-                html, body {{
-                    font-size: 14px;
-                }}
-                .container {{
-                    padding: 1vw 0.5vw 2vw 0.5vw;
-                }}
-                .file-info, .chat-container {{
-                    padding: 0.5rem 0.2rem;
-                }}
-                .chat-bubble {{
-                    font-size: 0.98rem;
-                    padding: 0.5rem 0.5rem;
-                }}
-                input[type="text"] {{
-                    font-size: 0.95rem;
-                }}
-                button {{
-                    font-size: 0.95rem;
-                    padding: 0.7rem 1rem;
-                }}
-                .chat-container {{
-                    max-height: 28vh;
-                    min-height: 8vh;
-                    flex: 1 1 0%;
-                }}
-                .file-info {{
-                    max-height: 18vh;
-                    min-height: 8vh;
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h2>DocuBridge Chat</h2>
-            {sheet_selector_html}
-            <h3>File Data Preview</h3>
-            <div class="file-info">
-                {file_preview_html}
-            </div>
-            <h3>Chat</h3>
-            <div class="chat-container" id="chatContainer">
-                {chat_html}
-            </div>
-            <form method="POST" action="/chat" id="chatForm">
-                <input type="text" name="user_question" placeholder="{input_placeholder}" autocomplete="off" required id="userQuestionInput" />
-                <button type="submit" id="sendBtn">Send</button>
-            </form>
-            <a href="/" class="back-link">&larr; Back to Home</a>
-        </div>
-        <script>
-            // Auto-scroll chat to bottom
-            var chatDiv = document.getElementById('chatContainer');
-            if (chatDiv) chatDiv.scrollTop = chatDiv.scrollHeight;
-
-            // Show 'DocuBridge Assistant is typing...' indicator on form submit
-            document.getElementById('chatForm').addEventListener('submit', function(e) {{
-                var chatDiv = document.getElementById('chatContainer');
-                var typingBubble = document.createElement('div');
-                typingBubble.className = 'chat-bubble bot typing';
-                typingBubble.innerHTML = '<strong>DocuBridge Assistant:</strong> <span id="typingDots">.</span>';
-                chatDiv.appendChild(typingBubble);
-                chatDiv.scrollTop = chatDiv.scrollHeight;
-                // Animate the dots
-                var dots = document.getElementById('typingDots');
-                var dotCount = 1;
-                var interval = setInterval(function() {{
-                    dotCount = (dotCount % 3) + 1;
-                    dots.textContent = '.'.repeat(dotCount);
-                }}, 500);
-                // Disable input and button while waiting for response
-                document.getElementById('userQuestionInput').readOnly = true;
-                document.getElementById('sendBtn').disabled = true;
-            }});
-        </script>
-    </body>
-    </html>
-    """
+
+    # Render the chat UI page (answers are stored with their HTML, so nothing is re-rendered here)
+    with metrics.span('template_render'):
+        return render_template('chat.html', sheet_names=sheet_names, current_sheet=current_sheet,
+                               chat_history=chat_history, pending_job=pending_job,
+                               input_placeholder=input_placeholder)
@@ -0,0 +1,158 @@
+# batches.py - Runs a list of questions concurrently under a shared cap and tracks their
+# results as one pollable batch
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from jobs import JOB_FOLDER, JOB_RESULT_TTL, JobQueueFull
+
+# Questions of all batches answered at once in each worker process
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '8'))
+# Most questions in one batch
+BATCH_MAX_QUESTIONS = int(os.getenv('BATCH_MAX_QUESTIONS', '50'))
+# Unfinished questions (across batches) allowed per worker before new batches are refused
+BATCH_MAX_PENDING = int(os.getenv('BATCH_MAX_PENDING', '200'))
+
+# Created lazily so pre-forked server workers each start their own threads
+_executor = None
+_lock = threading.Lock()
+# Notified whenever a question finishes, for callers streaming a batch's results
+_changed = threading.Condition(_lock)
+# batch_id -> {'id', 'status', 'created', 'finished', 'results', 'completed'}
+_batches = {}
+_pending = 0
+_stats = {'batches': 0, 'rejected': 0, 'answered': 0, 'failed': 0}
+
+# Shared executor answering the questions of every batch
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=BATCH_MAX_CONCURRENCY, thread_name_prefix='batch')
+        return _executor
+
+# File holding a batch's saved state (next to the saved job results)
+def _state_path(batch_id):
+    return os.path.join(JOB_FOLDER, f'batch-{batch_id}.json')
+
+# Copy of a batch that is safe to hand out while its questions are still running
+def _snapshot(batch):
+    return {**batch, 'results': [dict(result) for result in batch['results']],
+            'completed': list(batch['completed'])}
+
+# Write a batch's state to disk (atomically) so any worker process can report it
+def _persist(snapshot):
+    path = _state_path(snapshot['id'])
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError) as e:
+        print(f"Batch store: could not persist batch {snapshot['id']}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Drop finished batches older than the result TTL, in memory and on disk
+def _prune(now):
+    expired = [batch_id for batch_id, batch in _batches.items()
+               if batch['finished'] and now - batch['finished'] > JOB_RESULT_TTL]
+    for batch_id in expired:
+        del _batches[batch_id]
+        try:
+            os.remove(_state_path(batch_id))
+        except OSError:
+            pass
+
+# Answer one question in an executor thread and record the outcome
+def _run(batch, index, fn):
+    global _pending
+    result = batch['results'][index]
+    result['status'] = 'running'
+    started = time.perf_counter()
+    try:
+        answer, error, status = fn(result['question']), None, 'done'
+    except Exception as e:
+        print(f"Batch {batch['id']} question {index} failed: {e}")
+        answer, error, status = None, str(e), 'failed'
+    with _changed:
+        result.update(answer=answer, error=error, status=status,
+                      seconds=round(time.perf_counter() - started, 3))
+        batch['completed'].append(index)
+        _pending -= 1
+        _stats['answered' if status == 'done' else 'failed'] += 1
+        if len(batch['completed']) == len(batch['results']):
+            batch['status'] = 'done'
+            batch['finished'] = time.time()
+        # Saved while holding the lock so an older state never overwrites a newer one
+        _persist(_snapshot(batch))
+        _changed.notify_all()
+
+# Start answering questions with fn(question) -> answer; answers already known (a dict of
+# question index -> answer, e.g. from the response cache) are recorded as done right away.
+# Returns the batch ID; raises JobQueueFull when the worker has too many unfinished questions.
+def submit(questions, fn, known=None):
+    global _pending
+    known = known or {}
+    now = time.time()
+    results = [{'index': i, 'question': q, 'status': 'queued', 'answer': None, 'error': None, 'seconds': None}
+               for i, q in enumerate(questions)]
+    for i, answer in known.items():
+        results[i].update(status='done', answer=answer, seconds=0.0)
+    batch = {'id': uuid.uuid4().hex, 'status': 'running', 'created': now, 'finished': None,
+             'results': results, 'completed': list(known)}
+    to_run = [i for i in range(len(questions)) if i not in known]
+    with _lock:
+        if _pending + len(to_run) > BATCH_MAX_PENDING:
+            _stats['rejected'] += 1
+            raise JobQueueFull()
+        _prune(now)
+        _pending += len(to_run)
+        _stats['batches'] += 1
+        if not to_run:
+            batch['status'], batch['finished'] = 'done', now
+        _batches[batch['id']] = batch
+        _persist(_snapshot(batch))
+    executor = _get_executor()
+    for i in to_run:
+        executor.submit(_run, batch, i, fn)
+    return batch['id']
+
+# Current state of a batch, from this process or from the copy saved by another worker
+# Returns None if the batch is unknown
+def get(batch_id):
+    with _lock:
+        batch = _batches.get(batch_id)
+        if batch is not None:
+            return _snapshot(batch)
+    try:
+        with open(_state_path(batch_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Yield the results of a batch started by this process in the order they finish
+def iter_results(batch_id):
+    seen = 0
+    while True:
+        with _changed:
+            batch = _batches.get(batch_id)
+            if batch is None:
+                return
+            while len(batch['completed']) == seen:
+                _changed.wait()
+            fresh = [dict(batch['results'][i]) for i in batch['completed'][seen:]]
+            seen += len(fresh)
+            total = len(batch['results'])
+        yield from fresh
+        if seen == total:
+            return
+
+# Snapshot of batch counters
+def stats():
+    with _lock:
+        active = sum(1 for batch in _batches.values() if batch['status'] == 'running')
+        return {**_stats, 'active': active, 'pending_questions': _pending,
+                'max_concurrency': BATCH_MAX_CONCURRENCY}
@@ -0,0 +1,320 @@
+# bench_app.py - End-to-end benchmark of the app on synthetic workbooks with the stub LLM
+# Usage: python bench_app.py [--rows 1000,10000] [--cols 10,40] [--sheets 1,3] [--dtypes numeric,text,mixed]
+#                            [--repeat N] [--clients N] [--llm-latency S] [--json report.json] [--compare old.json]
+#                            [--workbooks DIR]
+# Workbooks are generated once (seeded, so every run measures the same files) into
+# <system temp dir>/docubridge-bench/ or --workbooks, never into the repository. Each workbook
+# is measured in its own process running the app in a scratch directory, so its stores,
+# caches and peak RSS start afresh.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import subprocess
+import threading
+import numpy as np
+import pandas as pd
+
+# Default folder for the generated workbooks (outside the checkout, kept between runs)
+WORKBOOK_FOLDER = os.path.join(tempfile.gettempdir(), 'docubridge-bench')
+# Seconds to wait for a queued answer before the run counts as failed
+ANSWER_TIMEOUT = 120
+DTYPES = ('numeric', 'text', 'mixed')
+PERCENTILES = (50, 90, 95, 99)
+
+# One synthetic sheet: column kinds cycle through the dtype's mix, with some missing values
+def synthetic_frame(rows, cols, dtype, seed):
+    rng = np.random.default_rng(seed)
+    kinds = {'numeric': ('float', 'int'),
+             'text': ('category', 'text'),
+             'mixed': ('float', 'int', 'category', 'date', 'text', 'bool')}[dtype]
+    regions = np.array(['North', 'South', 'East', 'West', 'Central'])
+    data = {}
+    for i, kind in zip(range(cols), itertools.cycle(kinds)):
+        if kind == 'float':
+            values = rng.normal(1000, 250, rows).round(2)
+            values[rng.random(rows) < 0.02] = np.nan
+        elif kind == 'int':
+            values = rng.integers(0, 100000, rows)
+        elif kind == 'category':
+            values = regions[rng.integers(0, len(regions), rows)]
+        elif kind == 'date':
+            values = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 1500, rows), unit='D')
+        elif kind == 'bool':
+            values = rng.random(rows) < 0.5
+        else:
+            values = np.char.add('item-', rng.integers(0, rows, rows).astype(str))
+        data[f'{kind}_{i}'] = values
+    return pd.DataFrame(data)
+
+# Path of a synthetic workbook in folder, generating it on first use
+def synthetic_workbook(rows, cols, sheets, dtype, folder=WORKBOOK_FOLDER):
+    path = os.path.join(folder, f'bench-{rows}x{cols}x{sheets}-{dtype}.xlsx')
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        print(f"Generating {os.path.basename(path)}...")
+        tmp_path = path[:-len('.xlsx')] + '.partial.xlsx'
+        with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+            for sheet in range(sheets):
+                synthetic_frame(rows, cols, dtype, seed=sheet).to_excel(writer, sheet_name=f'Sheet{sheet + 1}', index=False)
+        os.replace(tmp_path, path)
+    return path
+
+# Latency summary (milliseconds) of a list of seconds
+def summarize_timings(seconds):
+    ms = np.asarray(seconds) * 1000
+    summary = {'count': len(ms), 'mean_ms': round(float(ms.mean()), 3), 'max_ms': round(float(ms.max()), 3)}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = round(float(np.percentile(ms, p)), 3)
+    return summary
+
+# Peak resident memory of this process and of its finished children (MB)
+def peak_rss_mb():
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    return {'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    # Time one call; responses are closed so the app's request metrics see them finish
+    def call(self, op, fn, ok=lambda response: response.status_code < 400):
+        started = time.perf_counter()
+        response = fn()
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            if ok(response):
+                self.timings.setdefault(op, []).append(elapsed)
+            else:
+                self.errors[op] = self.errors.get(op, 0) + 1
+        return response
+
+    def add(self, op, seconds):
+        with self._lock:
+            self.timings.setdefault(op, []).append(seconds)
+
+    def fail(self, op):
+        with self._lock:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+# Wait for the session's queued answer; returns seconds waited or None on failure/timeout
+def wait_for_answer(client, conversation_store, jobs):
+    started = time.perf_counter()
+    with client.session_transaction() as session:
+        conversation_id = session.get('conversation_id')
+    pending = conversation_store.get_pending(conversation_id) if conversation_id else None
+    if pending is None:
+        return 0.0  # Answered from the response cache (or with a busy message)
+    while time.perf_counter() - started < ANSWER_TIMEOUT:
+        job = jobs.get(pending['id'])
+        if job is not None and job['status'] in ('done', 'failed'):
+            return time.perf_counter() - started if job['status'] == 'done' else None
+        time.sleep(0.005)
+    return None
+
+# One user session: upload, wait for the first answer, chat, preview, switch sheets and stream
+def run_session(app, path, sheets, run, recorder, modules):
+    conversation_store, jobs = modules
+    client = app.test_client()
+    with open(path, 'rb') as f:
+        recorder.call('upload', lambda: client.post(
+            '/upload', data={'excel_file': (f, os.path.basename(path)), 'user_question': f'Summarize this file (run {run})'},
+            content_type='multipart/form-data'), ok=lambda r: r.status_code == 302 and r.location.endswith('/chat'))
+    for question in (None, f'What is the average of the first column? (run {run})'):
+        if question is not None:
+            recorder.call('chat_post', lambda: client.post('/chat', data={'user_question': question}),
+                          ok=lambda r: r.status_code == 302)
+        waited = wait_for_answer(client, conversation_store, jobs)
+        if waited is None:
+            recorder.fail('answer')
+        else:
+            recorder.add('answer', waited)
+        recorder.call('chat_get', lambda: client.get('/chat'))
+    recorder.call('preview', lambda: client.get('/preview?offset=0&limit=100'))
+    recorder.call('preview_scroll', lambda: client.get(f'/preview?offset={run * 100}&limit=100'))
+    recorder.call('preview_search', lambda: client.get(f'/preview?q=item-{run}&limit=100'))
+    recorder.call('preview_sort', lambda: client.get('/preview?sort=0&order=desc&limit=100'))
+    if sheets > 1:
+        recorder.call('sheet_switch', lambda: client.post('/chat', data={'action': 'change_sheet', 'sheet_selection': 'Sheet2'}),
+                      ok=lambda r: r.status_code == 302)
+        recorder.call('chat_get', lambda: client.get('/chat'))
+    recorder.call('chat_stream', lambda: client.get('/chat/stream', query_string={
+        'user_question': f'Which rows stand out? (run {run})'}), ok=lambda r: b'event: done' in r.get_data())
+
+# Micro-benchmarks of the pieces behind the endpoints on the workbook's first sheet
+def run_micro(path, repeat, recorder, modules):
+    excel_reader, columnar_store, sheet_cache, summaries, backend = modules
+    file_hash = sheet_cache.file_hash(path)
+    columnar_store.convert_workbook(path, file_hash)
+    for _ in range(repeat):
+        started = time.perf_counter()
+        df = excel_reader.read_sheet(path, 'Sheet1')
+        recorder.add('excel_read', time.perf_counter() - started)
+        started = time.perf_counter()
+        columnar_store.read_sheet(file_hash, 'Sheet1')
+        recorder.add('arrow_load', time.perf_counter() - started)
+        started = time.perf_counter()
+        summaries.summarize_dataframe(df)
+        recorder.add('summarize_dataframe', time.perf_counter() - started)
+        started = time.perf_counter()
+        backend.preview_window(columnar_store.read_table(file_hash, 'Sheet1'), 0, 100)
+        recorder.add('preview_window', time.perf_counter() - started)
+
+# Print p50 changes per operation against an earlier report
+def compare(report, old_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = {w['workbook']: w for w in json.load(f)['workbooks']}
+    print(f"\nChange in p50 against {old_path} (+ slower, - faster):")
+    for workbook in report['workbooks']:
+        before = old.get(workbook['workbook'])
+        if before is None:
+            continue
+        for section in ('ops', 'micro'):
+            for op, stats in workbook[section].items():
+                previous = before.get(section, {}).get(op)
+                if previous and previous['p50_ms']:
+                    change = (stats['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] * 100
+                    print(f"{workbook['workbook']:<36} {op:<20} {previous['p50_ms']:>10.2f} -> {stats['p50_ms']:>10.2f} ms "
+                          f"({change:+.0f}%)")
+
+# Measure one workbook in this (fresh) process and write its result to result_path
+def bench_workbook(path, result_path, args):
+    # The app reads its settings at import time and keeps its files relative to the working directory
+    os.environ['GEMINI_BACKEND'] = 'stub'
+    os.environ['STUB_LLM_LATENCY'] = str(args.llm_latency)
+    os.environ.setdefault('UPLOAD_SWEEP_INTERVAL', '0')
+    # The stub has no quota, so the per-worker rate limiter would only measure itself
+    os.environ.setdefault('LLM_RATE_LIMIT_RPM', '1000000')
+    os.environ.setdefault('LLM_RATE_LIMIT_BURST', '1000')
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='docubridge-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, source_dir)
+    import main as app_module
+    import backend, columnar_store, conversation_store, excel_reader, jobs, sheet_cache, summaries
+
+    sheets = args.sheets[0]
+    try:
+        recorder = Recorder()
+        started = time.perf_counter()
+        runs = iter(range(args.repeat))
+        runs_lock = threading.Lock()
+
+        def client_loop():
+            while True:
+                with runs_lock:
+                    run = next(runs, None)
+                if run is None:
+                    return
+                run_session(app_module.app, path, sheets, run, recorder, (conversation_store, jobs))
+
+        threads = [threading.Thread(target=client_loop) for _ in range(max(1, args.clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+        requests = sum(len(t) for op, t in recorder.timings.items() if op != 'answer')
+
+        micro = Recorder()
+        run_micro(path, args.repeat, micro, (excel_reader, columnar_store, sheet_cache, summaries, backend))
+        result = {
+            'workbook': os.path.basename(path), 'size_bytes': os.path.getsize(path),
+            'ops': {op: summarize_timings(t) for op, t in sorted(recorder.timings.items())},
+            'errors': recorder.errors,
+            'micro': {op: summarize_timings(t) for op, t in sorted(micro.timings.items())},
+            'wall_seconds': round(wall, 3),
+            'requests_per_second': round(requests / wall, 2) if wall else None,
+            'sessions_per_second': round(args.repeat / wall, 3) if wall else None,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    finally:
+        os.chdir(source_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"\n{result['workbook']} ({result['size_bytes'] // 1024} KB): {result['requests_per_second']} req/s, "
+          f"peak RSS {result['peak_rss_mb']['self']} MB" + (f", errors {recorder.errors}" if recorder.errors else ''))
+    for section in ('ops', 'micro'):
+        for op, stats in result[section].items():
+            print(f"  {op:<20} n={stats['count']:<4} p50 {stats['p50_ms']:>9.2f} ms  p95 {stats['p95_ms']:>9.2f} ms  "
+                  f"max {stats['max_ms']:>9.2f} ms")
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+def _int_list(text):
+    return [int(value) for value in text.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark DocuBridge end to end on synthetic workbooks.')
+    parser.add_argument('--rows', type=_int_list, default=[1000, 10000], help='comma-separated row counts')
+    parser.add_argument('--cols', type=_int_list, default=[10, 40], help='comma-separated column counts')
+    parser.add_argument('--sheets', type=_int_list, default=[1, 3], help='comma-separated sheet counts')
+    parser.add_argument('--dtypes', default='mixed', help=f'comma-separated column mixes ({", ".join(DTYPES)})')
+    parser.add_argument('--repeat', type=int, default=5, help='user sessions per workbook')
+    parser.add_argument('--clients', type=int, default=1, help='sessions running at once')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='seconds the stub LLM takes per answer')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--compare', help='an earlier report to compare p50 latencies with')
+    parser.add_argument('--workbooks', default=WORKBOOK_FOLDER, help='folder for the generated workbooks')
+    parser.add_argument('--one-workbook', nargs=2, metavar=('WORKBOOK', 'RESULT'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.one_workbook:
+        bench_workbook(*args.one_workbook, args)
+        return 0
+    # Report paths are relative to where the benchmark was started, not to the scratch directory
+    args.json = args.json and os.path.abspath(args.json)
+    args.compare = args.compare and os.path.abspath(args.compare)
+    dtypes = args.dtypes.split(',')
+    if any(dtype not in DTYPES for dtype in dtypes):
+        parser.error(f'--dtypes must be a subset of {",".join(DTYPES)}')
+
+    matrix = list(itertools.product(args.rows, args.cols, args.sheets, dtypes))
+    workbooks = [(synthetic_workbook(*combo, folder=os.path.abspath(args.workbooks)), combo) for combo in matrix]
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'settings': {k: v for k, v in vars(args).items() if k not in ('json', 'compare', 'workbooks', 'one_workbook')},
+              'workbooks': []}
+    # Each workbook is measured in a fresh process, so its peak RSS (a high-water mark that
+    # never goes down) and its caches are its own and not left over from an earlier workbook
+    for path, combo in workbooks:
+        fd, result_path = tempfile.mkstemp(prefix='docubridge-bench-', suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--one-workbook', path, result_path,
+                            '--sheets', str(combo[2]), '--repeat', str(args.repeat), '--clients', str(args.clients),
+                            '--llm-latency', str(args.llm_latency)], check=True)
+            with open(result_path, encoding='utf-8') as f:
+                result = json.load(f)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            print(f"\n{os.path.basename(path)}: benchmark process failed ({e})")
+            result = {'workbook': os.path.basename(path), 'errors': {'process': 1}}
+        finally:
+            os.remove(result_path)
+        report['workbooks'].append({**dict(zip(('rows', 'cols', 'sheets', 'dtype'), combo)), **result})
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.json}")
+    if args.compare:
+        compare(report, args.compare)
+    return 1 if any(w['errors'] for w in report['workbooks']) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
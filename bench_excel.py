@@ -0,0 +1,81 @@
+# bench_excel.py - Compare Excel parsing engines on real workbooks
+# Usage: python bench_excel.py [--repeat N] [--json report.json] [workbook ...]
+# Without workbook arguments every .xlsx/.xls file in samples/ and tmp/uploads/ is measured.
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import statistics
+import pandas as pd
+import excel_reader
+
+# Sample workbooks kept with the code (outside tmp/, which the upload sweeper cleans)
+SAMPLES_FOLDER = 'samples'
+
+# Seconds to parse every sheet of a workbook with one engine (median of repeat runs)
+def time_engine(file_path, engine, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with pd.ExcelFile(file_path, engine=engine) as xls:
+            for sheet_name in xls.sheet_names:
+                xls.parse(sheet_name)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+# Engines that can be benchmarked for a file (calamine only when installed)
+def candidate_engines(file_path):
+    engines = [excel_reader.fallback_engine(file_path)]
+    if excel_reader.calamine_available():
+        engines.insert(0, 'calamine')
+    return engines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare Excel parsing engines.')
+    parser.add_argument('files', nargs='*', help='workbooks to parse (default: .xlsx/.xls files in samples/ and tmp/uploads/)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per engine and file (median is reported)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    files = args.files or sorted(path for folder in (SAMPLES_FOLDER, os.path.join('tmp', 'uploads'))
+                                 for ext in ('*.xlsx', '*.xls') for path in glob.glob(os.path.join(folder, ext)))
+    if not files:
+        print('No workbooks found.')
+        return 1
+    if not excel_reader.calamine_available():
+        print('python-calamine is not installed; only the pure-Python engines are measured.')
+
+    results = []
+    totals = {}
+    print(f"{'file':<44} {'size KB':>8} {'engine':<9} {'seconds':>9} {'speedup':>8}")
+    for file_path in files:
+        engines = candidate_engines(file_path)
+        baseline_engine = excel_reader.fallback_engine(file_path)
+        timings = {}
+        for engine in engines:
+            try:
+                timings[engine] = time_engine(file_path, engine, args.repeat)
+            except Exception as e:
+                print(f"{os.path.basename(file_path):<44} {'':>8} {engine:<9} failed: {e}")
+        baseline = timings.get(baseline_engine)
+        for engine, seconds in timings.items():
+            speedup = baseline / seconds if baseline and seconds else None
+            totals.setdefault(engine, 0.0)
+            totals[engine] += seconds
+            results.append({'file': file_path, 'size_bytes': os.path.getsize(file_path), 'engine': engine,
+                            'seconds': seconds, 'speedup_vs_' + baseline_engine: speedup})
+            print(f"{os.path.basename(file_path):<44} {os.path.getsize(file_path) // 1024:>8} {engine:<9} "
+                  f"{seconds:>9.4f} {'' if speedup is None else f'{speedup:.1f}x':>8}")
+
+    print()
+    for engine, seconds in sorted(totals.items(), key=lambda item: item[1]):
+        print(f"total {engine:<9} {seconds:.3f}s")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'repeat': args.repeat, 'results': results, 'totals': totals}, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
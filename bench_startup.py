@@ -0,0 +1,113 @@
+# bench_startup.py - Measure cold start and per-worker memory of the production server
+# Usage: python bench_startup.py [--workers N] [--repeat N] [--json report.json]
+# Times a bare "import main" in fresh interpreters, then starts gunicorn (gunicorn.conf.py) with
+# and without preloading and reports the time to the first response and each worker's memory.
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Seconds to wait for the server to answer its first request
+STARTUP_TIMEOUT = 60
+
+# Seconds to import the app in a fresh interpreter
+def import_seconds():
+    code = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=SOURCE_DIR, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# (RSS, private) memory of a process in MB from /proc, or None
+def process_memory_mb(pid):
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+
+    def kb(name):
+        return int(fields.get(name, '0 kB').split()[0])
+    return round(kb('Rss') / 1024, 1), round((kb('Private_Clean') + kb('Private_Dirty')) / 1024, 1)
+
+def _children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+# Start gunicorn, wait for the first response and for every worker, then measure and stop it
+def gunicorn_startup(workers, preload):
+    port = _free_port()
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_PRELOAD='1' if preload else '0',
+               PORT=str(port), UPLOAD_SWEEP_INTERVAL='0')
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'main:app'],
+                              cwd=SOURCE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_response = None
+        while time.perf_counter() - started < STARTUP_TIMEOUT:
+            if server.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with status {server.returncode}')
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1) as response:
+                    if response.status == 200:
+                        first_response = time.perf_counter() - started
+                        break
+            except OSError:
+                time.sleep(0.02)
+        if first_response is None:
+            raise RuntimeError('gunicorn did not answer in time')
+        # Let the remaining workers finish booting before measuring them
+        while time.perf_counter() - started < STARTUP_TIMEOUT and len(_children(server.pid)) < workers:
+            time.sleep(0.05)
+        time.sleep(1)
+        worker_memory = [memory for memory in map(process_memory_mb, _children(server.pid)) if memory]
+        return {
+            'preload': preload,
+            'workers': workers,
+            'first_response_seconds': round(first_response, 3),
+            'master_memory_mb': process_memory_mb(server.pid),
+            'worker_rss_mb': [rss for rss, _ in worker_memory],
+            'worker_private_mb': [private for _, private in worker_memory],
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure server cold start and worker memory.')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers to start')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each measurement (median is reported)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    report = {'import_seconds': round(statistics.median(import_seconds() for _ in range(args.repeat)), 3)}
+    print(f"import main: {report['import_seconds']:.3f}s (median of {args.repeat})")
+    report['gunicorn'] = []
+    for preload in (False, True):
+        runs = [gunicorn_startup(args.workers, preload) for _ in range(args.repeat)]
+        result = min(runs, key=lambda run: run['first_response_seconds'])
+        result['first_response_seconds'] = statistics.median(run['first_response_seconds'] for run in runs)
+        report['gunicorn'].append(result)
+        private = result['worker_private_mb']
+        print(f"gunicorn preload={'on ' if preload else 'off'}: first response after {result['first_response_seconds']:.2f}s, "
+              f"worker RSS {result['worker_rss_mb']} MB, private {private} MB "
+              f"(total private {sum(private):.0f} MB)")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
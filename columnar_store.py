@@ -0,0 +1,224 @@
+# columnar_store.py - Arrow IPC copies of uploaded sheets, read back via memory mapping
+import os
+import json
+import hashlib
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import pyarrow as pa
+import summaries
+import streaming_ingest
+import excel_reader
+
+# Directory holding one sub-directory of converted sheets per file content hash
+STORE_FOLDER = os.path.join('tmp', 'store')
+os.makedirs(STORE_FOLDER, exist_ok=True)
+
+MANIFEST_NAME = 'manifest.json'
+
+# Number of processes converting the remaining sheets of a workbook in the background
+SHEET_PARSE_WORKERS = int(os.getenv('SHEET_PARSE_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# Created lazily so pre-forked server workers each start their own pool
+_pool = None
+_pool_lock = threading.Lock()
+# (file_hash, sheet_name) -> Future of a background conversion started by this process
+_pending = {}
+
+# Directory with all converted artefacts of one uploaded file
+def artifact_dir(file_hash):
+    return os.path.join(STORE_FOLDER, file_hash)
+
+# Path of a per-sheet artefact (sheet names may contain any character, so hash them)
+def sheet_artifact_path(file_hash, sheet_name, suffix):
+    name_digest = hashlib.sha1(str(sheet_name).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(artifact_dir(file_hash), f'{name_digest}{suffix}')
+
+# Path of the Arrow file for a sheet
+def sheet_path(file_hash, sheet_name):
+    return sheet_artifact_path(file_hash, sheet_name, '.arrow')
+
+# Write a file atomically so other workers never see a half-written artefact
+def atomic_write(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Convert a DataFrame into an Arrow table, stringifying columns Arrow can't type
+# (Excel columns often mix numbers and text)
+def _to_arrow_table(df):
+    df = df.copy(deep=False)
+    df.columns = [str(col) for col in df.columns]
+    df = df.reset_index(drop=True)
+    for col in df.columns:
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            df[col] = df[col].map(lambda v: None if pd.isna(v) else str(v))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+# Persist one parsed sheet as an Arrow IPC file
+def write_sheet(file_hash, sheet_name, df):
+    table = _to_arrow_table(df)
+
+    def write(tmp_path):
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    atomic_write(sheet_path(file_hash, sheet_name), write)
+
+# Arrow table of a stored sheet, memory-mapped (its buffers are the OS page cache, not copies)
+def read_table(file_hash, sheet_name):
+    source = pa.memory_map(sheet_path(file_hash, sheet_name), 'r')
+    return pa.ipc.open_file(source).read_all()
+
+# Read a stored sheet by memory-mapping its Arrow file
+# Numeric columns without nulls stay backed by the shared OS page cache
+def read_sheet(file_hash, sheet_name):
+    return read_table(file_hash, sheet_name).to_pandas(split_blocks=True)
+
+# Check whether a sheet has already been converted
+def has_sheet(file_hash, sheet_name):
+    return os.path.exists(sheet_path(file_hash, sheet_name))
+
+# Record the workbook's sheet names (in workbook order) next to the converted sheets
+def write_manifest(file_hash, sheet_names):
+    payload = json.dumps({'sheet_names': list(sheet_names)})
+
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+
+    atomic_write(os.path.join(artifact_dir(file_hash), MANIFEST_NAME), write)
+
+# Sheet names of a converted workbook, or None if it was never converted
+def read_manifest(file_hash):
+    try:
+        with open(os.path.join(artifact_dir(file_hash), MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)['sheet_names']
+    except (OSError, ValueError, KeyError):
+        return None
+
+# Read a text artefact stored next to a sheet (e.g. its AI summary), or None if missing
+def read_sheet_text(file_hash, sheet_name, suffix):
+    try:
+        with open(sheet_artifact_path(file_hash, sheet_name, suffix), encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+# Store a text artefact next to a sheet
+def write_sheet_text(file_hash, sheet_name, suffix, text):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    atomic_write(sheet_artifact_path(file_hash, sheet_name, suffix), write)
+
+# Background pool for sheet conversion (spawned, so no request-thread state is forked)
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=SHEET_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+# Convert a large sheet chunk by chunk with bounded memory, storing its summary as well
+def _ingest_sheet(file_path, file_hash, sheet_name):
+    result = {}
+
+    def write(tmp_path):
+        result['summary'] = streaming_ingest.ingest_sheet(file_path, sheet_name, tmp_path)[1]
+
+    atomic_write(sheet_path(file_hash, sheet_name), write)
+    write_sheet_text(file_hash, sheet_name, summaries.SUMMARY_SUFFIX, result['summary'])
+
+# Worker-process task: convert one sheet of a workbook into the store
+def _convert_sheet(file_path, file_hash, sheet_name):
+    if not has_sheet(file_hash, sheet_name):
+        if streaming_ingest.use_streaming(file_path):
+            _ingest_sheet(file_path, file_hash, sheet_name)
+        else:
+            write_sheet(file_hash, sheet_name, excel_reader.read_sheet(file_path, sheet_name))
+    return sheet_name
+
+# Forget a finished background conversion and report failures
+def _conversion_done(key, future):
+    _pending.pop(key, None)
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Columnar store: background conversion of sheet '{key[1]}' failed: {future.exception()}")
+
+# Queue the given sheets for conversion in the background process pool
+def _schedule_conversion(file_path, file_hash, sheet_names):
+    pool = _get_pool()
+    for sheet_name in sheet_names:
+        key = (file_hash, sheet_name)
+        if key in _pending or has_sheet(file_hash, sheet_name):
+            continue
+        future = pool.submit(_convert_sheet, file_path, file_hash, sheet_name)
+        _pending[key] = future
+        future.add_done_callback(lambda f, key=key: _conversion_done(key, f))
+
+# Open an uploaded workbook once, convert its first sheet right away and the
+# remaining sheets in the background; returns the sheet names
+def convert_workbook(file_path, file_hash):
+    sheet_names = read_manifest(file_hash)
+    if sheet_names is None and streaming_ingest.use_streaming(file_path):
+        sheet_names = streaming_ingest.sheet_names(file_path)
+        _convert_sheet(file_path, file_hash, sheet_names[0])
+        write_manifest(file_hash, sheet_names)
+    elif sheet_names is None:
+        sheet_names, first = excel_reader.read_first_sheet(file_path)
+        if not has_sheet(file_hash, sheet_names[0]):
+            write_sheet(file_hash, sheet_names[0], first)
+        write_manifest(file_hash, sheet_names)
+    _schedule_conversion(file_path, file_hash, sheet_names[1:])
+    return sheet_names
+
+# Load a sheet from the store, waiting for a pending background conversion or
+# re-converting it from the original workbook if it is missing
+def load_sheet(file_path, file_hash, sheet_name):
+    pending = _pending.get((file_hash, sheet_name))
+    if pending is not None:
+        try:
+            pending.result()
+        except Exception:
+            pass  # Fall through to converting it in this process
+    if has_sheet(file_hash, sheet_name):
+        try:
+            return read_sheet(file_hash, sheet_name)
+        except (OSError, pa.ArrowException) as e:
+            print(f"Columnar store: could not read sheet '{sheet_name}' ({e}), re-converting.")
+    if streaming_ingest.use_streaming(file_path):
+        _ingest_sheet(file_path, file_hash, sheet_name)
+        return read_sheet(file_hash, sheet_name)
+    df = excel_reader.read_sheet(file_path, sheet_name)
+    try:
+        write_sheet(file_hash, sheet_name, df)
+        return read_sheet(file_hash, sheet_name)
+    except (OSError, pa.ArrowException) as e:
+        print(f"Columnar store: could not convert sheet '{sheet_name}' ({e}), using parsed copy.")
+        return df
+
+# Memory-mapped table of a sheet for reading a few rows without loading the whole sheet,
+# converting the sheet first (as load_sheet does) if it is not in the store yet
+def sheet_table(file_path, file_hash, sheet_name):
+    if (file_hash, sheet_name) not in _pending and has_sheet(file_hash, sheet_name):
+        try:
+            return read_table(file_hash, sheet_name)
+        except (OSError, pa.ArrowException) as e:
+            print(f"Columnar store: could not read sheet '{sheet_name}' ({e}), re-converting.")
+    df = load_sheet(file_path, file_hash, sheet_name)
+    if has_sheet(file_hash, sheet_name):
+        return read_table(file_hash, sheet_name)
+    return _to_arrow_table(df)
@@ -0,0 +1,154 @@
+# context_cache.py - Registers the stable prompt prefix (instructions and sheet data) with the
+# provider's context cache once and sends only the per-turn suffix afterwards
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from prompt_builder import count_tokens, join_prompt
+import llm_client
+import metrics
+
+# Set to 0 to always send the whole prompt
+CONTEXT_CACHE_ENABLED = os.getenv('CONTEXT_CACHE_ENABLED', '1') != '0'
+# Context names shared by all workers, so a prefix is registered once rather than once per worker
+CONTEXT_CACHE_PATH = os.getenv('CONTEXT_CACHE_PATH', os.path.join('tmp', 'context_cache.sqlite'))
+# Seconds the provider keeps a cached prefix (billed for storage while it lives)
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', '1800'))
+# Prefixes estimated below this many tokens are sent inline (Gemini rejects small caches)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('CONTEXT_CACHE_MIN_TOKENS', '4096'))
+# Contexts this close to expiring are re-created rather than used
+_EXPIRY_MARGIN = 60
+# Seconds to stop trying to create contexts after the provider refused one
+_FAILURE_BACKOFF = 600
+
+_local = threading.local()
+_failed_until = 0.0
+# One lock per prefix key so concurrent questions about a sheet create its context only once
+_create_locks = {}
+_create_locks_lock = threading.Lock()
+
+# Per-thread SQLite connection (WAL mode so workers can read while another writes)
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(CONTEXT_CACHE_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(CONTEXT_CACHE_PATH, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS contexts (
+            key TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            expires_at REAL NOT NULL)''')
+        _local.conn = conn
+    return conn
+
+# Key of a prefix for one backend and model. Stub contexts only exist in the process that
+# created them, so their rows are keyed by process as well and other workers never see them.
+def _key(client, prefix):
+    parts = [client.backend, client.model_name, prefix]
+    if client.backend == 'stub':
+        parts.append(str(os.getpid()))
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+# Name of the live context for a key, or None if there is none or it is about to expire
+def _lookup(key):
+    try:
+        row = _connect().execute('SELECT name FROM contexts WHERE key = ? AND expires_at > ?',
+                                 (key, time.time() + min(_EXPIRY_MARGIN, CONTEXT_CACHE_TTL / 4))).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        print(f"Context cache: lookup failed: {e}")
+        return None
+
+# Record a newly created context and drop the expired ones
+def _store(key, name, expires_at):
+    try:
+        conn = _connect()
+        conn.execute('INSERT OR REPLACE INTO contexts (key, name, expires_at) VALUES (?, ?, ?)',
+                     (key, name, expires_at))
+        conn.execute('DELETE FROM contexts WHERE expires_at <= ?', (time.time(),))
+    except sqlite3.Error as e:
+        print(f"Context cache: store failed: {e}")
+
+# Forget a context the provider no longer has
+def _forget(client, key, name):
+    client.forget_context(name)
+    try:
+        _connect().execute('DELETE FROM contexts WHERE key = ? AND name = ?', (key, name))
+    except sqlite3.Error as e:
+        print(f"Context cache: delete failed: {e}")
+
+# Whether a prefix is worth caching at all
+def _cacheable(prefix):
+    return CONTEXT_CACHE_ENABLED and count_tokens(prefix) >= CONTEXT_CACHE_MIN_TOKENS
+
+# Name of the cached context holding a prefix, creating it on a miss; None when the prefix
+# should be sent inline (the provider refused to cache one recently)
+def context_for(client, prefix, key):
+    global _failed_until
+    name = _lookup(key)
+    metrics.cache_lookup('context', name is not None)
+    if name is not None or time.time() < _failed_until:
+        return name
+    with _create_locks_lock:
+        create_lock = _create_locks.setdefault(key, threading.Lock())
+    try:
+        with create_lock:
+            # Another thread may have created it while we waited
+            name = _lookup(key)
+            if name is not None or time.time() < _failed_until:
+                return name
+            try:
+                with metrics.span('context_create'):
+                    name = client.create_context(prefix, CONTEXT_CACHE_TTL)
+            except Exception as e:
+                _failed_until = time.time() + _FAILURE_BACKOFF
+                print(f"Context cache: could not create context ({e}), sending prompts inline")
+                return None
+            _store(key, name, time.time() + CONTEXT_CACHE_TTL)
+            print(f"Context cache: created {name} for {count_tokens(prefix)} prefix tokens")
+            return name
+    finally:
+        with _create_locks_lock:
+            _create_locks.pop(key, None)
+
+# Generate an answer to prefix + suffix, with the prefix from the context cache when possible;
+# a context that expired early is re-created once. Returns the SDK response.
+def generate(client, prefix, suffix):
+    if not _cacheable(prefix):
+        return client.generate(join_prompt(prefix, suffix))
+    key = _key(client, prefix)
+    for _ in range(2):
+        name = context_for(client, prefix, key)
+        if name is None:
+            break
+        try:
+            return client.generate(suffix, context=name)
+        except llm_client.ContextNotFound:
+            print(f"Context cache: {name} is gone, re-creating it")
+            _forget(client, key, name)
+    return client.generate(join_prompt(prefix, suffix))
+
+# Stream an answer to prefix + suffix as text chunks (same context handling as generate)
+def stream(client, prefix, suffix):
+    if not _cacheable(prefix):
+        yield from client.stream(join_prompt(prefix, suffix))
+        return
+    key = _key(client, prefix)
+    for _ in range(2):
+        name = context_for(client, prefix, key)
+        if name is None:
+            break
+        chunks = client.stream(suffix, context=name)
+        try:
+            first = next(chunks, None)
+        except llm_client.ContextNotFound:
+            print(f"Context cache: {name} is gone, re-creating it")
+            _forget(client, key, name)
+            continue
+        if first is not None:
+            yield first
+        yield from chunks
+        return
+    yield from client.stream(join_prompt(prefix, suffix))
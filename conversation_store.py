@@ -0,0 +1,98 @@
+# conversation_store.py - Chat conversations in SQLite with append-only message rows,
+# shared by all workers (the session only holds the conversation id)
+import os
+import time
+import uuid
+import sqlite3
+import threading
+
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', os.path.join('tmp', 'conversations.sqlite'))
+
+_local = threading.local()
+
+# Per-thread SQLite connection (WAL mode so workers can read while another writes)
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(CONVERSATION_DB_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(CONVERSATION_DB_PATH, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            file_hash TEXT,
+            sheet_name TEXT,
+            created_at REAL NOT NULL,
+            pending_job_id TEXT,
+            pending_question TEXT,
+            pending_since REAL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            answer_html TEXT,
+            created_at REAL NOT NULL)''')
+        # Stores created before answers were kept with their HTML
+        if 'answer_html' not in [row[1] for row in conn.execute('PRAGMA table_info(messages)')]:
+            conn.execute('ALTER TABLE messages ADD COLUMN answer_html TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, id)')
+        _local.conn = conn
+    return conn
+
+# Start a new, empty conversation about a sheet; returns its id
+def create_conversation(file_hash=None, sheet_name=None):
+    conversation_id = uuid.uuid4().hex
+    _connect().execute('INSERT INTO conversations (id, file_hash, sheet_name, created_at) VALUES (?, ?, ?, ?)',
+                       (conversation_id, file_hash, sheet_name, time.time()))
+    return conversation_id
+
+# Append one question/answer turn with the answer's rendered HTML
+# (a single row insert, however long the conversation is)
+def append_turn(conversation_id, question, answer, answer_html=None):
+    _connect().execute('INSERT INTO messages (conversation_id, question, answer, answer_html, created_at) '
+                       'VALUES (?, ?, ?, ?, ?)', (conversation_id, question, answer, answer_html, time.time()))
+
+# All turns of a conversation, oldest first, as [{'id', 'question', 'answer', 'answer_html'}]
+# (answer_html is None for turns stored without it)
+def get_history(conversation_id):
+    rows = _connect().execute('SELECT id, question, answer, answer_html FROM messages '
+                              'WHERE conversation_id = ? ORDER BY id', (conversation_id,)).fetchall()
+    return [{'id': message_id, 'question': question, 'answer': answer, 'answer_html': answer_html}
+            for message_id, question, answer, answer_html in rows]
+
+# Store the rendered HTML of an answer that was saved without it
+def set_answer_html(message_id, answer_html):
+    _connect().execute('UPDATE messages SET answer_html = ? WHERE id = ?', (answer_html, message_id))
+
+# Remember the queued job answering the conversation's latest question
+def set_pending(conversation_id, job_id, question):
+    _connect().execute('UPDATE conversations SET pending_job_id = ?, pending_question = ?, pending_since = ? '
+                       'WHERE id = ?', (job_id, question, time.time(), conversation_id))
+
+# The pending job as {'id', 'question', 'submitted'}, or None
+def get_pending(conversation_id):
+    row = _connect().execute('SELECT pending_job_id, pending_question, pending_since FROM conversations '
+                             'WHERE id = ?', (conversation_id,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return {'id': row[0], 'question': row[1], 'submitted': row[2]}
+
+# Store the answer of a pending job as a new turn. Only the first caller for a job
+# appends it, so concurrent page loads in different workers never add it twice.
+def finish_pending(conversation_id, job_id, answer, answer_html=None):
+    conn = _connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT pending_question FROM conversations WHERE id = ? AND pending_job_id = ?',
+                           (conversation_id, job_id)).fetchone()
+        if row is not None:
+            conn.execute('UPDATE conversations SET pending_job_id = NULL, pending_question = NULL, '
+                         'pending_since = NULL WHERE id = ?', (conversation_id,))
+            conn.execute('INSERT INTO messages (conversation_id, question, answer, answer_html, created_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (conversation_id, row[0], answer, answer_html, time.time()))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return row is not None
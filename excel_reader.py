@@ -0,0 +1,54 @@
+# excel_reader.py - Pluggable Excel parsing: fast calamine engine with openpyxl/xlrd fallback
+import os
+import pandas as pd
+
+# 'auto' uses calamine when installed and falls back per file, or force one of ENGINES
+EXCEL_ENGINE = os.getenv('EXCEL_ENGINE', 'auto')
+
+ENGINES = ('calamine', 'openpyxl', 'xlrd')
+
+# Whether the Rust-backed calamine reader (python-calamine) is installed
+def calamine_available():
+    try:
+        import python_calamine  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+# The pure-Python engine pandas uses for this file type
+def fallback_engine(file_path):
+    return 'xlrd' if os.path.splitext(file_path)[1].lower() == '.xls' else 'openpyxl'
+
+# Engines to try for a file, in order
+def engines_for(file_path, engine=None):
+    engine = engine or EXCEL_ENGINE
+    fallback = fallback_engine(file_path)
+    if engine == 'auto':
+        return ['calamine', fallback] if calamine_available() else [fallback]
+    if engine not in ENGINES:
+        raise ValueError(f"unknown EXCEL_ENGINE {engine!r} (expected 'auto' or one of {', '.join(ENGINES)})")
+    return [engine] if engine == fallback else [engine, fallback]
+
+# Run read(engine) with each engine in turn until one succeeds
+def _read_with_fallback(file_path, read):
+    engines = engines_for(file_path)
+    for i, engine in enumerate(engines):
+        try:
+            return read(engine)
+        except Exception as e:
+            if i == len(engines) - 1:
+                raise
+            print(f"Excel reader: {engine} could not read {os.path.basename(file_path)} ({e}), "
+                  f"falling back to {engines[i + 1]}.")
+
+# Parse one sheet into a DataFrame
+def read_sheet(file_path, sheet_name):
+    return _read_with_fallback(file_path, lambda engine: pd.read_excel(file_path, sheet_name=sheet_name, engine=engine))
+
+# Open a workbook once and parse its first sheet; returns (sheet names, first sheet DataFrame)
+def read_first_sheet(file_path):
+    def read(engine):
+        with pd.ExcelFile(file_path, engine=engine) as xls:
+            return xls.sheet_names, xls.parse(xls.sheet_names[0])
+
+    return _read_with_fallback(file_path, read)
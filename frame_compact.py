@@ -0,0 +1,68 @@
+# frame_compact.py - Compact in-memory representation of loaded sheets (categoricals for
+# repetitive text, Arrow-backed strings) so each worker holds more of them. Numeric columns
+# are left alone: they are memory-mapped from the columnar store and shared by all workers,
+# and float32 copies would make every computed mean or sum inexact.
+import os
+import numpy as np
+import pandas as pd
+
+# Set to 0 to keep sheets with the dtypes they were read with
+COMPACT_FRAMES = os.getenv('COMPACT_FRAMES', '1') != '0'
+# Text columns with at most this share of distinct values (among non-empty cells) become categoricals
+CATEGORY_MAX_RATIO = float(os.getenv('CATEGORY_MAX_RATIO', '0.5'))
+
+# Arrow-backed strings, with NaN for empty cells like the object columns they replace
+# (spelled out because plain 'str' still means object dtype on pandas 2)
+ARROW_STRING = pd.StringDtype('pyarrow', na_value=np.nan)
+
+# Whether an object column holds nothing but strings (and empty cells)
+def _all_strings(series):
+    values = series.dropna()
+    return len(values) == 0 or values.map(type).eq(str).all()
+
+# Categorical copy of a text column with few distinct values, or None
+def _to_category(series):
+    count = series.count()
+    if count == 0 or series.nunique() > count * CATEGORY_MAX_RATIO:
+        return None
+    return series.astype('category')
+
+# The cheaper of two versions of a column
+def _smaller(current, candidate):
+    if candidate is None:
+        return current
+    if candidate.memory_usage(index=False, deep=True) < current.memory_usage(index=False, deep=True):
+        return candidate
+    return current
+
+# Compact representation of one column
+def compact_series(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series) \
+            or isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    if series.dtype == object:
+        if not _all_strings(series):
+            return series  # Mixed numbers and text: leave as read
+        series = _smaller(series, series.astype(ARROW_STRING))
+    if pd.api.types.is_string_dtype(series):
+        return _smaller(series, _to_category(series))
+    return series
+
+# Copy of a sheet with every column in its most compact lossless type; the values, column
+# names and index are unchanged, and columns kept as they are still share the original arrays
+def compact_frame(df):
+    if not COMPACT_FRAMES or len(df.columns) == 0:
+        return df
+    compacted = None
+    for position in range(len(df.columns)):
+        series = df.iloc[:, position]
+        try:
+            compact = compact_series(series)
+        except (TypeError, ValueError) as e:
+            print(f"Frame compaction: kept column {df.columns[position]!r} as is ({e})")
+            continue
+        if compact is not series:
+            if compacted is None:
+                compacted = df.copy(deep=False)
+            compacted.isetitem(position, compact)
+    return df if compacted is None else compacted
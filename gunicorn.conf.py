@@ -0,0 +1,69 @@
+# gunicorn.conf.py - Production serving profile: threaded workers for long outbound LLM calls,
+# with the app preloaded once in the master and shared copy-on-write by the workers
+# Run with: gunicorn --config gunicorn.conf.py main:app
+import gc
+import os
+import time
+import shutil
+
+_config_loaded = time.perf_counter()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Worker processes; each holds its own sheet cache, so a few workers with many threads
+# use far less memory than many single-threaded workers
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# Threads per worker: a request waiting on Gemini (or streaming its answer) only holds a thread
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+# Import the app (pandas, pyarrow, Flask...) once in the master before forking workers
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
+# gthread workers keep heart-beating while requests run, so this only catches stuck workers
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Time given to in-flight answers when a worker is stopped
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers after this many requests (0 = never) to bound slow memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+accesslog = '-'
+# Workers save their request metrics here so /metrics on any worker reports all of them
+os.environ.setdefault('METRICS_DIR', os.path.join('tmp', 'metrics'))
+
+# Resident and private (not shared with the master) memory of this process in MB, or None off Linux
+def _memory_mb():
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+
+    def kb(name):
+        return int(fields.get(name, '0 kB').split()[0])
+    return kb('Rss') / 1024, (kb('Private_Clean') + kb('Private_Dirty')) / 1024
+
+def on_starting(server):
+    # Metrics saved by the workers of an earlier run would be added to this run's
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+
+def when_ready(server):
+    # Objects created while preloading never change; keeping them out of the collector's
+    # generations stops garbage collection in the workers from copying their pages
+    if preload_app:
+        gc.freeze()
+    memory = _memory_mb()
+    server.log.info(f"Master ready in {time.perf_counter() - _config_loaded:.2f}s "
+                    f"(app {'preloaded' if preload_app else 'loaded by each worker'})"
+                    + (f", RSS {memory[0]:.0f} MB" if memory else ''))
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+def post_worker_init(worker):
+    memory = _memory_mb()
+    worker.log.info(f"Worker {worker.pid} ready {(time.perf_counter() - worker.forked_at) * 1000:.0f} ms after fork"
+                    + (f", RSS {memory[0]:.0f} MB of which {memory[1]:.0f} MB private" if memory else ''))
+
+def worker_exit(server, worker):
+    # Save the last few seconds of this worker's metrics, which stay in the totals
+    import metrics
+    metrics.flush()
@@ -0,0 +1,154 @@
+# jobs.py - Bounded background executor for slow LLM calls, with job IDs and results
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of LLM calls running at once in each worker process
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+# Extra jobs allowed to wait for a free slot before new submissions are refused
+LLM_MAX_QUEUED = int(os.getenv('LLM_MAX_QUEUED', '32'))
+# Seconds a finished job's result is kept for pickup
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', '600'))
+
+# Finished results are also written here so any worker process can serve them
+JOB_FOLDER = os.path.join('tmp', 'jobs')
+os.makedirs(JOB_FOLDER, exist_ok=True)
+
+# Raised when the executor has no room for another job (callers should back off)
+class JobQueueFull(Exception):
+    pass
+
+# Created lazily so pre-forked server workers each start their own threads
+_executor = None
+_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY + LLM_MAX_QUEUED)
+_lock = threading.Lock()
+# job_id -> {'id', 'status', 'result', 'error', 'created', 'finished'}
+_jobs = {}
+_stats = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0}
+# Seconds between sweeps of saved results nobody collected
+_SWEEP_INTERVAL = 60
+_last_sweep = 0.0
+
+# Shared executor running the queued LLM calls
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix='llm-job')
+        return _executor
+
+# File holding a finished job's saved state
+def _result_path(job_id):
+    return os.path.join(JOB_FOLDER, f'{job_id}.json')
+
+# Write a finished job to disk (atomically) for other worker processes
+def _persist(job):
+    path = _result_path(job['id'])
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError) as e:
+        print(f"Job store: could not persist job {job['id']}: {e}")
+
+# Delete saved results (of any worker) older than the result TTL; collected results are
+# deleted right away, this catches those whose page was closed before they were picked up
+def _sweep_files(now):
+    try:
+        names = os.listdir(JOB_FOLDER)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(JOB_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_RESULT_TTL:
+                os.remove(path)
+        except OSError:
+            pass  # Collected or swept by another worker meanwhile
+
+# Drop finished jobs older than the result TTL from memory, and now and then from disk
+def _prune(now):
+    global _last_sweep
+    expired = [job_id for job_id, job in _jobs.items()
+               if job['finished'] and now - job['finished'] > JOB_RESULT_TTL]
+    for job_id in expired:
+        del _jobs[job_id]
+    if now - _last_sweep > _SWEEP_INTERVAL:
+        _last_sweep = now
+        _sweep_files(now)
+
+# Run a job in an executor thread and record its outcome
+def _run(job, fn, args, kwargs):
+    job['status'] = 'running'
+    outcome = {}
+    try:
+        outcome = {'result': fn(*args, **kwargs), 'status': 'done'}
+        with _lock:
+            _stats['completed'] += 1
+    except Exception as e:
+        print(f"Job {job['id']} failed: {e}")
+        outcome = {'error': str(e), 'status': 'failed'}
+        with _lock:
+            _stats['failed'] += 1
+    finally:
+        outcome['finished'] = time.time()
+        # Saved before the job shows as finished and its slot is freed, so a collector can't
+        # discard it first and leave the file behind
+        _persist({**job, **outcome})
+        job.update(outcome)
+        _slots.release()
+
+# Queue fn(*args, **kwargs) and return its job ID; raises JobQueueFull when saturated
+def submit(fn, *args, **kwargs):
+    if not _slots.acquire(blocking=False):
+        with _lock:
+            _stats['rejected'] += 1
+        raise JobQueueFull()
+    now = time.time()
+    job = {'id': uuid.uuid4().hex, 'status': 'queued', 'result': None,
+           'error': None, 'created': now, 'finished': None}
+    with _lock:
+        _prune(now)
+        _jobs[job['id']] = job
+        _stats['submitted'] += 1
+    try:
+        _get_executor().submit(_run, job, fn, args, kwargs)
+    except Exception:
+        _slots.release()
+        with _lock:
+            _jobs.pop(job['id'], None)
+        raise
+    return job['id']
+
+# Current state of a job, from this process or from another worker's saved result
+# Returns None if the job is unknown here and has not finished elsewhere
+def get(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    try:
+        with open(_result_path(job_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Forget a job once its result has been collected
+def discard(job_id):
+    with _lock:
+        _jobs.pop(job_id, None)
+    try:
+        os.remove(_result_path(job_id))
+    except OSError:
+        pass
+
+# Snapshot of executor counters
+def stats():
+    with _lock:
+        active = sum(1 for job in _jobs.values() if job['status'] in ('queued', 'running'))
+        return {**_stats, 'active': active,
+                'max_concurrency': LLM_MAX_CONCURRENCY, 'max_queued': LLM_MAX_QUEUED}
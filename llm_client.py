@@ -0,0 +1,325 @@
+# llm_client.py - Long-lived Gemini client with timeouts, retries, rate limiting and a circuit breaker
+import os
+import time
+import uuid
+import random
+import datetime
+import threading
+from types import SimpleNamespace
+
+# 'gemini' for the real API, 'stub' for a local stand-in (tests, benchmarks, offline development)
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'gemini')
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')
+
+# Seconds allowed for a single API call
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+# Retries after a transient error, with jittered exponential backoff between attempts
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '0.5'))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', '8'))
+# Token bucket per process: sustained requests per minute, burst size, and longest wait for a token
+LLM_RATE_LIMIT_RPM = float(os.getenv('LLM_RATE_LIMIT_RPM', '60'))
+LLM_RATE_LIMIT_BURST = int(os.getenv('LLM_RATE_LIMIT_BURST', '10'))
+LLM_RATE_LIMIT_WAIT = float(os.getenv('LLM_RATE_LIMIT_WAIT', '10'))
+# Consecutive failed calls that open the circuit, and seconds before a trial call is let through
+LLM_BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+
+# Stub backend behaviour: seconds before the answer, seconds per streamed word, and share of failing calls
+STUB_LLM_LATENCY = float(os.getenv('STUB_LLM_LATENCY', '0'))
+STUB_LLM_STREAM_DELAY = float(os.getenv('STUB_LLM_STREAM_DELAY', '0'))
+STUB_LLM_FAILURE_RATE = float(os.getenv('STUB_LLM_FAILURE_RATE', '0'))
+
+# Raised when a call can't be made or keeps failing (circuit open, rate limited, retries exhausted)
+class LLMUnavailable(Exception):
+    pass
+
+# Stand-in for a transient server error raised by the stub backend
+class StubTransientError(Exception):
+    pass
+
+# Raised when a call names a cached context the provider no longer has (expired or deleted)
+class ContextNotFound(Exception):
+    pass
+
+# Provider errors meaning a cached context is gone
+def _context_error_types():
+    types = [ContextNotFound]
+    try:
+        from google.api_core import exceptions as api_exceptions
+        types.append(api_exceptions.NotFound)
+    except ImportError:
+        pass
+    return tuple(types)
+
+# Errors worth retrying: rate limiting, overload, timeouts and dropped connections
+def _transient_error_types():
+    types = [ConnectionError, TimeoutError, StubTransientError]
+    try:
+        from google.api_core import exceptions as api_exceptions
+        types += [api_exceptions.ResourceExhausted, api_exceptions.ServiceUnavailable,
+                  api_exceptions.DeadlineExceeded, api_exceptions.InternalServerError,
+                  api_exceptions.TooManyRequests, api_exceptions.Aborted]
+    except ImportError:
+        pass
+    return tuple(types)
+
+# Token bucket limiter: refills at rate_per_minute, holds at most burst tokens
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take one token, waiting up to timeout seconds; returns False if none became available
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate if self.rate > 0 else timeout
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+# Circuit breaker: after threshold consecutive failures, reject calls until cooldown has passed,
+# then let a single trial call through (success closes it, failure re-opens it)
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    # Whether a call may go ahead now
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    # A call succeeded: close the circuit
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    # A call failed: open the circuit once the threshold is reached
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    # 'closed' while calls go through, 'open' while they are being rejected
+    @property
+    def state(self):
+        with self.lock:
+            return 'closed' if self.opened_at is None else 'open'
+
+# Cached contexts of the stub backend: name -> (prefix, expires_at). Like the real ones they
+# expire, but they only exist in the process that created them.
+_stub_contexts = {}
+_stub_contexts_lock = threading.Lock()
+
+# Local stand-in for genai.GenerativeModel with configurable latency and failures
+class StubModel:
+    def __init__(self, model_name, context=None):
+        self.model_name = model_name
+        self.context = context
+
+    # Same role as caching.CachedContent.create: keep a prompt prefix for ttl seconds
+    @staticmethod
+    def create_context(prefix, ttl):
+        name = f'cachedContents/stub-{uuid.uuid4().hex}'
+        now = time.time()
+        with _stub_contexts_lock:
+            for expired in [key for key, (_, expires_at) in _stub_contexts.items() if expires_at <= now]:
+                del _stub_contexts[expired]
+            _stub_contexts[name] = (prefix, now + ttl)
+        return name
+
+    # Canned answer that mentions the question so answers differ per question
+    def _answer(self, prompt):
+        marker = "Question:\n"
+        question = prompt[prompt.rfind(marker) + len(marker):].split('\n', 1)[0] if marker in prompt else ''
+        return (f"This is a stub answer to: {question}\n\n"
+                f"* The prompt was about {len(prompt) // 4} tokens long.\n"
+                f"* Set GEMINI_BACKEND=gemini and GEMINI_API_KEY to get real answers.")
+
+    # Same call shape as GenerativeModel.generate_content (request_options is ignored)
+    def generate_content(self, prompt, stream=False, request_options=None):
+        cached_tokens = 0
+        if self.context is not None:
+            with _stub_contexts_lock:
+                prefix, expires_at = _stub_contexts.get(self.context, (None, 0))
+            if expires_at <= time.time():
+                raise ContextNotFound(f"stub backend: {self.context} not found")
+            prompt = f"{prefix}\n\n{prompt}"
+            cached_tokens = len(prefix) // 4
+        time.sleep(STUB_LLM_LATENCY)
+        if STUB_LLM_FAILURE_RATE and random.random() < STUB_LLM_FAILURE_RATE:
+            raise StubTransientError("stub backend: simulated transient failure")
+        text = self._answer(prompt)
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4, cached_content_token_count=cached_tokens)
+        if not stream:
+            return SimpleNamespace(text=text, usage_metadata=usage)
+
+        def chunks():
+            for word in text.split(' '):
+                time.sleep(STUB_LLM_STREAM_DELAY)
+                yield SimpleNamespace(text=word + ' ', usage_metadata=usage)
+        return chunks()
+
+# Process-wide client: one configured model, shared limiter and breaker, retrying calls
+class LLMClient:
+    def __init__(self, backend, model_name, api_key=None):
+        self.backend = backend
+        self.model_name = model_name
+        if backend == 'stub':
+            self.model = StubModel(model_name)
+        else:
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            self.model = genai.GenerativeModel(model_name)
+        self.bucket = TokenBucket(LLM_RATE_LIMIT_RPM, LLM_RATE_LIMIT_BURST)
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+        self.transient_errors = _transient_error_types()
+        self.context_errors = _context_error_types()
+        # Models bound to cached contexts, by context name
+        self._context_models = {}
+        self._context_lock = threading.Lock()
+
+    # Identifies backend and model (used to keep cached answers apart)
+    @property
+    def model_id(self):
+        return f'{self.backend}:{self.model_name}'
+
+    # Check the rate limiter and breaker before an attempt (in that order, so a
+    # breaker trial is never left hanging by a rate-limit rejection)
+    def _admit(self):
+        if not self.bucket.acquire(LLM_RATE_LIMIT_WAIT):
+            raise LLMUnavailable('rate limit exceeded')
+        if not self.breaker.allow():
+            raise LLMUnavailable('circuit breaker open')
+
+    # Seconds to sleep before retry number attempt (full jitter)
+    def _backoff(self, attempt):
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+    # Run call() with retries on transient errors; the breaker is asked once and sees one
+    # result per logical call, so a half-open trial that is retried ends as one success or failure
+    def _call_with_retries(self, call):
+        self._admit()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            if attempt and not self.bucket.acquire(LLM_RATE_LIMIT_WAIT):
+                self.breaker.record_failure()
+                raise LLMUnavailable('rate limit exceeded')
+            try:
+                result = call()
+                self.breaker.record_success()
+                return result
+            except self.context_errors as e:
+                # The provider answered: the cached context is gone, which is no outage
+                self.breaker.record_success()
+                raise ContextNotFound(str(e)) from e
+            except self.transient_errors as e:
+                if attempt == LLM_MAX_RETRIES:
+                    self.breaker.record_failure()
+                    raise LLMUnavailable(f'gave up after {attempt + 1} attempts: {e}') from e
+                delay = self._backoff(attempt)
+                print(f"AI API transient error ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            except Exception:
+                self.breaker.record_failure()
+                raise
+
+    # Store a prompt prefix in the provider's context cache for ttl seconds; returns the context name
+    def create_context(self, prefix, ttl):
+        def create():
+            if self.backend == 'stub':
+                return StubModel.create_context(prefix, ttl)
+            from google.generativeai import caching
+            return caching.CachedContent.create(model=self.model_name, contents=[prefix],
+                                                ttl=datetime.timedelta(seconds=ttl)).name
+        return self._call_with_retries(create)
+
+    # Model that answers with a cached context in front of the prompt (created once per context)
+    def _model_for(self, context):
+        if context is None:
+            return self.model
+        with self._context_lock:
+            model = self._context_models.get(context)
+        if model is None:
+            if self.backend == 'stub':
+                model = StubModel(self.model_name, context)
+            else:
+                import google.generativeai as genai
+                model = genai.GenerativeModel.from_cached_content(cached_content=context)
+            with self._context_lock:
+                if len(self._context_models) >= 256:
+                    self._context_models.clear()
+                self._context_models[context] = model
+        return model
+
+    # Drop the model bound to a context the provider no longer has
+    def forget_context(self, context):
+        with self._context_lock:
+            self._context_models.pop(context, None)
+
+    # Generate a complete answer, optionally after a cached context; returns the SDK response
+    def generate(self, prompt, context=None):
+        return self._call_with_retries(
+            lambda: self._model_for(context).generate_content(prompt, request_options={'timeout': LLM_TIMEOUT}))
+
+    # Stream an answer as text chunks; retries only happen before the first chunk arrives
+    def stream(self, prompt, context=None):
+        def start():
+            chunks = iter(self._model_for(context).generate_content(
+                prompt, stream=True, request_options={'timeout': LLM_TIMEOUT}))
+            first = next(chunks, None)
+            return first, chunks
+
+        first, chunks = self._call_with_retries(start)
+        if first is None:
+            return
+        if first.text:
+            yield first.text
+        for chunk in chunks:
+            if chunk.text:
+                yield chunk.text
+
+    # Backend, model and breaker state for monitoring
+    def stats(self):
+        return {'backend': self.backend, 'model': self.model_name, 'breaker': self.breaker.state,
+                'consecutive_failures': self.breaker.failures}
+
+_client = None
+_client_lock = threading.Lock()
+
+# Shared client for this process, or None when the real backend has no API key
+def get_client():
+    global _client
+    if _client is not None:
+        return _client
+    api_key = os.getenv('GEMINI_API_KEY')
+    if GEMINI_BACKEND != 'stub' and not api_key:
+        return None
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient(GEMINI_BACKEND, GEMINI_MODEL, api_key)
+        return _client
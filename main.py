@@ -1,7 +1,11 @@
 # main.py - Entry point for the DocuBridge Flask app
-from flask import Flask, render_template, request
+import os
+import time
+import hashlib
+from flask import Flask, Response, g, render_template, request, url_for
 from flask_session import Session
 import backend
+import metrics
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -12,11 +16,65 @@ app.secret_key = 'a8f$2k@1!z9x7v3q6b0p4w5e2r8t1y6u'
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_TYPE"] = "filesystem"
 Session(app)
+# Time loading and saving sessions as their own phases
+app.session_interface = metrics.TimedSessionInterface(app.session_interface)
+
+# Static files requested with a content version (?v=...) never change, so browsers may keep
+# them for a year; unversioned requests are revalidated with the ETag Flask sends
+STATIC_MAX_AGE = 365 * 24 * 3600
+_asset_versions = {}
+
+# URL of a static file with a short hash of its content as the version
+@app.template_global()
+def asset_url(filename):
+    version = _asset_versions.get(filename)
+    if version is None or app.debug:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = _asset_versions[filename] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return url_for('static', filename=filename, v=version)
+
+# Cache headers for static files
+@app.after_request
+def static_cache_headers(response):
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+    return response
+
+# Start timing the request (and profiling it when asked to via the X-Profile header)
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.profiler = metrics.start_profile(request.headers)
+
+# Record the request once its response has been sent; streamed responses finish when their stream ends
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    method, status, request_bytes = request.method, response.status_code, request.content_length
+    response_bytes = None if response.is_streamed else response.content_length
+    profiler = g.pop('profiler', None)
+
+    def finished():
+        metrics.observe_request(endpoint, method, status, time.perf_counter() - started,
+                                request_bytes, response_bytes)
+        if profiler is not None:
+            metrics.finish_profile(profiler, endpoint)
+    response.call_on_close(finished)
+    return response
 
 # Home page route: renders the upload form
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', max_upload_mb=backend.MAX_UPLOAD_MB)
 
 # Upload route: handles file upload and initial question
 @app.route('/upload', methods=['POST'])
@@ -28,6 +86,36 @@ def upload():
 def chat():
     return backend.handle_chat(request)
 
+# Chat stream route: streams the answer to a question as Server-Sent Events
+@app.route('/chat/stream')
+def chat_stream():
+    return backend.handle_chat_stream(request)
+
+# Job status route: reports whether a queued AI answer is ready
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    return backend.handle_job_status(job_id)
+
+# Batch route: answers a list of questions about the uploaded file concurrently
+@app.route('/batch', methods=['POST'])
+def batch():
+    return backend.handle_batch(request)
+
+# Batch status route: progress and answers of a batch of questions
+@app.route('/batch/<batch_id>')
+def batch_status(batch_id):
+    return backend.handle_batch_status(batch_id)
+
+# Preview route: a JSON window of rows from the current sheet
+@app.route('/preview')
+def preview():
+    return backend.handle_preview(request)
+
+# Metrics route: this worker's counters and histograms in the Prometheus text format
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Runs the app
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
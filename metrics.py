@@ -0,0 +1,333 @@
+# metrics.py - Request metrics (phase timings, sizes, token counts, cache ratios) summed
+# over the worker processes and rendered in the Prometheus text format, plus an opt-in
+# per-request profiler
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+import contextlib
+
+# Set to 0 to turn off timing spans and request metrics (/metrics then only has the gauges)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+# Requests whose X-Profile header equals this value are run under cProfile (empty disables profiling)
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_HEADER = 'X-Profile'
+# Profiles are written here as <milliseconds since epoch>-<endpoint>.prof (open with pstats or snakeviz)
+PROFILE_FOLDER = os.path.join('tmp', 'profiles')
+# Functions listed in the log for each profiled request
+PROFILE_TOP_FUNCTIONS = 25
+
+# Directory where each worker process saves its counters and histograms, so /metrics reports
+# the sum over all workers (empty keeps them per process); gunicorn.conf.py sets and empties it
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+# Seconds between saves of a worker's metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = 5
+
+# Histogram bucket bounds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+TOKENS_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+# (pid, path) of the file this process saves its metrics to
+_worker_file = (None, None)
+
+# Prometheus label set from label names and values
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+# Prometheus sample value (integers without a decimal point)
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+# Cumulative per-bucket counts with a sum and count for each label combination
+class Histogram:
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        with _lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def reset(self):
+        self._series = {}
+
+    def snapshot(self):
+        with _lock:
+            return {labels: [list(counts), total, count] for labels, (counts, total, count) in self._series.items()}
+
+    @staticmethod
+    def add(current, other):
+        if current is None:
+            return other
+        return [[a + b for a, b in zip(current[0], other[0])], current[1] + other[1], current[2] + other[2]]
+
+    def render(self, snapshot):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = bound if bound == '+Inf' else _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {count}')
+        return lines
+
+# Monotonic counter for each label combination
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def reset(self):
+        self._values = {}
+
+    def snapshot(self):
+        with _lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(current, other):
+        return other if current is None else current + other
+
+    def render(self, snapshot):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(snapshot.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+# Histogram registered under name (the existing one if already registered)
+def histogram(name, help_text, buckets, label_names=()):
+    return _metrics.setdefault(name, Histogram(name, help_text, buckets, label_names))
+
+# Counter registered under name (the existing one if already registered)
+def counter(name, help_text, label_names=()):
+    return _metrics.setdefault(name, Counter(name, help_text, label_names))
+
+# Register a gauge whose value is read when /metrics is scraped; read() returns a number,
+# or a {label value: number} dict when label_name is given
+def gauge(name, help_text, read, label_name=None, kind='gauge'):
+    _collectors.append((name, help_text, read, label_name, kind))
+
+REQUEST_SECONDS = histogram('docubridge_request_seconds', 'Time from request start until the response (or its stream) finished',
+                            SECONDS_BUCKETS, ('endpoint', 'method', 'status'))
+REQUEST_BYTES = histogram('docubridge_request_bytes', 'Request body size', BYTES_BUCKETS, ('endpoint',))
+RESPONSE_BYTES = histogram('docubridge_response_bytes', 'Response body size (streamed responses are not counted)',
+                           BYTES_BUCKETS, ('endpoint',))
+PHASE_SECONDS = histogram('docubridge_phase_seconds', 'Time spent in one phase of handling a request',
+                          SECONDS_BUCKETS, ('phase',))
+PROMPT_TOKENS = histogram('docubridge_prompt_tokens', 'Prompt size in tokens (estimated before the call, reported by the model after)',
+                          TOKENS_BUCKETS, ('source',))
+CACHE_LOOKUPS = counter('docubridge_cache_lookups_total', 'Cache lookups by cache and result', ('cache', 'result'))
+
+# Times the enclosed block as one phase (a shared no-op when metrics are off)
+class _Span:
+    __slots__ = ('phase', 'started')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        PHASE_SECONDS.observe(time.perf_counter() - self.started, self.phase)
+        return False
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# Context manager timing the enclosed block as one phase
+def span(phase):
+    return _Span(phase) if METRICS_ENABLED else _NULL_SPAN
+
+# Record a phase timed by hand (for phases that span generator yields)
+def observe_phase(phase, seconds):
+    if METRICS_ENABLED:
+        PHASE_SECONDS.observe(seconds, phase)
+
+# Count a cache hit or miss
+def cache_lookup(cache, hit):
+    if METRICS_ENABLED:
+        CACHE_LOOKUPS.inc(cache, 'hit' if hit else 'miss')
+
+# Record a prompt size
+def prompt_tokens(tokens, source):
+    if METRICS_ENABLED and tokens is not None:
+        PROMPT_TOKENS.observe(tokens, source)
+
+# Record a finished request
+def observe_request(endpoint, method, status, seconds, request_bytes, response_bytes):
+    if not METRICS_ENABLED:
+        return
+    _ensure_flusher()
+    REQUEST_SECONDS.observe(seconds, endpoint, method, str(status))
+    if request_bytes:
+        REQUEST_BYTES.observe(request_bytes, endpoint)
+    if response_bytes is not None:
+        RESPONSE_BYTES.observe(response_bytes, endpoint)
+
+# Path of the file holding this worker's saved metrics (pids are reused, hence the suffix)
+def _worker_path():
+    global _worker_file
+    pid = os.getpid()
+    if _worker_file[0] != pid:
+        _worker_file = (pid, os.path.join(METRICS_DIR, f'worker-{pid}-{uuid.uuid4().hex[:8]}.json'))
+    return _worker_file[1]
+
+# Save this worker's counters and histograms to METRICS_DIR (atomically). Files of workers
+# that exited are kept, so the totals never go down while the server runs.
+def flush():
+    if not METRICS_DIR:
+        return
+    data = {name: [[list(labels), value] for labels, value in metric.snapshot().items()]
+            for name, metric in list(_metrics.items())}
+    path = _worker_path()
+    tmp_path = f'{path}.tmp'
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Metrics: could not save worker metrics: {e}")
+
+# A forked worker starts from zero: what it inherited is already in its parent's totals
+def _after_fork():
+    if METRICS_DIR:
+        for metric in _metrics.values():
+            metric.reset()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+# Save every METRICS_FLUSH_INTERVAL seconds
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+# Start the flusher thread once per process (forked server workers each start their own)
+def _ensure_flusher():
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            _flusher_pid = os.getpid()
+            threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+
+# Counters and histograms of every worker summed per label set ({name: {labels: value}});
+# other workers' values are at most METRICS_FLUSH_INTERVAL seconds old
+def _merged():
+    flush()
+    merged = {}
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+    for file_name in names:
+        if not (file_name.startswith('worker-') and file_name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, file_name), encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, series in data.items():
+            metric = _metrics.get(name)
+            if metric is None:
+                continue
+            target = merged.setdefault(name, {})
+            for labels, value in series:
+                labels = tuple(labels)
+                target[labels] = metric.add(target.get(labels), value)
+    return merged
+
+# Everything in the Prometheus text exposition format: counters and histograms of all
+# workers when METRICS_DIR is set, gauges as read by the worker answering the scrape
+def render():
+    lines = []
+    merged = _merged() if METRICS_DIR else None
+    for name, metric in list(_metrics.items()):
+        lines.extend(metric.render(merged.get(name, {}) if merged is not None else metric.snapshot()))
+    for name, help_text, read, label_name, kind in _collectors:
+        try:
+            value = read()
+        except Exception as e:
+            print(f"Metrics: could not read {name}: {e}")
+            continue
+        lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'])
+        if label_name is None:
+            lines.append(f'{name} {_format_value(value)}')
+        else:
+            for label, item in sorted(value.items()):
+                lines.append(f'{name}{_format_labels((label_name,), (label,))} {_format_value(item)}')
+    return '\n'.join(lines) + '\n'
+
+# Start profiling the current request if its profile header carries PROFILE_TOKEN; returns the profiler or None
+def start_profile(headers):
+    if not PROFILE_TOKEN or headers.get(PROFILE_HEADER) != PROFILE_TOKEN:
+        return None
+    import cProfile  # Profiling is rare, so its modules are only loaded when it is used
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler is already active in this thread
+        print(f"Metrics: could not start profiler: {e}")
+        return None
+    return profiler
+
+# Stop a request profiler, save the profile and log its most expensive functions; returns the file path
+def finish_profile(profiler, endpoint):
+    profiler.disable()
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    path = os.path.join(PROFILE_FOLDER, f'{int(time.time() * 1000)}-{endpoint}.prof')
+    profiler.dump_stats(path)
+    print(f"Profile of {endpoint} saved to {path}:")
+    import pstats
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    return path
+
+# Session interface wrapper that times loading and saving the server-side session
+class TimedSessionInterface:
+    def __init__(self, inner):
+        self.inner = inner
+
+    def open_session(self, app, request):
+        with span('session_open'):
+            return self.inner.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with span('session_save'):
+            return self.inner.save_session(app, session, response)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
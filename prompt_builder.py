@@ -0,0 +1,194 @@
+# prompt_builder.py - Token-budgeted Gemini prompt assembly (cacheable prefix plus per-turn suffix)
+# with rolling history compaction
+import os
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Upper bound on prompt size (estimated tokens), configurable from environment
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '24000'))
+# Most recent chat turns always sent verbatim (budget permitting)
+HISTORY_RECENT_TURNS = int(os.getenv('HISTORY_RECENT_TURNS', '4'))
+# Token allowance for the running summary of older turns
+HISTORY_SUMMARY_TOKENS = int(os.getenv('HISTORY_SUMMARY_TOKENS', '800'))
+
+# Characters per token used for estimates (Gemini averages about four for English text)
+CHARS_PER_TOKEN = 4
+# Longest question / answer excerpt kept for each summarized turn
+SUMMARY_QUESTION_CHARS = 200
+SUMMARY_ANSWER_CHARS = 300
+
+INTRO = """You are an expert, friendly, and proactive Excel assistant. Your job is to help the user interpret, analyze, and get the most out of their uploaded Excel file. Use your knowledge of spreadsheets, formulas, and data analysis to provide clear, CONCISE, actionable, and conversational answers."""
+
+INSTRUCTIONS = """Instructions:
+- Occasionally (especially early in the conversation or when relevant), offer proactive insights, trends, or suggestions based on the data. Do not repeat the same types of insights in every response. If the user's question is specific, focus on answering it directly.
+- If the data contains dates or time periods, you may perform trend analysis (e.g., month-over-month, year-over-year changes) and summarize the results, but only if it hasn't already been done recently.
+- When applicable, automatically calculate and present key business metrics or financial ratios.
+- When asked a question, also provide the Excel formulas or step-by-step instructions for the user to perform the task themselves.
+- For step-by-step instructions, always use Markdown bullet points (e.g., * Item 1
+* Item 2).
+- Reference specific columns, rows, or values when helpful.
+- If the user's request is unclear, ask a clarifying question.
+- Be as concise and brief as possible while remaining helpful and thorough. Aim for direct answers.
+- Avoid unnecessary disclaimers.
+- Do not generate tables in your response. If you need to summarize differences or comparisons, use bullet points or plain text instead of tables.
+
+Respond as a helpful, proactive Excel assistant."""
+
+# Introduces the prefix; the same on every turn so the prefix stays cacheable
+PREFIX_LINE = "Below is the Excel Data Preview (this can be the full file content for smaller files, or a summary for larger files) and your instructions. The conversation so far and the user's latest question follow after them."
+
+# Rolling digest of history prefixes -> summary lines, so each turn is folded only once
+_SUMMARY_CACHE_SIZE = 1024
+_summary_cache = OrderedDict()
+_summary_lock = threading.Lock()
+
+# Estimate the number of tokens in a piece of text
+def count_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+# Format one chat turn verbatim
+def _format_turn(turn):
+    return f"User: {turn['question']}\nAssistant: {turn['answer']}"
+
+# Shorten text to a limit, cutting at a word boundary
+def _shorten(text, limit):
+    text = ' '.join(str(text).split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + ' ...'
+
+# Fold one turn into a single summary line (the question and the start of the answer)
+def _summarize_turn(turn):
+    return (f"- User asked: {_shorten(turn['question'], SUMMARY_QUESTION_CHARS)} "
+            f"| Assistant answered: {_shorten(turn['answer'], SUMMARY_ANSWER_CHARS)}")
+
+# Chain a digest over each turn so any history prefix has a stable key
+def _next_digest(previous, turn):
+    digest = hashlib.sha1(previous.encode('utf-8'))
+    digest.update(turn['question'].encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(turn['answer'].encode('utf-8'))
+    return digest.hexdigest()
+
+# Summary lines for the given older turns, reusing the cached summary of the
+# longest already folded prefix and only folding the turns after it
+def summarize_history(turns):
+    digests = []
+    digest = ''
+    for turn in turns:
+        digest = _next_digest(digest, turn)
+        digests.append(digest)
+    lines = []
+    start = 0
+    with _summary_lock:
+        for i in range(len(digests) - 1, -1, -1):
+            cached = _summary_cache.get(digests[i])
+            if cached is not None:
+                _summary_cache.move_to_end(digests[i])
+                lines, start = list(cached), i + 1
+                break
+    for i in range(start, len(turns)):
+        lines.append(_summarize_turn(turns[i]))
+    if digests:
+        with _summary_lock:
+            _summary_cache[digests[-1]] = tuple(lines)
+            while len(_summary_cache) > _SUMMARY_CACHE_SIZE:
+                _summary_cache.popitem(last=False)
+    return lines
+
+# Keep the newest summary lines that fit within a token allowance
+def _trim_summary(lines, max_tokens):
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        cost = count_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    dropped = len(lines) - len(kept)
+    kept.reverse()
+    if dropped:
+        kept.insert(0, f"- ({dropped} earlier exchanges omitted)")
+    return kept
+
+# Cut the file data down to a token allowance (last resort for very large previews)
+def _truncate_file_data(file_data, max_tokens):
+    note = "\n... (data preview truncated to fit the prompt budget)"
+    max_chars = max(0, max_tokens) * CHARS_PER_TOKEN
+    if len(file_data) <= max_chars:
+        return file_data
+    return file_data[:max(0, max_chars - len(note))] + note
+
+# Join the two parts of a prompt into the text sent when the prefix isn't cached
+def join_prompt(prefix, suffix):
+    return f"{prefix}\n\n{suffix}"
+
+# Assemble the prompt within the token budget, split into a stable prefix (instructions and
+# file data: identical on every turn about a sheet, so the provider can cache it) and a
+# per-turn suffix (computed result, conversation and question).
+# Returns (prefix, suffix, stats) where stats holds the estimated token counts per section.
+def build_prompt_parts(file_data, user_question="", chat_history=None, computed=None, budget=None):
+    budget = budget or PROMPT_TOKEN_BUDGET
+    chat_history = chat_history or []
+    user_question = user_question or ''
+
+    # The file data allowance must not depend on the turn, or the prefix would change from
+    # one question to the next; a quarter of the budget is always left for the suffix
+    fixed_tokens = count_tokens(INTRO) + count_tokens(PREFIX_LINE) + count_tokens(INSTRUCTIONS) + 32
+    file_tokens = count_tokens(file_data)
+    file_allowance = budget - fixed_tokens - budget // 4
+    if file_tokens > file_allowance:
+        file_data = _truncate_file_data(file_data, file_allowance)
+        file_tokens = count_tokens(file_data)
+    prefix = "\n\n".join([INTRO, PREFIX_LINE, f"Excel Data Preview:\n{file_data}", INSTRUCTIONS])
+    prefix_tokens = count_tokens(prefix)
+
+    # Never let the computed result crowd out the newest turn
+    remaining = max(0, budget - prefix_tokens - count_tokens(user_question) - 32)
+    computed_tokens = 0
+    if computed:
+        history_floor = count_tokens(_format_turn(chat_history[-1])) + 1 if chat_history else 0
+        computed = _truncate_file_data(computed, remaining - min(history_floor, remaining // 2))
+        computed_tokens = count_tokens(computed)
+    history_allowance = max(0, remaining - computed_tokens)
+
+    # Newest turns verbatim while they fit, everything older folded into the summary
+    recent = []
+    used = 0
+    for turn in reversed(chat_history[-HISTORY_RECENT_TURNS:] if HISTORY_RECENT_TURNS > 0 else []):
+        cost = count_tokens(_format_turn(turn)) + 1
+        if used + cost > history_allowance:
+            break
+        recent.append(turn)
+        used += cost
+    recent.reverse()
+    older = chat_history[:len(chat_history) - len(recent)]
+    summary_lines = []
+    if older:
+        summary_allowance = min(HISTORY_SUMMARY_TOKENS, history_allowance - used)
+        summary_lines = _trim_summary(summarize_history(older), summary_allowance)
+
+    sections = []
+    if computed:
+        sections.append(f"Computed Result for This Question:\n{computed}")
+    if summary_lines:
+        sections.append("Summary of Earlier Conversation:\n" + "\n".join(summary_lines))
+    if recent:
+        sections.append("Chat History:\n" + "\n".join(_format_turn(turn) for turn in recent))
+    question_label = "User's New Question:" if chat_history else "User's Question:"
+    sections.append(f"{question_label}\n{user_question}")
+    suffix = "\n\n".join(sections)
+
+    stats = {
+        'prompt_tokens': count_tokens(join_prompt(prefix, suffix)),
+        'prefix_tokens': prefix_tokens,
+        'file_tokens': file_tokens,
+        'computed_tokens': computed_tokens,
+        'history_tokens': used + sum(count_tokens(line) + 1 for line in summary_lines),
+        'verbatim_turns': len(recent),
+        'summarized_turns': len(older),
+    }
+    return prefix, suffix, stats
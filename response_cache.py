@@ -0,0 +1,101 @@
+# response_cache.py - Disk-backed exact-match cache of AI answers, shared by all workers
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', os.path.join('tmp', 'response_cache.sqlite'))
+# Seconds a cached answer stays valid
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))
+# Entries kept before the least recently used are evicted
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '5000'))
+
+_local = threading.local()
+
+# Per-thread SQLite connection (WAL mode so workers can read while another writes)
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(RESPONSE_CACHE_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(RESPONSE_CACHE_PATH, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            expires_at REAL NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        _local.conn = conn
+    return conn
+
+# Lower-case a question and collapse whitespace and trailing punctuation
+def normalize_question(question):
+    return ' '.join((question or '').lower().split()).rstrip('?!. ')
+
+# Digest of the conversation so far (the same question means something else mid-conversation)
+def history_digest(chat_history):
+    turns = [[entry['question'], entry['answer']] for entry in chat_history or []]
+    return hashlib.sha256(json.dumps(turns).encode('utf-8')).hexdigest()
+
+# Cache key for a question about one sheet of a file at a point in the conversation
+def make_key(file_hash, sheet_name, question, chat_history, namespace=''):
+    parts = [namespace, file_hash, str(sheet_name), normalize_question(question), history_digest(chat_history)]
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+# Increment a shared counter
+def _count(conn, name):
+    conn.execute('INSERT INTO counters (name, value) VALUES (?, 1) '
+                 'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+# Cached answer for a key, or None on a miss (expired entries count as misses)
+def get(key):
+    try:
+        conn = _connect()
+        now = time.time()
+        row = conn.execute('SELECT answer FROM responses WHERE key = ? AND expires_at > ?',
+                           (key, now)).fetchone()
+        if row is None:
+            _count(conn, 'misses')
+            return None
+        conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+        _count(conn, 'hits')
+        return row[0]
+    except sqlite3.Error as e:
+        print(f"Response cache: lookup failed: {e}")
+        return None
+
+# Store an answer, dropping expired entries and the least recently used over the limit
+def put(key, answer):
+    try:
+        conn = _connect()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO responses (key, answer, created_at, last_access, expires_at) '
+                     'VALUES (?, ?, ?, ?, ?)', (key, answer, now, now, now + RESPONSE_CACHE_TTL))
+        conn.execute('DELETE FROM responses WHERE expires_at <= ?', (now,))
+        excess = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0] - RESPONSE_CACHE_MAX_ENTRIES
+        if excess > 0:
+            conn.execute('DELETE FROM responses WHERE key IN '
+                         '(SELECT key FROM responses ORDER BY last_access LIMIT ?)', (excess,))
+            conn.execute('INSERT INTO counters (name, value) VALUES (?, ?) '
+                         'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                         ('evictions', excess))
+    except sqlite3.Error as e:
+        print(f"Response cache: store failed: {e}")
+
+# Hit/miss counters across all workers, with the hit rate and current size
+def stats():
+    try:
+        conn = _connect()
+        counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        entries = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Response cache: stats failed: {e}")
+        counters, entries = {}, 0
+    hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+    return {'hits': hits, 'misses': misses, 'evictions': counters.get('evictions', 0),
+            'entries': entries, 'hit_ratio': hits / (hits + misses) if hits + misses else 0.0}
@@ -0,0 +1,121 @@
+# sheet_cache.py - Process-wide LRU cache of parsed Excel sheets
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Memory budget for cached DataFrames (MB), configurable from environment
+SHEET_CACHE_MAX_MB = float(os.getenv('SHEET_CACHE_MAX_MB', '512'))
+# Sheets nobody has used for this many seconds are dropped even under budget (0 keeps them)
+SHEET_CACHE_IDLE_SECONDS = float(os.getenv('SHEET_CACHE_IDLE_SECONDS', '1800'))
+
+# (file_hash, sheet_name) -> (DataFrame, size in bytes, last use), least recently used first
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+# One lock per key so concurrent misses on the same sheet only parse it once
+_load_locks = {}
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'idle_evictions': 0}
+
+# Compute the SHA-256 content hash of a file, reading it in chunks
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Estimate the in-memory size of a DataFrame (including object columns)
+def frame_nbytes(df):
+    try:
+        return int(df.memory_usage(index=True, deep=True).sum())
+    except Exception:
+        return 0
+
+# Drop sheets of sessions that have gone cold (the least recently used come first)
+def _evict_idle(now):
+    global _cache_bytes
+    if SHEET_CACHE_IDLE_SECONDS <= 0:
+        return
+    while _cache:
+        key, (_, nbytes, last_use) = next(iter(_cache.items()))
+        if now - last_use < SHEET_CACHE_IDLE_SECONDS:
+            break
+        del _cache[key]
+        _cache_bytes -= nbytes
+        _stats['idle_evictions'] += 1
+
+# Look up a cached sheet, marking it as most recently used
+def _lookup(key):
+    now = time.monotonic()
+    _evict_idle(now)
+    entry = _cache.get(key)
+    if entry is not None:
+        _cache[key] = (entry[0], entry[1], now)
+        _cache.move_to_end(key)
+    return entry
+
+# Insert a sheet into the cache and evict least recently used entries over budget
+def _store(key, df):
+    global _cache_bytes
+    budget = SHEET_CACHE_MAX_MB * 1024 * 1024
+    nbytes = frame_nbytes(df)
+    if key in _cache:
+        _cache_bytes -= _cache.pop(key)[1]
+    _cache[key] = (df, nbytes, time.monotonic())
+    _cache_bytes += nbytes
+    # A sheet larger than the whole budget evicts every other sheet and stays cached on its
+    # own, rather than being re-read on every request
+    while _cache_bytes > budget and len(_cache) > 1:
+        _, (_, evicted_bytes, _) = _cache.popitem(last=False)
+        _cache_bytes -= evicted_bytes
+        _stats['evictions'] += 1
+
+# Get a sheet from the cache, calling loader() to parse it on a miss
+# Callers must treat the returned DataFrame as read-only since it is shared
+def get_sheet(file_hash, sheet_name, loader):
+    key = (file_hash, sheet_name)
+    with _lock:
+        entry = _lookup(key)
+        if entry is not None:
+            _stats['hits'] += 1
+            return entry[0]
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        # Another thread may have loaded it while we waited
+        with _lock:
+            entry = _lookup(key)
+            if entry is not None:
+                _stats['hits'] += 1
+                return entry[0]
+            _stats['misses'] += 1
+        try:
+            df = loader()
+            with _lock:
+                _store(key, df)
+            return df
+        finally:
+            with _lock:
+                _load_locks.pop(key, None)
+
+# Drop every cached sheet of a file (or the whole cache if no hash is given)
+def invalidate(file_hash=None):
+    global _cache_bytes
+    with _lock:
+        for key in [k for k in _cache if file_hash is None or k[0] == file_hash]:
+            _cache_bytes -= _cache.pop(key)[1]
+
+# Snapshot of cache counters (hits, misses, evictions, entries, bytes, hit ratio)
+def stats():
+    with _lock:
+        _evict_idle(time.monotonic())
+        lookups = _stats['hits'] + _stats['misses']
+        return {
+            **_stats,
+            'entries': len(_cache),
+            'bytes': _cache_bytes,
+            'budget_bytes': int(SHEET_CACHE_MAX_MB * 1024 * 1024),
+            'hit_ratio': _stats['hits'] / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,297 @@
+# sheet_index.py - Per-column indexes for filtering, sorting and searching the data preview
+import os
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import columnar_store
+
+# Directory (next to the converted sheet) holding the index files of a sheet
+INDEX_SUFFIX = '.index-v1'
+FILTER_OPS = ('eq', 'ne', 'lt', 'le', 'gt', 'ge', 'contains')
+
+# Query results (matching row ids) kept per process, so scrolling through one result is cheap
+_RESULT_CACHE_SIZE = 16
+_results = OrderedDict()
+# Loaded sheet indexes; their arrays are memory-mapped, so keeping them is cheap
+_INDEX_CACHE_SIZE = 32
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+# Raised for filters that don't fit a column (unknown op, value of the wrong type)
+class IndexQueryError(ValueError):
+    pass
+
+# Concatenate the ranges [starts[i], ends[i]) of a permutation without a Python loop
+def _take_ranges(order, starts, ends):
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=order.dtype)
+    shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return order[shifts + np.arange(total)]
+
+# Sorted permutation of a numeric or date column: rows in value order with missing
+# values last, plus the sorted values for binary search
+class NumericIndex:
+    kind = 'numeric'
+
+    def __init__(self, order, sorted_values, valid, is_datetime):
+        self.order = order
+        self.sorted_values = sorted_values
+        self.valid = valid
+        self.is_datetime = is_datetime
+
+    @classmethod
+    def build(cls, series):
+        is_datetime = pd.api.types.is_datetime64_any_dtype(series)
+        missing = series.isna().to_numpy()
+        if is_datetime:
+            values = series.to_numpy(dtype='datetime64[ns]', na_value=np.datetime64('NaT')).view('int64')
+        else:
+            values = series.to_numpy(dtype='float64', na_value=np.nan)
+        present = np.flatnonzero(~missing)
+        order = np.concatenate((present[np.argsort(values[present], kind='stable')], np.flatnonzero(missing)))
+        valid = len(present)
+        return cls(order, values[order[:valid]], valid, is_datetime)
+
+    def arrays(self):
+        return {'order': self.order, 'sorted': self.sorted_values}
+
+    def meta(self):
+        return {'kind': self.kind, 'valid': self.valid, 'is_datetime': self.is_datetime}
+
+    # Filter value converted to the column's sort key
+    def _key(self, value):
+        try:
+            if self.is_datetime:
+                return pd.Timestamp(value).as_unit('ns').value
+            return float(value)
+        except (TypeError, ValueError) as e:
+            raise IndexQueryError(f'{value!r} is not a {"date" if self.is_datetime else "number"}') from e
+
+    # Row ids matching one filter
+    def rows(self, op, value, series=None):
+        if op == 'contains':
+            raise IndexQueryError("'contains' only applies to text columns")
+        key = self._key(value)
+        left = int(np.searchsorted(self.sorted_values, key, side='left'))
+        right = int(np.searchsorted(self.sorted_values, key, side='right'))
+        spans = {'eq': [(left, right)], 'ne': [(0, left), (right, self.valid)],
+                 'lt': [(0, left)], 'le': [(0, right)], 'gt': [(right, self.valid)], 'ge': [(left, self.valid)]}[op]
+        return np.concatenate([self.order[start:end] for start, end in spans])
+
+    # Rows in sorted order (missing values stay last either way)
+    def sorted_rows(self, descending=False):
+        if not descending:
+            return self.order
+        return np.concatenate((self.order[:self.valid][::-1], self.order[self.valid:]))
+
+# Inverted index of a text, categorical or true/false column: rows grouped by distinct
+# value (groups in value order, missing values last) with the start offset of each group.
+# The distinct values themselves are read back from the sheet (first row of each group).
+class TextIndex:
+    kind = 'text'
+
+    def __init__(self, order, offsets):
+        self.order = order
+        self.offsets = offsets
+        self._folded = None
+
+    @classmethod
+    def build(cls, series):
+        keys = series.astype(str).where(series.notna())
+        codes, _ = pd.factorize(keys, sort=True)
+        missing = codes < 0
+        codes = np.where(missing, codes.max(initial=-1) + 1, codes)
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes[~missing], minlength=int(codes[~missing].max(initial=-1)) + 1)
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(order, offsets)
+
+    def arrays(self):
+        return {'order': self.order, 'offsets': self.offsets}
+
+    def meta(self):
+        return {'kind': self.kind}
+
+    @property
+    def valid(self):
+        return int(self.offsets[-1])
+
+    # Distinct values as a lower-cased Arrow array in group order (computed once per loaded
+    # index; Arrow's string kernels scan a million values in milliseconds)
+    def folded_values(self, series):
+        if self._folded is None:
+            firsts = self.order[self.offsets[:-1]]
+            values = series.iloc[firsts]
+            if not pd.api.types.is_string_dtype(values):
+                values = values.astype(str)
+            values = pa.array(values, from_pandas=True)
+            if pa.types.is_dictionary(values.type):
+                values = values.dictionary_decode()  # Categorical column
+            self._folded = pc.utf8_lower(pc.utf8_trim_whitespace(values))
+        return self._folded
+
+    # Rows of the given groups
+    def _group_rows(self, groups):
+        return _take_ranges(self.order, self.offsets[groups], self.offsets[groups + 1])
+
+    # Row ids matching one filter (equality and 'contains' ignore case and surrounding spaces;
+    # range comparisons are alphabetical)
+    def rows(self, op, value, series):
+        folded = self.folded_values(series)
+        needle = str(value).strip().lower()
+        if op in ('eq', 'ne', 'contains'):
+            if op == 'contains':
+                matched = pc.match_substring(folded, needle)
+            else:
+                matched = pc.equal(folded, needle)
+                matched = pc.invert(matched) if op == 'ne' else matched
+            return self._group_rows(np.flatnonzero(matched.to_numpy(zero_copy_only=False)))
+        values = series.iloc[self.order[self.offsets[:-1]]].astype(str).to_numpy(dtype=object)
+        left = int(np.searchsorted(values, str(value), side='left'))
+        right = int(np.searchsorted(values, str(value), side='right'))
+        start, end = {'lt': (0, left), 'le': (0, right), 'gt': (right, len(values)), 'ge': (left, len(values))}[op]
+        return self.order[self.offsets[start]:self.offsets[end]]
+
+    def sorted_rows(self, descending=False):
+        if not descending:
+            return self.order
+        valid = self.valid
+        return np.concatenate((self.order[:valid][::-1], self.order[valid:]))
+
+# Whether a column gets a sorted permutation (numbers and dates) or an inverted index
+def _is_numeric(series):
+    if pd.api.types.is_bool_dtype(series):
+        return False
+    return pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series)
+
+# Indexes of one sheet, built column by column on first use and persisted next to the
+# converted sheet (memory-mapped when read back, so all workers share one copy)
+class SheetIndex:
+    def __init__(self, file_hash, sheet_name):
+        self.directory = columnar_store.sheet_artifact_path(file_hash, sheet_name, INDEX_SUFFIX)
+        self.columns = {}
+        self.lock = threading.Lock()
+
+    def _paths(self, position):
+        base = os.path.join(self.directory, f'c{position}')
+        return f'{base}.json', base
+
+    # Read a persisted column index, or None if it was never built
+    def _load(self, position):
+        meta_path, base = self._paths(position)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['kind'] == 'numeric':
+                return NumericIndex(np.load(f'{base}.order.npy', mmap_mode='r'),
+                                    np.load(f'{base}.sorted.npy', mmap_mode='r'),
+                                    meta['valid'], meta['is_datetime'])
+            return TextIndex(np.load(f'{base}.order.npy', mmap_mode='r'),
+                             np.load(f'{base}.offsets.npy', mmap_mode='r'))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    # Write a column index (arrays first, metadata last, so a reader never sees half an index)
+    def _save(self, position, index):
+        meta_path, base = self._paths(position)
+        for name, array in index.arrays().items():
+            columnar_store.atomic_write(f'{base}.{name}.npy',
+                                        lambda tmp_path, array=array: _save_array(tmp_path, array))
+        payload = json.dumps(index.meta())
+
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+
+        columnar_store.atomic_write(meta_path, write)
+
+    # Index of one column (by position), loading or building it on first use
+    def column(self, df, position):
+        index = self.columns.get(position)
+        if index is not None:
+            return index
+        with self.lock:
+            index = self.columns.get(position)
+            if index is None:
+                index = self._load(position)
+                if index is None:
+                    series = df.iloc[:, position]
+                    index = (NumericIndex if _is_numeric(series) else TextIndex).build(series)
+                    try:
+                        self._save(position, index)
+                    except OSError as e:
+                        print(f"Sheet index: could not persist index of column {position} ({e}).")
+                self.columns[position] = index
+        return index
+
+# np.save appends '.npy' to names without it, so write through a file object
+def _save_array(path, array):
+    with open(path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+
+# Shared index object for a sheet
+def get_index(file_hash, sheet_name):
+    key = (file_hash, sheet_name)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = SheetIndex(file_hash, sheet_name)
+            while len(_indexes) > _INDEX_CACHE_SIZE:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(key)
+        return index
+
+# Row ids matching a free-text search: a case-insensitive substring of any text cell,
+# or an exact match in a numeric column when the text is a number
+def _search_mask(df, index, text):
+    mask = np.zeros(len(df), dtype=bool)
+    number = pd.to_numeric(text, errors='coerce')
+    for position in range(len(df.columns)):
+        column = index.column(df, position)
+        if column.kind == 'text':
+            mask[column.rows('contains', text, df.iloc[:, position])] = True
+        elif not pd.isna(number) and not column.is_datetime:
+            mask[column.rows('eq', number)] = True
+    return mask
+
+# Row ids of a sheet matching filters (list of (position, op, value)) and a search text,
+# in the order of the sort column (position or None) or in sheet order
+def query(df, file_hash, sheet_name, filters=(), search='', sort=None, descending=False):
+    search = (search or '').strip()
+    key = (file_hash, sheet_name, tuple(filters), search.casefold(), sort, descending)
+    with _lock:
+        cached = _results.get(key)
+        if cached is not None:
+            _results.move_to_end(key)
+            return cached
+
+    index = get_index(file_hash, sheet_name)
+    mask = None
+    for position, op, value in filters:
+        if op not in FILTER_OPS:
+            raise IndexQueryError(f'unsupported filter op {op!r}')
+        filter_mask = np.zeros(len(df), dtype=bool)
+        filter_mask[index.column(df, position).rows(op, value, df.iloc[:, position])] = True
+        mask = filter_mask if mask is None else mask & filter_mask
+    if search:
+        search_mask = _search_mask(df, index, search)
+        mask = search_mask if mask is None else mask & search_mask
+
+    if sort is not None:
+        rows = index.column(df, sort).sorted_rows(descending)
+        rows = rows if mask is None else rows[mask[rows]]
+    else:
+        rows = np.arange(len(df)) if mask is None else np.flatnonzero(mask)
+
+    with _lock:
+        _results[key] = rows
+        while len(_results) > _RESULT_CACHE_SIZE:
+            _results.popitem(last=False)
+    return rows
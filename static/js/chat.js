@@ -0,0 +1,118 @@
+// chat.js - Chat page behaviour: auto-scroll, typing indicator and streamed answers
+
+// Auto-scroll chat to bottom
+var chatDiv = document.getElementById('chatContainer');
+if (chatDiv) chatDiv.scrollTop = chatDiv.scrollHeight;
+
+var chatForm = document.getElementById('chatForm');
+var questionInput = document.getElementById('userQuestionInput');
+var sendBtn = document.getElementById('sendBtn');
+
+// Disable or re-enable input and button while waiting for a response
+function setWaiting(waiting) {
+    questionInput.readOnly = waiting;
+    sendBtn.disabled = waiting;
+}
+
+// Show 'DocuBridge Assistant is typing...' indicator and return the bubble
+function showTypingBubble() {
+    var typingBubble = document.createElement('div');
+    typingBubble.className = 'chat-bubble bot typing';
+    typingBubble.innerHTML = '<strong>DocuBridge Assistant:</strong> <span class="typing-dots">.</span>';
+    chatDiv.appendChild(typingBubble);
+    chatDiv.scrollTop = chatDiv.scrollHeight;
+    // Animate the dots
+    var dots = typingBubble.querySelector('.typing-dots');
+    var dotCount = 1;
+    typingBubble.dotsInterval = setInterval(function() {
+        dotCount = (dotCount % 3) + 1;
+        dots.textContent = '.'.repeat(dotCount);
+    }, 500);
+    return typingBubble;
+}
+
+// Append the user's question as a chat bubble
+function showQuestionBubble(question) {
+    var bubble = document.createElement('div');
+    bubble.className = 'chat-bubble user';
+    bubble.innerHTML = '<strong>You:</strong> ';
+    bubble.appendChild(document.createTextNode(question));
+    chatDiv.appendChild(bubble);
+}
+
+// Stream the answer over Server-Sent Events, showing tokens as they arrive
+function streamAnswer(question) {
+    showQuestionBubble(question);
+    var bubble = showTypingBubble();
+    var answerText = null;
+    var source = new EventSource('/chat/stream?user_question=' + encodeURIComponent(question));
+
+    source.onmessage = function(e) {
+        var data = JSON.parse(e.data);
+        if (answerText === null) {
+            // First tokens: turn the typing indicator into the answer bubble
+            clearInterval(bubble.dotsInterval);
+            bubble.className = 'chat-bubble bot';
+            bubble.innerHTML = '<strong>DocuBridge Assistant:</strong> ';
+            answerText = document.createElement('span');
+            answerText.style.whiteSpace = 'pre-wrap';
+            bubble.appendChild(answerText);
+        }
+        answerText.textContent += data.text;
+        chatDiv.scrollTop = chatDiv.scrollHeight;
+    };
+
+    // Finished: swap the plain text for the rendered Markdown answer
+    source.addEventListener('done', function(e) {
+        source.close();
+        clearInterval(bubble.dotsInterval);
+        bubble.className = 'chat-bubble bot';
+        bubble.innerHTML = '<strong>DocuBridge Assistant:</strong> ' + JSON.parse(e.data).html;
+        chatDiv.scrollTop = chatDiv.scrollHeight;
+        questionInput.value = '';
+        questionInput.placeholder = 'Ask a follow up question...';
+        setWaiting(false);
+        questionInput.focus();
+    });
+
+    // Connection failed: reload so the page reflects whatever was saved
+    source.onerror = function() {
+        source.close();
+        window.location.reload();
+    };
+}
+
+// A queued answer is still being generated: poll its job until it finishes, then reload
+function waitForPendingJob(jobId) {
+    setWaiting(true);
+    showTypingBubble();
+    var unknownPolls = 0;
+    var poll = setInterval(function() {
+        fetch('/jobs/' + jobId).then(function(response) {
+            return response.json();
+        }).then(function(job) {
+            // Unknown jobs may be running in another worker; the server gives up on them eventually
+            if (job.status === 'unknown') unknownPolls += 1;
+            if (job.status === 'done' || job.status === 'failed' || unknownPolls >= 10) {
+                clearInterval(poll);
+                window.location.reload();
+            }
+        });
+    }, 1000);
+}
+
+if (chatDiv && chatDiv.dataset.pendingJob) waitForPendingJob(chatDiv.dataset.pendingJob);
+
+chatForm.addEventListener('submit', function(e) {
+    if (!window.EventSource) {
+        // No streaming support: fall back to the regular form POST
+        showTypingBubble();
+        setWaiting(true);
+        return;
+    }
+    e.preventDefault();
+    var question = questionInput.value.trim();
+    if (!question) return;
+    setWaiting(true);
+    streamAnswer(question);
+});
@@ -0,0 +1,288 @@
+// preview.js - Virtualized data preview: only the rows in view are rendered, and they are
+// fetched from /preview one page at a time as the table scrolls. Search, filters and
+// header-click sorting are applied on the server.
+
+(function() {
+    var viewport = document.getElementById('previewViewport');
+    if (!viewport) return;
+    var table = document.getElementById('previewTable');
+    var statusLine = document.getElementById('previewStatus');
+    var tools = document.getElementById('previewTools');
+    var searchInput = document.getElementById('previewSearch');
+    var filterColumn = document.getElementById('previewFilterColumn');
+    var filterOp = document.getElementById('previewFilterOp');
+    var filterValue = document.getElementById('previewFilterValue');
+    var filterList = document.getElementById('previewFilters');
+
+    var PAGE_ROWS = 100;          // Rows per /preview request
+    var MAX_CACHED_PAGES = 30;    // Pages kept in memory (least recently used are dropped first)
+    var MAX_REQUESTS = 2;         // Page requests in flight at once, so fast scrolling doesn't flood the server
+    var OVERSCAN_ROWS = 10;       // Rows rendered above and below the visible ones
+    var SEARCH_DELAY = 300;       // Milliseconds of typing pause before a search is sent
+    // Browsers cap element heights (Firefox at about 17 million pixels); taller sheets scroll proportionally
+    var MAX_SCROLL_HEIGHT = 8000000;
+    var OP_LABELS = { eq: '=', ne: '≠', gt: '>', ge: '≥', lt: '<', le: '≤', contains: 'contains' };
+
+    var rowHeight = 32;           // Replaced by the measured height once the first rows are drawn
+    var rowHeightMeasured = false;
+    var columns = null;
+    var sheetRows = 0;
+    var query = { q: '', sort: null, desc: false, filters: [] };
+    var queryMs = null;
+
+    // Per-query state, reset whenever the search, filters or sort change
+    var version = 0;
+    var totalRows = null;
+    var pages = new Map();        // page number -> {rows, numbers}; Map order doubles as the LRU order
+    var requested = {};           // page number -> true while its request is in flight
+    var inFlight = 0;
+    var renderQueued = false;
+    var failed = false;           // Set after a failed request so the error stays visible
+
+    // Page data if loaded (marking it recently used), otherwise undefined
+    function getPage(page) {
+        var data = pages.get(page);
+        if (data !== undefined) {
+            pages.delete(page);
+            pages.set(page, data);
+        }
+        return data;
+    }
+
+    function storePage(page, data) {
+        pages.set(page, data);
+        while (pages.size > MAX_CACHED_PAGES) pages.delete(pages.keys().next().value);
+    }
+
+    // Query string for the current search, filters and sort
+    function queryParams() {
+        var params = '';
+        if (query.q) params += '&q=' + encodeURIComponent(query.q);
+        query.filters.forEach(function(f) {
+            params += '&filter=' + encodeURIComponent(f.position + ':' + f.op + ':' + f.value);
+        });
+        if (query.sort !== null) params += '&sort=' + query.sort + (query.desc ? '&order=desc' : '');
+        return params;
+    }
+
+    // Request one page of rows unless it is loaded, already requested, or too many requests are running
+    function fetchPage(page) {
+        if (failed || pages.has(page) || requested[page] || inFlight >= MAX_REQUESTS) return;
+        var requestVersion = version;
+        requested[page] = true;
+        inFlight += 1;
+        fetch('/preview?offset=' + (page * PAGE_ROWS) + '&limit=' + PAGE_ROWS + queryParams()).then(function(response) {
+            return response.json().then(function(data) {
+                if (!response.ok) throw new Error(data.error || response.statusText);
+                return data;
+            });
+        }).then(function(data) {
+            if (requestVersion !== version) return;  // The query changed while this was loading
+            if (columns === null) showHeader(data);
+            totalRows = data.total_rows;
+            sheetRows = data.sheet_rows;
+            if (data.query_ms !== null) queryMs = data.query_ms;
+            storePage(page, { rows: data.rows, numbers: data.row_numbers });
+        }).catch(function(error) {
+            if (requestVersion !== version) return;
+            failed = true;
+            statusLine.textContent = 'Could not load the preview: ' + error.message;
+        }).then(function() {
+            if (requestVersion === version) delete requested[page];
+            inFlight -= 1;
+            scheduleRender();
+        });
+    }
+
+    // Build the header row (click a column to sort by it) and the filter column list
+    function showHeader(data) {
+        columns = data.columns;
+        var row = document.createElement('tr');
+        row.appendChild(document.createElement('th')).textContent = '#';
+        columns.forEach(function(name, i) {
+            var th = document.createElement('th');
+            th.textContent = name;
+            th.title = name + ' (click to sort)';
+            th.className = 'sortable';
+            th.dataset.position = data.column_indexes[i];
+            row.appendChild(th);
+            var option = document.createElement('option');
+            option.value = data.column_indexes[i];
+            option.textContent = name;
+            filterColumn.appendChild(option);
+        });
+        table.tHead.appendChild(row);
+        table.dataset.extraColumns = data.total_columns - columns.length;
+    }
+
+    // Start over with a new query: drop loaded pages and scroll back to the top
+    function runQuery() {
+        version += 1;
+        totalRows = null;
+        queryMs = null;
+        pages = new Map();
+        requested = {};
+        failed = false;
+        viewport.scrollTop = 0;
+        Array.prototype.forEach.call(table.tHead.querySelectorAll('th.sortable'), function(th) {
+            var sorted = Number(th.dataset.position) === query.sort;
+            th.classList.toggle('sorted-asc', sorted && !query.desc);
+            th.classList.toggle('sorted-desc', sorted && query.desc);
+        });
+        filterList.replaceChildren();
+        query.filters.forEach(function(f, i) {
+            var chip = document.createElement('span');
+            chip.className = 'filter-chip';
+            chip.textContent = f.label + ' ';
+            var remove = document.createElement('button');
+            remove.type = 'button';
+            remove.textContent = '×';
+            remove.title = 'Remove filter';
+            remove.addEventListener('click', function() {
+                query.filters.splice(i, 1);
+                runQuery();
+            });
+            chip.appendChild(remove);
+            filterList.appendChild(chip);
+        });
+        scheduleRender();
+    }
+
+    // A full-width empty row standing in for rows that are scrolled out of view
+    function spacerRow(height) {
+        var row = document.createElement('tr');
+        row.className = 'spacer';
+        var cell = document.createElement('td');
+        cell.colSpan = columns.length + 1;
+        cell.style.height = Math.max(0, height) + 'px';
+        row.appendChild(cell);
+        return row;
+    }
+
+    // One table row; values is undefined while its page is still loading
+    function dataRow(number, values) {
+        var row = document.createElement('tr');
+        var numberCell = document.createElement('td');
+        numberCell.className = 'row-number';
+        numberCell.textContent = number === undefined ? '' : number;
+        row.appendChild(numberCell);
+        for (var i = 0; i < columns.length; i++) {
+            var cell = document.createElement('td');
+            var value = values ? values[i] : null;
+            cell.textContent = value === null || value === undefined ? (values ? '' : '…') : String(value);
+            if (cell.textContent.length > 30) cell.title = cell.textContent;
+            row.appendChild(cell);
+        }
+        return row;
+    }
+
+    // Redraw the rows around the scroll position and request any pages they need
+    function render() {
+        renderQueued = false;
+        if (failed) return;
+        if (totalRows === null) {
+            fetchPage(0);
+            return;
+        }
+        var fullHeight = totalRows * rowHeight;
+        var contentHeight = Math.min(fullHeight, MAX_SCROLL_HEIGHT);
+        var visibleRows = Math.ceil(viewport.clientHeight / rowHeight);
+        var scrollTop = viewport.scrollTop;
+        var first;
+        if (fullHeight <= MAX_SCROLL_HEIGHT) {
+            first = Math.floor(scrollTop / rowHeight);
+        } else {
+            var maxScroll = Math.max(1, contentHeight - viewport.clientHeight);
+            first = Math.floor(Math.min(1, scrollTop / maxScroll) * Math.max(0, totalRows - visibleRows));
+        }
+        first = Math.max(0, Math.min(first, Math.max(0, totalRows - 1)));
+        var start = Math.max(0, first - OVERSCAN_ROWS);
+        var end = Math.min(totalRows, first + visibleRows + OVERSCAN_ROWS);
+        var top = fullHeight <= MAX_SCROLL_HEIGHT ? start * rowHeight : scrollTop - (first - start) * rowHeight;
+
+        var body = document.createDocumentFragment();
+        body.appendChild(spacerRow(top));
+        for (var index = start; index < end; index++) {
+            var page = Math.floor(index / PAGE_ROWS);
+            var data = getPage(page);
+            if (data === undefined) fetchPage(page);
+            var offset = index - page * PAGE_ROWS;
+            body.appendChild(dataRow(data && data.numbers[offset], data && data.rows[offset]));
+        }
+        body.appendChild(spacerRow(contentHeight - top - (end - start) * rowHeight));
+        var tbody = table.tBodies[0];
+        tbody.replaceChildren(body);
+
+        if (!rowHeightMeasured && end > start) {
+            rowHeightMeasured = true;
+            var measured = tbody.rows[1].getBoundingClientRect().height;
+            if (measured > 0 && Math.abs(measured - rowHeight) > 0.5) {
+                rowHeight = measured;
+                scheduleRender();
+            }
+        }
+
+        var filtered = query.q || query.filters.length;
+        var extraColumns = Number(table.dataset.extraColumns || 0);
+        if (totalRows === 0) {
+            statusLine.textContent = filtered ? 'No matching rows.' : 'This sheet has no rows.';
+        } else {
+            statusLine.textContent = 'Rows ' + (first + 1).toLocaleString() + '–' +
+                Math.min(totalRows, first + visibleRows).toLocaleString() + ' of ' + totalRows.toLocaleString() +
+                (filtered ? ' matching (' + sheetRows.toLocaleString() + ' in the sheet)' : '') +
+                (extraColumns > 0 ? ', first ' + columns.length + ' of ' + (columns.length + extraColumns) + ' columns' : '');
+        }
+        if (queryMs !== null) statusLine.textContent += ' · ' + queryMs + ' ms';
+    }
+
+    function scheduleRender() {
+        if (renderQueued) return;
+        renderQueued = true;
+        window.requestAnimationFrame(render);
+    }
+
+    // Header click: sort ascending, then descending, then back to sheet order
+    table.tHead.addEventListener('click', function(e) {
+        var th = e.target.closest('th.sortable');
+        if (!th) return;
+        var position = Number(th.dataset.position);
+        if (query.sort !== position) {
+            query.sort = position;
+            query.desc = false;
+        } else if (!query.desc) {
+            query.desc = true;
+        } else {
+            query.sort = null;
+            query.desc = false;
+        }
+        runQuery();
+    });
+
+    var searchTimer = null;
+    searchInput.addEventListener('input', function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(function() {
+            if (searchInput.value.trim() === query.q) return;
+            query.q = searchInput.value.trim();
+            runQuery();
+        }, SEARCH_DELAY);
+    });
+
+    tools.addEventListener('submit', function(e) {
+        e.preventDefault();
+        if (filterValue.value.trim() === '' || filterColumn.value === '') return;
+        var columnName = filterColumn.options[filterColumn.selectedIndex].textContent;
+        query.filters.push({
+            position: filterColumn.value,
+            op: filterOp.value,
+            value: filterValue.value.trim(),
+            label: columnName + ' ' + OP_LABELS[filterOp.value] + ' ' + filterValue.value.trim()
+        });
+        filterValue.value = '';
+        runQuery();
+    });
+
+    viewport.addEventListener('scroll', scheduleRender, { passive: true });
+    window.addEventListener('resize', scheduleRender);
+    render();
+})();
@@ -0,0 +1,301 @@
+# streaming_ingest.py - Bounded-memory conversion of large .xlsx sheets into Arrow IPC files
+import os
+import datetime
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import summaries
+
+# Rows converted per Arrow record batch; peak memory is proportional to this, not to the file size
+INGEST_CHUNK_ROWS = int(os.getenv('INGEST_CHUNK_ROWS', '10000'))
+# .xlsx files at least this large (MB) are ingested in streaming mode instead of through pandas
+STREAMING_INGEST_MIN_MB = float(os.getenv('STREAMING_INGEST_MIN_MB', '10'))
+
+# Raised when values don't fit a column's type; the column is widened (int -> float -> text)
+class _WidenColumn(Exception):
+    def __init__(self, index, arrow_type):
+        super().__init__(index, arrow_type)
+        self.index = index
+        self.arrow_type = arrow_type
+
+# Whether a workbook should be converted in streaming mode
+def use_streaming(file_path):
+    if os.path.splitext(file_path)[1].lower() != '.xlsx':
+        return False  # .xls (xlrd) has no streaming reader and is capped at 65k rows anyway
+    return os.path.getsize(file_path) >= STREAMING_INGEST_MIN_MB * 1024 * 1024
+
+# Sheet names of a workbook without loading any sheet data
+def sheet_names(file_path):
+    import openpyxl  # Only needed for large .xlsx uploads, so not loaded at startup
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        return list(wb.sheetnames)
+    finally:
+        wb.close()
+
+# Column names the way pandas would build them (blank -> "Unnamed: i", duplicates -> "name.1")
+def _column_names(header, width):
+    names = []
+    seen = {}
+    for i in range(width):
+        value = header[i] if i < len(header) else None
+        name = f'Unnamed: {i}' if value is None or str(value).strip() == '' else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+# Arrow type for a column from the values in the first chunk
+def _infer_type(values):
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            kinds.add('bool')
+        elif isinstance(v, int):
+            kinds.add('int')
+        elif isinstance(v, float):
+            kinds.add('float')
+        elif isinstance(v, (datetime.datetime, datetime.date)) and not isinstance(v, datetime.time):
+            kinds.add('datetime')
+        else:
+            kinds.add('text')
+    if kinds == {'bool'}:
+        return pa.bool_()
+    if kinds == {'int'}:
+        return pa.int64()
+    if kinds and kinds <= {'int', 'float'}:
+        return pa.float64()
+    if kinds == {'datetime'}:
+        return pa.timestamp('us')
+    return pa.string()
+
+# Next wider type for a column whose values no longer fit
+def _widen(arrow_type, values):
+    numeric = all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values)
+    if pa.types.is_integer(arrow_type) and numeric:
+        return pa.float64()
+    return pa.string()
+
+# Whether every value has the Python type a column of arrow_type holds (pyarrow itself would
+# truncate 2.5 into an int64 column without complaint)
+def _fits(values, arrow_type):
+    if pa.types.is_boolean(arrow_type):
+        return all(v is None or isinstance(v, bool) for v in values)
+    if pa.types.is_integer(arrow_type):
+        return all(v is None or (isinstance(v, int) and not isinstance(v, bool)) for v in values)
+    if pa.types.is_floating(arrow_type):
+        return all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values)
+    if pa.types.is_timestamp(arrow_type):
+        return all(v is None or isinstance(v, (datetime.datetime, datetime.date)) for v in values)
+    return True
+
+# Convert one column of a chunk to an Arrow array of the given type
+def _to_array(values, arrow_type, index):
+    if pa.types.is_string(arrow_type):
+        return pa.array([None if v is None else str(v) for v in values], type=arrow_type)
+    if not _fits(values, arrow_type):
+        raise _WidenColumn(index, _widen(arrow_type, values))
+    if pa.types.is_timestamp(arrow_type):
+        values = [datetime.datetime.combine(v, datetime.time()) if type(v) is datetime.date else v for v in values]
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+        raise _WidenColumn(index, _widen(arrow_type, values)) from None
+
+# Arrow array of a column's values, widening its type (int -> float -> text) until they fit;
+# returns (array, type)
+def _fitting_array(values, arrow_type, index):
+    while True:
+        try:
+            return _to_array(values, arrow_type, index), arrow_type
+        except _WidenColumn as widen:
+            arrow_type = widen.arrow_type
+
+# Running per-column statistics over every row (count, mean, std, min, max)
+class _ColumnStats:
+    def __init__(self, arrow_type):
+        self.arrow_type = arrow_type
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = None
+        self.max = None
+
+    # Fold one chunk's Arrow array into the running statistics
+    def update(self, array):
+        self.count += len(array) - array.null_count
+        if self.count == 0 or array.null_count == len(array):
+            return
+        if pa.types.is_integer(self.arrow_type) or pa.types.is_floating(self.arrow_type):
+            as_float = pc.cast(array, pa.float64(), safe=False)
+            self.total += pc.sum(as_float).as_py() or 0.0
+            self.total_sq += pc.sum(pc.multiply(as_float, as_float)).as_py() or 0.0
+        if not pa.types.is_string(self.arrow_type) and not pa.types.is_boolean(self.arrow_type):
+            bounds = pc.min_max(array).as_py()
+            self.min = bounds['min'] if self.min is None else min(self.min, bounds['min'])
+            self.max = bounds['max'] if self.max is None else max(self.max, bounds['max'])
+
+    # One-line description for the summary
+    def describe(self):
+        text = f'count={self.count}'
+        if self.count and (pa.types.is_integer(self.arrow_type) or pa.types.is_floating(self.arrow_type)):
+            mean = self.total / self.count
+            std = np.sqrt(max(0.0, self.total_sq / self.count - mean * mean))
+            text += f', mean={mean:.6g}, std={std:.6g}'
+        if self.min is not None:
+            text += f', min={self.min}, max={self.max}'
+        return text
+
+# Rows of a worksheet with trailing empty cells trimmed. Blank rows between data rows are
+# kept (as empty tuples) like pandas does; blank rows before the header and after the last
+# data row are dropped.
+def _rows(ws):
+    started = False
+    blank = 0
+    for row in ws.iter_rows(values_only=True):
+        end = len(row)
+        while end and row[end - 1] is None:
+            end -= 1
+        if not end:
+            blank += started
+            continue
+        yield from [()] * blank
+        blank = 0
+        started = True
+        yield row[:end]
+
+# Move the batches already written to path to a new file with the widened schema (an Arrow to
+# Arrow copy, far cheaper than parsing the workbook again); widened column statistics are
+# recomputed on the way. Returns the new (sink, writer). Raises _WidenColumn if an earlier
+# batch doesn't fit the new type either.
+def _rewrite(path, schema, widened, stats):
+    old_path = f'{path}.old'
+    os.replace(path, old_path)
+    sink = pa.OSFile(path, 'wb')
+    writer = pa.ipc.new_file(sink, schema)
+    try:
+        with pa.memory_map(old_path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for position in range(reader.num_record_batches):
+                batch = reader.get_batch(position)
+                arrays = [_to_array(batch.column(i).to_pylist(), schema.field(i).type, i) if i in widened
+                          else batch.column(i) for i in range(batch.num_columns)]
+                for i in widened:
+                    stats[i].update(arrays[i])
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+    except BaseException:
+        writer.close()
+        sink.close()
+        raise
+    finally:
+        os.remove(old_path)
+    return sink, writer
+
+# One streaming pass: write record batches to path while keeping stats and a reservoir sample
+def _ingest_pass(file_path, sheet_name, path, forced_types):
+    import openpyxl
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        rows = _rows(wb[sheet_name])
+        header = next(rows, ())
+        first_chunk = []
+        for row in rows:
+            first_chunk.append(row)
+            if len(first_chunk) >= INGEST_CHUNK_ROWS:
+                break
+        width = max([len(header)] + [len(row) for row in first_chunk])
+        names = _column_names(header, width)
+        types = [forced_types.get(i) or _infer_type([row[i] if i < len(row) else None for row in first_chunk])
+                 for i in range(width)]
+        schema = pa.schema([pa.field(name, arrow_type) for name, arrow_type in zip(names, types)])
+        stats = [_ColumnStats(arrow_type) for arrow_type in types]
+
+        sample_size = summaries.SUMMARY_SAMPLE_ROWS
+        reservoir = []
+        rng = np.random.default_rng(0)
+        total_rows = 0
+
+        def chunks():
+            yield first_chunk
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= INGEST_CHUNK_ROWS:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        sink = pa.OSFile(path, 'wb')
+        writer = pa.ipc.new_file(sink, schema)
+        try:
+            for chunk in chunks():
+                if not chunk:
+                    continue
+                columns = [[row[i] if i < len(row) else None for row in chunk] for i in range(width)]
+                arrays = []
+                widened = set()
+                for i, values in enumerate(columns):
+                    array, arrow_type = _fitting_array(values, types[i], i)
+                    if arrow_type != types[i]:
+                        types[i] = arrow_type
+                        widened.add(i)
+                    arrays.append(array)
+                if widened:
+                    # Every column this chunk widened is changed in one go, without a new pass
+                    schema = pa.schema([pa.field(name, arrow_type) for name, arrow_type in zip(names, types)])
+                    for i in widened:
+                        stats[i] = _ColumnStats(types[i])
+                    writer.close()
+                    sink.close()
+                    sink = writer = None
+                    sink, writer = _rewrite(path, schema, widened, stats)
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                for column_stats, array in zip(stats, arrays):
+                    column_stats.update(array)
+                # Reservoir sampling (Algorithm R) of (row position, row) pairs
+                positions = np.arange(total_rows, total_rows + len(chunk))
+                fill = max(0, min(len(chunk), sample_size - len(reservoir)))
+                reservoir.extend(zip(positions[:fill].tolist(), chunk[:fill]))
+                if fill < len(chunk):
+                    slots = (rng.random(len(chunk) - fill) * (positions[fill:] + 1)).astype(np.int64)
+                    for offset in np.nonzero(slots < sample_size)[0]:
+                        reservoir[slots[offset]] = (int(positions[fill + offset]), chunk[fill + offset])
+                total_rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+                sink.close()
+    finally:
+        wb.close()
+
+    # Keep the sample in sheet order, indexed by original row position like a pandas read
+    reservoir.sort(key=lambda item: item[0])
+    sample_columns = [[row[i] if i < len(row) else None for _, row in reservoir] for i in range(width)]
+    sample = pa.table([_to_array(values, types[i], i) for i, values in enumerate(sample_columns)],
+                      schema=schema).to_pandas()
+    sample.index = [position for position, _ in reservoir]
+    exact = {name: column_stats.describe() for name, column_stats in zip(names, stats)}
+    return total_rows, sample, exact
+
+# Convert one sheet to an Arrow IPC file at path chunk by chunk, summarizing it along the way;
+# returns (row count, summary text). Columns whose type changes part-way through the sheet
+# are widened as the chunk is converted; only when an earlier chunk doesn't fit the widened
+# type either (e.g. integers too large for float64) is the pass restarted with it forced.
+def ingest_sheet(file_path, sheet_name, path):
+    forced_types = {}
+    for _ in range(64):
+        try:
+            total_rows, sample, exact = _ingest_pass(file_path, sheet_name, path, forced_types)
+            break
+        except _WidenColumn as widen:
+            forced_types[widen.index] = widen.arrow_type
+    else:
+        raise ValueError(f"could not settle column types for sheet '{sheet_name}'")
+    summary = summaries.summarize_sample(sample, total_rows, exact_stats=exact if len(sample) < total_rows else None)
+    return total_rows, summary
@@ -0,0 +1,72 @@
+# summaries.py - Bounded-cost sheet summaries for the AI prompt
+import os
+import math
+import numpy as np
+
+# Rows sampled for summary statistics; larger sheets get estimated statistics
+SUMMARY_SAMPLE_ROWS = int(os.getenv('SUMMARY_SAMPLE_ROWS', '5000'))
+# Example rows shown to the model for sheets too large to send in full
+SUMMARY_EXAMPLE_ROWS = 20
+# Versioned so summaries persisted in an older format are recomputed
+SUMMARY_SUFFIX = '.summary-v3.txt'
+
+# Pick about n rows spread over the whole sheet: one random row from each of n equal strata
+def stratified_sample(df, n, seed=0):
+    total = len(df)
+    if total <= n:
+        return df
+    rng = np.random.default_rng(seed)
+    bounds = np.linspace(0, total, n + 1).astype(np.int64)
+    positions = bounds[:-1] + (rng.random(n) * (bounds[1:] - bounds[:-1])).astype(np.int64)
+    return df.iloc[positions]
+
+# Estimate a column's distinct values from a uniform sample (GEE estimator:
+# values seen once are scaled up, values seen repeatedly are counted as-is)
+def _estimate_distinct(values, total_rows):
+    counts = values.value_counts(dropna=True)
+    if len(values) == 0 or len(values) >= total_rows:
+        return len(counts)
+    singletons = int((counts == 1).sum())
+    if singletons == len(values):
+        # Every sampled value is unique: most likely a key column
+        return total_rows
+    estimate = math.sqrt(total_rows / len(values)) * singletons + (len(counts) - singletons)
+    return int(round(min(estimate, total_rows)))
+
+# Summarize a sample of a sheet that has total_rows rows (columns, types, stats, sample rows);
+# exact_stats maps column -> description of statistics computed over every row
+def summarize_sample(sample, total_rows, max_rows=100, exact_stats=None):
+    summary = []
+    summary.append(f"Columns: {', '.join(sample.columns.astype(str))}")
+    summary.append(
+        "Column types: " +
+        ', '.join([f"{col}: {dtype}" for col, dtype in sample.dtypes.items()]))
+    summary.append(f"Rows: {total_rows}")
+    estimated = len(sample) < total_rows
+    try:
+        label = f"Summary statistics (estimated from {len(sample)} sampled rows)" if estimated else "Summary statistics"
+        summary.append(f"{label}:\n" + sample.describe(include='all').to_string())
+    except Exception:
+        pass
+    if exact_stats:
+        summary.append("Exact column statistics (all rows):\n" +
+                       '\n'.join(f"{col}: {text}" for col, text in exact_stats.items()))
+    if estimated:
+        distinct = []
+        for col in sample.columns:
+            try:
+                distinct.append(f"{col}: ~{_estimate_distinct(sample[col], total_rows)}")
+            except TypeError:
+                pass
+        summary.append("Estimated distinct values: " + ', '.join(distinct))
+    if total_rows <= max_rows and not estimated:
+        summary.append("Full data:\n" + sample.to_string())
+    else:
+        rows = stratified_sample(sample, SUMMARY_EXAMPLE_ROWS, seed=1)
+        summary.append(f"Sample rows ({len(rows)} spread across the sheet):\n" + rows.to_string())
+    return '\n\n'.join(summary)
+
+# Summarize a DataFrame for the AI prompt; cost is bounded by SUMMARY_SAMPLE_ROWS
+# however many rows the sheet has
+def summarize_dataframe(df, max_rows=100):
+    return summarize_sample(stratified_sample(df, SUMMARY_SAMPLE_ROWS), len(df), max_rows)
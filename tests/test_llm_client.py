@@ -0,0 +1,56 @@
+# tests/test_llm_client.py - Circuit breaker behaviour of the shared Gemini client (stub backend)
+import time
+import pytest
+import llm_client
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(llm_client, 'LLM_MAX_RETRIES', 2)
+    monkeypatch.setattr(llm_client, 'LLM_BACKOFF_BASE', 0)
+    monkeypatch.setattr(llm_client, 'LLM_BREAKER_THRESHOLD', 2)
+    monkeypatch.setattr(llm_client, 'LLM_BREAKER_COOLDOWN', 0.05)
+
+def failing(error):
+    def call():
+        raise error
+    return call
+
+def test_failed_half_open_trial_admits_later_calls():
+    client = llm_client.LLMClient('stub', 'stub-model')
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            client._call_with_retries(failing(ValueError('bad request')))
+    assert client.breaker.state == 'open'
+    with pytest.raises(llm_client.LLMUnavailable, match='circuit breaker open'):
+        client._call_with_retries(lambda: 'ok')
+
+    time.sleep(0.06)
+    attempts = []
+
+    def flaky_trial():
+        attempts.append(1)
+        raise llm_client.StubTransientError('overloaded')
+    with pytest.raises(llm_client.LLMUnavailable, match='gave up after 3 attempts'):
+        client._call_with_retries(flaky_trial)
+    assert len(attempts) == 3
+    assert not client.breaker.trial_running
+
+    time.sleep(0.06)
+    assert client._call_with_retries(lambda: 'ok') == 'ok'
+    assert client.breaker.state == 'closed'
+
+def test_retried_trial_that_recovers_closes_the_circuit():
+    client = llm_client.LLMClient('stub', 'stub-model')
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            client._call_with_retries(failing(ValueError('bad request')))
+    time.sleep(0.06)
+    attempts = []
+
+    def recovers():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise llm_client.StubTransientError('overloaded')
+        return 'ok'
+    assert client._call_with_retries(recovers) == 'ok'
+    assert client.breaker.state == 'closed'
@@ -0,0 +1,254 @@
+# upload_store.py - Content-addressed upload storage with reference counting and a
+# background sweeper that enforces a TTL and a disk quota
+import os
+import re
+import time
+import uuid
+import shutil
+import hashlib
+import sqlite3
+import threading
+import columnar_store
+import sheet_cache
+
+# Uploads are stored once per content hash as <UPLOAD_DIR>/<sha256><ext>
+UPLOAD_DIR = os.path.join('tmp', 'uploads')
+UPLOAD_DB_PATH = os.path.join('tmp', 'uploads.sqlite')
+# Uploads saved before they were content-addressed: tmp/<uuid>.xls(x), swept once past UPLOAD_TTL
+LEGACY_UPLOAD_DIR = 'tmp'
+_LEGACY_NAME = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.xlsx?$')
+# Seconds an upload nobody is using is kept (since it was last used)
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', str(7 * 24 * 3600)))
+# Seconds after its last request that a session stops holding on to its upload
+UPLOAD_REF_TTL = int(os.getenv('UPLOAD_REF_TTL', str(24 * 3600)))
+# Disk budget for uploads plus their converted sheets, summaries and indexes (MB)
+UPLOAD_QUOTA_MB = float(os.getenv('UPLOAD_QUOTA_MB', '2048'))
+# Seconds between sweeps
+UPLOAD_SWEEP_INTERVAL = int(os.getenv('UPLOAD_SWEEP_INTERVAL', '600'))
+# A session's reference is refreshed at most this often (seconds), so page loads rarely write
+_TOUCH_INTERVAL = 60
+
+_local = threading.local()
+# ref_id -> when this process last recorded the session's use of its upload
+_touched = {}
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+# Per-thread SQLite connection (WAL mode so workers can read while another writes)
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(UPLOAD_DB_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(UPLOAD_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS uploads (
+            file_hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL)''')
+        # One row per session: the upload it is currently working with
+        conn.execute('''CREATE TABLE IF NOT EXISTS refs (
+            ref_id TEXT PRIMARY KEY,
+            file_hash TEXT NOT NULL,
+            last_seen REAL NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS refs_file_hash ON refs (file_hash)')
+        _local.conn = conn
+    return conn
+
+# Run fn(conn) in a write transaction
+def _transaction(fn):
+    conn = _connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        result = fn(conn)
+        conn.execute('COMMIT')
+        return result
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+# Store an uploaded file (a werkzeug FileStorage) by content hash on behalf of a session.
+# Returns (path, file_hash, reused) where reused is True if the same content was already stored.
+def save_upload(file_storage, extension, ref_id):
+    _ensure_sweeper()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_DIR, f'.{uuid.uuid4().hex}.tmp')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while chunk := file_storage.stream.read(1024 * 1024):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        file_hash = digest.hexdigest()
+        path = os.path.join(UPLOAD_DIR, file_hash + extension)
+
+        # Registering the upload and placing the file happen inside one transaction, so a
+        # concurrent sweep can't delete the file between the two
+        def register(conn):
+            now = time.time()
+            reused = os.path.exists(path)
+            if not reused:
+                os.replace(tmp_path, path)
+            conn.execute('INSERT INTO uploads (file_hash, path, size, created_at, last_access) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT(file_hash) DO UPDATE SET last_access = excluded.last_access',
+                         (file_hash, path, size, now, now))
+            conn.execute('INSERT OR REPLACE INTO refs (ref_id, file_hash, last_seen) VALUES (?, ?, ?)',
+                         (ref_id, file_hash, now))
+            return reused
+
+        reused = _transaction(register)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _touched[ref_id] = time.time()
+    return path, file_hash, reused
+
+# Note that a session is still using its upload (throttled to one write per _TOUCH_INTERVAL)
+def touch(ref_id, file_hash):
+    now = time.time()
+    if now - _touched.get(ref_id, 0) < _TOUCH_INTERVAL:
+        return
+    _touched[ref_id] = now
+    _ensure_sweeper()
+    try:
+        conn = _connect()
+        conn.execute('INSERT OR REPLACE INTO refs (ref_id, file_hash, last_seen) VALUES (?, ?, ?)',
+                     (ref_id, file_hash, now))
+        conn.execute('UPDATE uploads SET last_access = ? WHERE file_hash = ?', (now, file_hash))
+    except sqlite3.Error as e:
+        print(f"Upload store: could not record use of upload: {e}")
+
+# Bytes used by a file or directory tree
+def _disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# Delete an upload and everything derived from it
+def _remove(file_hash, path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(columnar_store.artifact_dir(file_hash), ignore_errors=True)
+    sheet_cache.invalidate(file_hash)
+
+# Latest modification time of a file or anything in a directory tree
+def _last_modified(path):
+    latest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                pass
+    return latest
+
+# Delete legacy tmp/<uuid>.xls(x) uploads and converted-sheet directories of files the store
+# doesn't know (e.g. those legacy uploads) once untouched for UPLOAD_TTL and no session refers
+# to them (legacy sessions record their file's hash in refs too). Returns the count removed.
+def _sweep_orphans(conn, cutoff):
+    removed = 0
+    known = {row[0] for row in conn.execute('SELECT file_hash FROM uploads')}
+    referenced = {row[0] for row in conn.execute('SELECT file_hash FROM refs')}
+    candidates = [(os.path.join(LEGACY_UPLOAD_DIR, name), None)
+                  for name in os.listdir(LEGACY_UPLOAD_DIR) if _LEGACY_NAME.match(name)]
+    if os.path.isdir(columnar_store.STORE_FOLDER):
+        candidates += [(columnar_store.artifact_dir(name), name)
+                       for name in os.listdir(columnar_store.STORE_FOLDER)
+                       if name not in known and name not in referenced]
+    for path, file_hash in candidates:
+        try:
+            if _last_modified(path) >= cutoff:
+                continue
+            if file_hash is None:
+                if sheet_cache.file_hash(path) in referenced:
+                    continue
+                os.remove(path)
+            else:
+                shutil.rmtree(path)
+                sheet_cache.invalidate(file_hash)
+            removed += 1
+        except OSError as e:
+            print(f"Upload store: could not remove {path}: {e}")
+    return removed
+
+# One sweep: expire idle session references, then delete unreferenced uploads past their
+# TTL, then the least recently used unreferenced uploads while over the disk quota, then
+# legacy uploads and orphaned converted sheets past the TTL.
+# Returns the number of uploads removed.
+def sweep():
+    now = time.time()
+
+    def collect(conn):
+        conn.execute('DELETE FROM refs WHERE last_seen < ?', (now - UPLOAD_REF_TTL,))
+        unreferenced = conn.execute(
+            'SELECT file_hash, path, last_access FROM uploads '
+            'WHERE file_hash NOT IN (SELECT file_hash FROM refs) ORDER BY last_access').fetchall()
+        usage = {file_hash: _disk_usage(path) + _disk_usage(columnar_store.artifact_dir(file_hash))
+                 for file_hash, path in conn.execute('SELECT file_hash, path FROM uploads')}
+        total = sum(usage.values())
+        budget = UPLOAD_QUOTA_MB * 1024 * 1024
+        removed = 0
+        for file_hash, path, last_access in unreferenced:
+            if last_access >= now - UPLOAD_TTL and total <= budget:
+                continue
+            # Files are deleted while the transaction holds the write lock, so a
+            # re-upload of the same content waits and then stores it afresh
+            conn.execute('DELETE FROM uploads WHERE file_hash = ?', (file_hash,))
+            _remove(file_hash, path)
+            total -= usage.get(file_hash, 0)
+            removed += 1
+        return removed, total, _sweep_orphans(conn, now - UPLOAD_TTL)
+
+    removed, total, orphans = _transaction(collect)
+    # Sessions idle this long would write on their next touch anyway
+    for ref_id, touched_at in list(_touched.items()):
+        if touched_at < now - _TOUCH_INTERVAL:
+            _touched.pop(ref_id, None)
+    if removed:
+        print(f"Upload store: removed {removed} unused upload(s), {total / (1024 * 1024):.1f}MB in use.")
+    if orphans:
+        print(f"Upload store: removed {orphans} legacy upload(s) and orphaned converted sheets.")
+    return removed
+
+# Sweep every UPLOAD_SWEEP_INTERVAL seconds
+def _sweep_loop():
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            print(f"Upload store: sweep failed: {e}")
+        time.sleep(UPLOAD_SWEEP_INTERVAL)
+
+# Start the sweeper thread once per process (forked server workers each start their own)
+def _ensure_sweeper():
+    global _sweeper_pid
+    if _sweeper_pid == os.getpid() or UPLOAD_SWEEP_INTERVAL <= 0:
+        return
+    with _sweeper_lock:
+        if _sweeper_pid != os.getpid():
+            _sweeper_pid = os.getpid()
+            threading.Thread(target=_sweep_loop, name='upload-sweeper', daemon=True).start()
+
+# Number of stored uploads, live session references and bytes used by the uploads themselves
+def stats():
+    try:
+        conn = _connect()
+        uploads, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads').fetchone()
+        refs = conn.execute('SELECT COUNT(*) FROM refs').fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Upload store: stats failed: {e}")
+        uploads, size, refs = 0, 0, 0
+    return {'uploads': uploads, 'upload_bytes': size, 'refs': refs}